@@ -0,0 +1,3 @@
+"""
+End-to-end benchmarks for the MCAS DLP policy trigger to Box file classification sync
+"""
@@ -0,0 +1,121 @@
+"""
+Cold start import time check of the CLI. Runs CLI invocations in fresh interpreters under -X importtime, reports their
+import time and slowest imports, and fails if an invocation imports a module it should not or exceeds its budget.
+
+    $ python -m benchmarks.importtime
+    $ python -m benchmarks.importtime --budget-ms 150 --json importtime.json
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+from typing import Dict, List, NamedTuple, Tuple
+
+
+# Heavy SDKs that CLI startup and --help must not import
+HEAVY_MODULES = ("boxsdk", "cryptography", "jwt", "sqlalchemy", "sqlalchemy_utils", "requests", "psutil", "aiohttp")
+
+
+class Invocation(NamedTuple):
+    """
+    A CLI invocation and the top level packages it must not import
+    """
+    name: str
+    args: List[str]
+    forbidden_modules: Tuple[str, ...]
+
+
+INVOCATIONS = [
+    Invocation("help", ["--help"], HEAVY_MODULES),
+    Invocation("sql-create-table --help", ["sql-create-table", "--help"], ("boxsdk", "sqlalchemy_utils", "psutil")),
+    Invocation(
+        "kill-pythonw-process --help", ["kill-pythonw-process", "--help"], ("boxsdk", "sqlalchemy", "requests")
+    ),
+    Invocation("mcas-policy-box-classification-sync --help", ["mcas-policy-box-classification-sync", "--help"], ()),
+]
+
+
+def parse_args() -> argparse.Namespace:
+    """
+    Parses the import time check's command line arguments
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--budget-ms", type=float, default=100, help="import time budget in milliseconds of the --help invocation"
+    )
+    parser.add_argument("--runs", type=int, default=3, help="runs of each invocation, the fastest is reported")
+    parser.add_argument("--top", type=int, default=5, help="slowest imports to report per invocation")
+    parser.add_argument("--json", dest="json_path", default=None, help="also write the report to a JSON file")
+
+    return parser.parse_args()
+
+
+def measure_imports(args: List[str]) -> Dict[str, Tuple[int, int]]:
+    """
+    Runs the CLI with arguments in a fresh interpreter under -X importtime. Returns each imported module's self and
+    cumulative import time in microseconds.
+    """
+    repository_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    python_path = os.pathsep.join(filter(None, [repository_dir, os.environ.get("PYTHONPATH")]))
+    environment = dict(os.environ, PYTHONPATH=python_path)
+    completed_process = subprocess.run(
+        [sys.executable, "-X", "importtime", os.path.join(repository_dir, "src", "main.py")] + args,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        env=environment,
+        universal_newlines=True,
+        check=True,
+    )
+
+    imports = dict()
+    for line in completed_process.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, module_name = line[len("import time:"):].split("|")
+        imports[module_name.strip()] = (int(self_us), int(cumulative_us))
+
+    return imports
+
+
+def main() -> None:
+    """
+    Measures every invocation, prints the report and exits non-zero on a regression
+    """
+    args = parse_args()
+    report = dict()
+    failures = list()
+    for invocation in INVOCATIONS:
+        imports = min((measure_imports(invocation.args) for _ in range(args.runs)), key=lambda runs_imports: sum(
+            self_us for self_us, _ in runs_imports.values()
+        ))
+        total_ms = sum(self_us for self_us, _ in imports.values()) / 1000
+        imported_packages = {module_name.split(".")[0] for module_name in imports}
+        forbidden_imports = sorted(imported_packages.intersection(invocation.forbidden_modules))
+        report[invocation.name] = {
+            "import_ms": round(total_ms, 1),
+            "modules": len(imports),
+            "slowest": {
+                module_name: round(cumulative_us / 1000, 1)
+                for module_name, (_, cumulative_us) in sorted(
+                    imports.items(), key=lambda module_import: -module_import[1][1]
+                )[:args.top]
+            },
+            "forbidden_imports": forbidden_imports,
+        }
+        if forbidden_imports:
+            failures.append(f"{invocation.name} imports {', '.join(forbidden_imports)}")
+    if report["help"]["import_ms"] > args.budget_ms:
+        failures.append(f"help imports take {report['help']['import_ms']} ms, over the {args.budget_ms} ms budget")
+
+    print(json.dumps(report, indent=2))
+    if args.json_path:
+        with open(args.json_path, "w") as fh:
+            json.dump(report, fh, indent=2)
+    if failures:
+        sys.exit("import time regression: " + "; ".join(failures))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,334 @@
+"""
+Local stand-in HTTP servers for the Microsoft Cloud App Security files endpoint and the Box Platform users and
+classification metadata endpoints. Responses can be slowed with latency and made to fail with injected 500 and 429
+responses, and every request is counted and timed.
+"""
+
+from __future__ import annotations
+from collections import Counter, defaultdict, deque
+import http.server
+import json
+import random
+import re
+import threading
+import time
+from typing import Deque, Dict, List, NamedTuple, Optional
+from urllib.parse import parse_qs, urlparse
+
+
+class StubBehaviour(NamedTuple):
+    """
+    Latency and fault injection settings of a stub server. Rates are the probability of each request failing that way.
+    Requests over a quota of requests a second are throttled too.
+    """
+    latency: float = 0.0
+    latency_jitter: float = 0.0
+    error_rate: float = 0.0
+    throttle_rate: float = 0.0
+    retry_after: int = 1
+    quota: Optional[float] = None
+
+
+class StubRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Keep-alive HTTP request handler that dispatches requests to its stub server
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def _handle(self) -> None:
+        """
+        Reads the request body and passes the request to the stub server
+        """
+        content_length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(content_length) if content_length else b""
+        self.server.stub.handle(self, body)
+
+    do_GET = _handle
+    do_POST = _handle
+    do_PUT = _handle
+
+    def send_json(self, status: int, body: Optional[object] = None, headers: Optional[Dict[str, str]] = None) -> None:
+        """
+        Sends a JSON response
+        """
+        payload = json.dumps(body).encode("utf-8") if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args) -> None:
+        """
+        Silences per request logging
+        """
+        pass
+
+
+class StubServer:
+    """
+    Base stub HTTP server run on a daemon thread. Subclasses route requests in handle_request.
+    """
+
+    def __init__(self, behaviour: StubBehaviour = StubBehaviour(), host: str = "127.0.0.1", port: int = 0) -> StubServer:
+        self.behaviour: StubBehaviour = behaviour
+        self._server = http.server.ThreadingHTTPServer((host, port), StubRequestHandler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self._lock: threading.Lock = threading.Lock()
+        self.calls: Counter = Counter()
+        self.injected: Counter = Counter()
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        # Arrival times of the requests within the quota in the last second
+        self._quota_window: Deque[float] = deque()
+        self._random: random.Random = random.Random(0)
+
+    @property
+    def url(self) -> str:
+        """
+        Base URL of the running server
+        """
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> StubServer:
+        """
+        Serves requests on a daemon thread
+        """
+        threading.Thread(target=self._server.serve_forever, name=type(self).__name__, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        """
+        Stops serving requests
+        """
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _roll(self, rate: float) -> bool:
+        """
+        Returns True with a probability of rate
+        """
+        with self._lock:
+            return self._random.random() < rate
+
+    def _over_quota(self) -> bool:
+        """
+        Returns True if a request would exceed the quota of requests a second, and otherwise counts it against the quota
+        """
+        if not self.behaviour.quota:
+            return False
+
+        now = time.monotonic()
+        with self._lock:
+            while self._quota_window and self._quota_window[0] <= now - 1:
+                self._quota_window.popleft()
+            if len(self._quota_window) >= self.behaviour.quota:
+                return True
+            self._quota_window.append(now)
+
+        return False
+
+    def handle(self, handler: StubRequestHandler, body: bytes) -> None:
+        """
+        Applies latency and fault injection to a request, then routes it to handle_request
+        """
+        started_at = time.monotonic()
+        route = self.route(handler.command, urlparse(handler.path).path)
+        delay = self.behaviour.latency + self.behaviour.latency_jitter * self._random.random()
+        if delay > 0:
+            time.sleep(delay)
+
+        if self._over_quota() or self._roll(self.behaviour.throttle_rate):
+            outcome = "429"
+            handler.send_json(
+                429,
+                {"type": "error", "status": 429, "code": "rate_limit_exceeded", "message": "Request rate limit exceeded"},
+                {"Retry-After": str(self.behaviour.retry_after)},
+            )
+        elif self._roll(self.behaviour.error_rate):
+            outcome = "500"
+            handler.send_json(500, {"type": "error", "status": 500, "code": "internal_server_error", "message": ""})
+        else:
+            outcome = None
+            self.handle_request(handler, route, body)
+
+        with self._lock:
+            self.calls[route] += 1
+            if outcome:
+                self.injected[f"{route} {outcome}"] += 1
+            self.latencies[route].append(time.monotonic() - started_at)
+
+    def route(self, method: str, path: str) -> str:
+        """
+        Returns the name a request is counted under
+        """
+        return f"{method} {path}"
+
+    def handle_request(self, handler: StubRequestHandler, route: str, body: bytes) -> None:
+        """
+        Sends the response to a request
+        """
+        handler.send_json(404, {"type": "error", "status": 404, "code": "not_found", "message": ""})
+
+
+class MCASStubServer(StubServer):
+    """
+    Stand-in MCAS files endpoint. Serves skip and limit paginated pages of DLP policy triggers for a set of policies,
+    each trigger pointing at a Box file owned by one of a set of owner emails. Existing files were modified a second
+    apart up to the server's start, and each policy gains new_files_per_second new files after it. Supports the
+    modifiedDate filter sorted by modification.
+    """
+
+    def __init__(
+            self,
+            policy_file_counts: Dict[str, int],
+            owner_emails: List[str],
+            behaviour: StubBehaviour = StubBehaviour(),
+            new_files_per_second: float = 0.0,
+            **kwargs
+    ) -> MCASStubServer:
+        super().__init__(behaviour, **kwargs)
+        self._policy_indexes: Dict[str, int] = {policy_id: index for index, policy_id in enumerate(policy_file_counts)}
+        self._policy_file_counts: Dict[str, int] = policy_file_counts
+        self._owner_emails: List[str] = owner_emails
+        self._new_files_per_second: float = new_files_per_second
+        self._started_at: float = time.time()
+
+    def file_count(self, mcas_policy_id: str) -> int:
+        """
+        Number of files matching a policy so far
+        """
+        return self._policy_file_counts.get(mcas_policy_id, 0) + int(
+            (time.time() - self._started_at) * self._new_files_per_second
+        )
+
+    def _modified_date(self, mcas_policy_id: str, file_index: int) -> int:
+        """
+        Epoch milliseconds a policy's file was last modified
+        """
+        existing_file_count = self._policy_file_counts.get(mcas_policy_id, 0)
+        if file_index < existing_file_count:
+            return int((self._started_at - (existing_file_count - file_index)) * 1000)
+
+        return int((self._started_at + (file_index - existing_file_count + 1) / self._new_files_per_second) * 1000)
+
+    def route(self, method: str, path: str) -> str:
+        return "mcas files" if path.rstrip("/") == "/api/v1/files" else super().route(method, path)
+
+    def handle_request(self, handler: StubRequestHandler, route: str, body: bytes) -> None:
+        if route != "mcas files":
+            return super().handle_request(handler, route, body)
+
+        request_body = json.loads(body or b"{}")
+        skip = int(parse_qs(urlparse(handler.path).query).get("skip", ["0"])[0])
+        limit = int(request_body.get("limit") or 100)
+        mcas_policy_id = request_body["filters"]["policy"]["cabinetmatchedrulesequals"][0]
+        policy_index = self._policy_indexes.get(mcas_policy_id)
+        file_count = self.file_count(mcas_policy_id)
+        # Files are in modification order, so the files modified since a time are a suffix
+        first_file_index = 0
+        modified_since = request_body["filters"].get("modifiedDate", {}).get("gte")
+        if modified_since is not None:
+            while (
+                    first_file_index < file_count
+                    and self._modified_date(mcas_policy_id, first_file_index) < modified_since
+            ):
+                first_file_index += 1
+        matched_file_count = file_count - first_file_index
+        data = list()
+        for file_index in range(first_file_index + skip, min(first_file_index + skip + limit, file_count)):
+            box_file_id = str(policy_index * 10 ** 9 + file_index)
+            data.append({
+                "_id": f"{mcas_policy_id}-{file_index}",
+                "id": f"{mcas_policy_id}-{file_index}",
+                "modifiedDate": self._modified_date(mcas_policy_id, file_index),
+                "boxItem": {
+                    "id": box_file_id,
+                    "name": f"file-{box_file_id}.docx",
+                    "owned_by": {"login": self._owner_emails[file_index % len(self._owner_emails)]},
+                },
+            })
+
+        handler.send_json(
+            200, {"total": matched_file_count, "hasNext": skip + limit < matched_file_count, "data": data}
+        )
+
+
+class BoxStubServer(StubServer):
+    """
+    Stand-in Box users and classification metadata endpoints. Keeps each file's classification in memory, so a second
+    classification create conflicts like the real API.
+    """
+
+    metadata_path = re.compile(r"^/files/(?P<file_id>[^/]+)/metadata/enterprise/(?P<template_key>[^/]+)$")
+
+    def __init__(
+            self,
+            box_user_ids: Dict[str, str],
+            behaviour: StubBehaviour = StubBehaviour(),
+            forbidden_rate: float = 0.0,
+            **kwargs
+    ) -> BoxStubServer:
+        super().__init__(behaviour, **kwargs)
+        self._box_user_ids: Dict[str, str] = box_user_ids
+        self._forbidden_rate: float = forbidden_rate
+        self._classifications: Dict[str, dict] = dict()
+
+    def route(self, method: str, path: str) -> str:
+        if path.rstrip("/") == "/users":
+            return "box users"
+        if self.metadata_path.match(path):
+            return f"box metadata {method}"
+
+        return super().route(method, path)
+
+    def handle_request(self, handler: StubRequestHandler, route: str, body: bytes) -> None:
+        if route == "box users":
+            email = parse_qs(urlparse(handler.path).query).get("filter_term", [""])[0]
+            entries = list()
+            if email in self._box_user_ids:
+                entries.append({"type": "user", "id": self._box_user_ids[email], "login": email, "name": email})
+            handler.send_json(200, {"entries": entries, "total_count": len(entries), "limit": 1, "offset": 0})
+            return
+
+        metadata_match = self.metadata_path.match(urlparse(handler.path).path)
+        if not metadata_match:
+            return super().handle_request(handler, route, body)
+
+        box_file_id = metadata_match.group("file_id")
+        with self._lock:
+            classification = self._classifications.get(box_file_id)
+        if handler.command == "GET":
+            if classification is None:
+                handler.send_json(404, {"type": "error", "status": 404, "code": "instance_not_found", "message": ""})
+            else:
+                handler.send_json(200, classification)
+        elif handler.command == "POST":
+            if self._roll(self._forbidden_rate):
+                handler.send_json(403, {
+                    "type": "error", "status": 403, "code": "access_denied_insufficient_permissions", "message": ""
+                })
+            elif classification is not None:
+                handler.send_json(409, {"type": "error", "status": 409, "code": "tuple_already_exists", "message": ""})
+            else:
+                classification = dict(json.loads(body), **{"$id": box_file_id, "$parent": f"file_{box_file_id}"})
+                with self._lock:
+                    self._classifications[box_file_id] = classification
+                handler.send_json(201, classification)
+        else:
+            for operation in json.loads(body):
+                classification = dict(classification or {}, **{operation["path"].lstrip("/"): operation["value"]})
+            with self._lock:
+                self._classifications[box_file_id] = classification
+            handler.send_json(200, classification)
+
+    @property
+    def classified_file_count(self) -> int:
+        """
+        Number of files with a classification
+        """
+        return len(self._classifications)
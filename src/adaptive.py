@@ -0,0 +1,281 @@
+"""
+Adaptive additive increase, multiplicative decrease (AIMD) control of the Box API rate limits and concurrency
+"""
+
+from __future__ import annotations
+import logging
+import threading
+import time
+from typing import Dict, List, Optional
+
+from src import metrics
+
+
+log = logging.getLogger(__name__)
+
+
+# Adjustment directions and reasons, as labelled on the box_adaptive_adjustments_total counter
+INCREASE = "increase"
+DECREASE = "decrease"
+REASON_HEALTHY = "healthy"
+REASON_THROTTLED = "throttled"
+REASON_ERRORS = "errors"
+REASON_LATENCY = "latency"
+
+# Factor the latency baseline may rise by each window, so that it follows a slow change in Box's latency
+BASELINE_DRIFT = 1.05
+
+
+def configure_aimd_controller(
+        config: dict,
+        rate_limiters: Dict[str, object],
+        concurrency_limiters: Dict[str, object]
+) -> Optional[AIMDController]:
+    """
+    Configures an AIMDController over rate limiters and concurrency limiters from the "adaptive" settings of a
+    configuration dictionary's "box" section. Returns None unless adaptive control is enabled.
+    """
+    adaptive_config = (config.get("box") or {}).get("adaptive") or {}
+    if not adaptive_config.get("enabled"):
+        return None
+
+    return AIMDController(
+        rate_limiters,
+        concurrency_limiters,
+        interval=adaptive_config.get("interval", 5),
+        min_samples=adaptive_config.get("min_samples", 20),
+        decrease_factor=adaptive_config.get("decrease_factor", 0.5),
+        error_rate=adaptive_config.get("error_rate", 0.05),
+        latency_tolerance=adaptive_config.get("latency_tolerance", 2.0),
+        max_p95_latency=adaptive_config.get("max_p95_latency"),
+        rate_increase=adaptive_config.get("rate_increase", 1),
+        min_rate=adaptive_config.get("min_rate", 1),
+        max_rate=adaptive_config.get("max_rate", 50),
+        concurrency_increase=adaptive_config.get("concurrency_increase", 5),
+        min_concurrency=adaptive_config.get("min_concurrency", 4),
+        max_concurrency=adaptive_config.get("max_concurrency"),
+    )
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """
+    Returns the nearest rank percentile of a non-empty list of values
+    """
+    sorted_values = sorted(values)
+
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+class AIMDController:
+    """
+    Adapts the Box API rate limits and concurrency to the responses Box returns. While Box is healthy, every rate limit
+    rises by rate_increase calls per second and every concurrency by concurrency_increase each interval. A 429
+    response or Retry-After header cuts them at once by decrease_factor, and holds them there for the Retry-After
+    delay. So does a window whose error rate, counting 5xx responses and connection errors, is above error_rate, or
+    whose p95 latency is above latency_tolerance times the lowest p95 seen, or above max_p95_latency.
+
+    Rate limiters have calls_per_second and set_rate, and concurrency limiters concurrency and set_concurrency, such
+    as http_utils.RateLimiter, aio.AsyncRateLimiter, thread.WorkerPool and aio.AsyncConcurrencyLimiter. Each
+    concurrency limiter's maximum defaults to its starting concurrency. Responses are reported to observe, from any
+    thread.
+    """
+
+    def __init__(
+            self,
+            rate_limiters: Dict[str, object],
+            concurrency_limiters: Dict[str, object],
+            interval: float = 5,
+            min_samples: int = 20,
+            decrease_factor: float = 0.5,
+            error_rate: float = 0.05,
+            latency_tolerance: float = 2.0,
+            max_p95_latency: Optional[float] = None,
+            rate_increase: float = 1,
+            min_rate: float = 1,
+            max_rate: float = 50,
+            concurrency_increase: int = 5,
+            min_concurrency: int = 4,
+            max_concurrency: Optional[int] = None
+    ) -> AIMDController:
+        if not 0 < decrease_factor < 1:
+            raise ValueError("decrease_factor must be between 0 and 1")
+        if not 0 < min_rate <= max_rate:
+            raise ValueError("min_rate must be greater than 0 and at most max_rate")
+
+        self._rate_limiters: Dict[str, object] = rate_limiters
+        self._concurrency_limiters: Dict[str, object] = concurrency_limiters
+        self._interval: float = interval
+        self._min_samples: int = min_samples
+        self._decrease_factor: float = decrease_factor
+        self._error_rate: float = error_rate
+        self._latency_tolerance: float = latency_tolerance
+        self._max_p95_latency: Optional[float] = max_p95_latency
+        self._rate_increase: float = rate_increase
+        self._min_rate: float = min_rate
+        self._max_rate: float = max_rate
+        self._concurrency_increase: int = concurrency_increase
+        self._min_concurrency: int = max(1, min_concurrency)
+        self._max_concurrencies: Dict[str, int] = {
+            limiter_name: max(1, max_concurrency or concurrency_limiter.concurrency)
+            for limiter_name, concurrency_limiter in concurrency_limiters.items()
+        }
+        self._lock: threading.Lock = threading.Lock()
+        # Response count, error count and latencies of the current window
+        self._responses: int = 0
+        self._errors: int = 0
+        self._latencies: List[float] = list()
+        self._window_started_at: float = time.monotonic()
+        self._decreased_at: Optional[float] = None
+        self._hold_until: float = 0
+        self._baseline_p95: Optional[float] = None
+        self._p95: Optional[float] = None
+        for endpoint_alias, rate_limiter in rate_limiters.items():
+            metrics.registry.gauge(
+                "box_adaptive_calls_per_second", "Adaptive Box API rate limit", {"endpoint": endpoint_alias}
+            ).set_function(lambda rate_limiter=rate_limiter: rate_limiter.calls_per_second)
+        for limiter_name, concurrency_limiter in concurrency_limiters.items():
+            metrics.registry.gauge(
+                "box_adaptive_concurrency", "Adaptive cap on concurrent Box API work", {"limiter": limiter_name}
+            ).set_function(lambda concurrency_limiter=concurrency_limiter: concurrency_limiter.concurrency)
+        metrics.registry.gauge(
+            "box_api_latency_p95_seconds", "p95 Box API latency of the last adaptive control window"
+        ).set_function(lambda: self._p95 or 0)
+        log.info(f"adapting Box API limits every {interval} seconds from {self._limits()}")
+
+    def _limits(self) -> str:
+        """
+        Describes the current rate limits and concurrency
+        """
+        return ", ".join(
+            [
+                f"{endpoint_alias} {rate_limiter.calls_per_second:.1f} calls per second"
+                for endpoint_alias, rate_limiter in self._rate_limiters.items()
+            ] + [
+                f"{limiter_name} concurrency {concurrency_limiter.concurrency}"
+                for limiter_name, concurrency_limiter in self._concurrency_limiters.items()
+            ]
+        )
+
+    def _adjust(self, direction: str, reason: str, detail: str) -> None:
+        """
+        Raises every limit additively or cuts it multiplicatively, within its bounds. Called with the lock held.
+        """
+        # Limits configured outside their bounds only move towards them
+        for rate_limiter in self._rate_limiters.values():
+            calls_per_second = rate_limiter.calls_per_second
+            if direction == INCREASE:
+                rate_limiter.set_rate(
+                    max(calls_per_second, min(self._max_rate, calls_per_second + self._rate_increase))
+                )
+            else:
+                rate_limiter.set_rate(
+                    min(calls_per_second, max(self._min_rate, calls_per_second * self._decrease_factor))
+                )
+        for limiter_name, concurrency_limiter in self._concurrency_limiters.items():
+            concurrency = concurrency_limiter.concurrency
+            if direction == INCREASE:
+                concurrency_limiter.set_concurrency(max(concurrency, min(
+                    self._max_concurrencies[limiter_name], concurrency + self._concurrency_increase
+                )))
+            else:
+                concurrency_limiter.set_concurrency(min(concurrency, max(
+                    self._min_concurrency, int(concurrency * self._decrease_factor)
+                )))
+
+        metrics.registry.counter(
+            "box_adaptive_adjustments_total",
+            "Adaptive Box API limit adjustments",
+            {"direction": direction, "reason": reason},
+        ).inc()
+        log.log(
+            logging.WARNING if direction == DECREASE else logging.INFO,
+            f"{direction}d Box API limits after {detail} to {self._limits()}"
+        )
+
+    def _at_bounds(self, direction: str) -> bool:
+        """
+        True if every limit is already at its bound in a direction. Called with the lock held.
+        """
+        if direction == INCREASE:
+            return all(
+                rate_limiter.calls_per_second >= self._max_rate for rate_limiter in self._rate_limiters.values()
+            ) and all(
+                concurrency_limiter.concurrency >= self._max_concurrencies[limiter_name]
+                for limiter_name, concurrency_limiter in self._concurrency_limiters.items()
+            )
+
+        return all(
+            rate_limiter.calls_per_second <= self._min_rate for rate_limiter in self._rate_limiters.values()
+        ) and all(
+            concurrency_limiter.concurrency <= self._min_concurrency
+            for limiter_name, concurrency_limiter in self._concurrency_limiters.items()
+        )
+
+    def _decrease(self, now: float, reason: str, detail: str) -> None:
+        """
+        Cuts the limits, at most once an interval, and starts a new window. Called with the lock held.
+        """
+        if self._decreased_at is None or now - self._decreased_at >= self._interval:
+            self._decreased_at = now
+            if not self._at_bounds(DECREASE):
+                self._adjust(DECREASE, reason, detail)
+        self._responses, self._errors, self._latencies = 0, 0, list()
+        self._window_started_at = now
+
+    def observe(self, latency: float, status: Optional[int], retry_after: Optional[float] = None) -> None:
+        """
+        Records a Box API response's latency in seconds, its status, or None on a connection error, and its Retry-After
+        delay in seconds. Adjusts the limits on throttling and at the end of each interval.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if status == 429 or retry_after is not None:
+                self._hold_until = max(self._hold_until, now + (retry_after or 0))
+                self._decrease(
+                    now,
+                    REASON_THROTTLED,
+                    f"HTTP {status}" + (f" with Retry-After {retry_after:g} seconds" if retry_after is not None else "")
+                )
+                return
+
+            self._responses += 1
+            if status is None or status >= 500:
+                self._errors += 1
+            if status is not None:
+                self._latencies.append(latency)
+            if now - self._window_started_at >= self._interval:
+                self._end_window(now)
+
+    def _end_window(self, now: float) -> None:
+        """
+        Ends the current window once it holds min_samples responses. Cuts the limits if the window was unhealthy, and
+        raises them if it was healthy and no Retry-After delay holds them. Called with the lock held.
+        """
+        if self._responses < self._min_samples:
+            return
+
+        responses, errors, latencies = self._responses, self._errors, self._latencies
+        self._responses, self._errors, self._latencies = 0, 0, list()
+        self._window_started_at = now
+        if latencies:
+            self._p95 = percentile(latencies, 0.95)
+            self._baseline_p95 = self._p95 if self._baseline_p95 is None else min(
+                self._p95, self._baseline_p95 * BASELINE_DRIFT
+            )
+
+        if errors / responses > self._error_rate:
+            self._decrease(now, REASON_ERRORS, f"{errors} errors in {responses} responses")
+        elif latencies and self._p95 > self._baseline_p95 * self._latency_tolerance:
+            self._decrease(
+                now, REASON_LATENCY, f"p95 latency rose to {self._p95:.3f} from {self._baseline_p95:.3f} seconds"
+            )
+        elif latencies and self._max_p95_latency and self._p95 > self._max_p95_latency:
+            self._decrease(
+                now, REASON_LATENCY, f"p95 latency of {self._p95:.3f} seconds, over {self._max_p95_latency:g} seconds"
+            )
+        elif now >= self._hold_until and not self._at_bounds(INCREASE):
+            self._adjust(
+                INCREASE,
+                REASON_HEALTHY,
+                f"{responses} responses with {errors} errors and p95 latency {self._p95 or 0:.3f} seconds"
+            )
@@ -0,0 +1,496 @@
+"""
+asyncio HTTP utilities and REST clients for Microsoft Cloud App Security and Box Platform. Requires aiohttp.
+"""
+
+from __future__ import annotations
+import asyncio
+from collections import deque
+import datetime
+import json
+import logging
+import random
+import time
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import aiohttp
+import boxsdk
+from boxsdk.config import API
+
+from src import box
+from src import cache
+from src import http_utils
+from src import mcas
+
+
+log = logging.getLogger(__name__)
+
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class AsyncRateLimiter:
+    """
+    asyncio token bucket HTTP rate limiter. Tokens refill continuously at rate_limit tokens per second up to a bucket
+    size of burst. Waiting coroutines are released in FIFO order.
+    """
+
+    def __init__(self, rate_limit: float = 15, burst: int = 1) -> AsyncRateLimiter:
+        if rate_limit <= 0:
+            raise ValueError("rate_limit must be greater than 0")
+
+        self._rate_limit: float = float(rate_limit)
+        self._burst: int = max(1, int(burst))
+        self._tokens: float = float(self._burst)
+        self._refilled_at: float = time.monotonic()
+        self._lock: Optional[asyncio.Lock] = None
+
+    @property
+    def calls_per_second(self) -> float:
+        """
+        Current rate limit in calls per second
+        """
+        return self._rate_limit
+
+    def set_rate(self, calls_per_second: float) -> None:
+        """
+        Changes the rate limit. Tokens accrued at the old rate are kept.
+        """
+        if calls_per_second <= 0:
+            raise ValueError("calls_per_second must be greater than 0")
+
+        self._refill()
+        self._rate_limit = float(calls_per_second)
+
+    @classmethod
+    def from_rate_limiter(cls, rate_limiter: http_utils.RateLimiter) -> AsyncRateLimiter:
+        """
+        Instantiates an AsyncRateLimiter with the same budget as a thread safe RateLimiter
+        """
+        return cls(rate_limiter.calls_per_second, rate_limiter.burst)
+
+    def _refill(self) -> None:
+        """
+        Adds the tokens accrued since the last refill to the bucket
+        """
+        now = time.monotonic()
+        self._tokens = min(self._burst, self._tokens + (now - self._refilled_at) * self._rate_limit)
+        self._refilled_at = now
+
+    async def rate_limit(self) -> float:
+        """
+        Returns when the next rate limited HTTP call can be made. Returns the seconds spent waiting.
+        """
+        started_at = time.monotonic()
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        # asyncio.Lock wakes waiters in FIFO order, and the holder sleeps until its token is available
+        async with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self._rate_limit)
+                self._refill()
+            self._tokens -= 1
+
+        return time.monotonic() - started_at
+
+    async def __aenter__(self) -> None:
+        """
+        Async context manager entry
+        """
+        await self.rate_limit()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        """
+        Async context manager exit
+        """
+        pass
+
+
+class AsyncConcurrencyLimiter:
+    """
+    asyncio semaphore whose concurrency can be changed while it is held. Lowering the concurrency lets in-flight holders
+    finish and admits no waiter until fewer than the new concurrency hold it. Waiting coroutines are admitted in FIFO
+    order.
+    """
+
+    def __init__(self, concurrency: int) -> AsyncConcurrencyLimiter:
+        if concurrency <= 0:
+            raise ValueError("concurrency must be greater than 0")
+
+        self._concurrency: int = concurrency
+        self._holders: int = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    @property
+    def concurrency(self) -> int:
+        """
+        Current cap on concurrent holders
+        """
+        return self._concurrency
+
+    def set_concurrency(self, concurrency: int) -> None:
+        """
+        Changes the cap on concurrent holders, admitting waiters if it was raised
+        """
+        if concurrency <= 0:
+            raise ValueError("concurrency must be greater than 0")
+
+        self._concurrency = concurrency
+        self._wake()
+
+    def _wake(self) -> None:
+        """
+        Admits waiters in FIFO order while below the concurrency cap
+        """
+        while self._waiters and self._holders < self._concurrency:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self._holders += 1
+                waiter.set_result(None)
+
+    async def acquire(self) -> None:
+        """
+        Waits until below the concurrency cap, behind any earlier waiters
+        """
+        if not self._waiters and self._holders < self._concurrency:
+            self._holders += 1
+            return
+
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Admitted as it was cancelled, so the slot is handed on
+                self.release()
+            raise
+
+    def release(self) -> None:
+        """
+        Releases a hold, admitting the next waiter if below the concurrency cap
+        """
+        self._holders -= 1
+        self._wake()
+
+    async def __aenter__(self) -> None:
+        """
+        Async context manager entry
+        """
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        """
+        Async context manager exit
+        """
+        self.release()
+
+
+class AsyncHTTPError(Exception):
+    """
+    Unsuccessful HTTP response. Carries the same status and code attributes as boxsdk.BoxAPIException.
+    """
+
+    def __init__(self, status: int, code: Optional[str] = None, message: str = "", headers: Optional[dict] = None):
+        super().__init__(f"HTTP {status} {code or ''} {message}".strip())
+        self.status = status
+        self.code = code
+        self.message = message
+        self.headers = headers or {}
+
+
+def retry_after_seconds(headers: dict, attempt: int, backoff_factor: float) -> float:
+    """
+    Returns the seconds to wait before retrying a request, from a Retry-After header or exponential backoff with jitter
+    """
+    retry_after = http_utils.parse_retry_after(headers)
+    if retry_after is not None:
+        return retry_after
+
+    return backoff_factor * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+
+class AsyncHTTPClient:
+    """
+    Base asyncio REST client. Owns a pooled keep-alive aiohttp.ClientSession with timeouts, and retries throttled and
+    failed calls with exponential backoff, honouring Retry-After headers. Response observers are called after every
+    response, including the responses of retried calls.
+    """
+
+    def __init__(
+            self,
+            pool_size: int = 100,
+            connect_timeout: float = 10,
+            read_timeout: float = 60,
+            retries: int = 5,
+            backoff_factor: float = 1,
+    ) -> AsyncHTTPClient:
+        self._pool_size: int = pool_size
+        self._timeout: aiohttp.ClientTimeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self._retries: int = retries
+        self._backoff_factor: float = backoff_factor
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._response_observers: List[http_utils.ResponseObserver] = list()
+
+    def add_response_observer(self, observer: http_utils.ResponseObserver) -> None:
+        """
+        Adds an observer called with the latency, status and Retry-After delay of every response
+        """
+        self._response_observers.append(observer)
+
+    def _observe_response(self, latency: float, status: Optional[int], retry_after: Optional[float]) -> None:
+        """
+        Calls the response observers, logging rather than raising their errors
+        """
+        for observer in self._response_observers:
+            try:
+                observer(latency, status, retry_after)
+            except Exception as e:
+                log.error(f"failed to observe an HTTP response with {e!r}")
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """
+        Lazily created aiohttp session, bound to the running event loop
+        """
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self._pool_size),
+                timeout=self._timeout,
+                headers={"Accept-Encoding": "gzip"},
+            )
+
+        return self._session
+
+    async def _headers(self) -> dict:
+        """
+        Returns per-request headers
+        """
+        return dict()
+
+    async def _on_unauthorized(self) -> bool:
+        """
+        Called on a 401 response. Returns True if the request should be retried.
+        """
+        return False
+
+    async def request(
+            self,
+            method: str,
+            url: str,
+            rate_limiter: AsyncRateLimiter,
+            headers: Optional[dict] = None,
+            **kwargs
+    ) -> Tuple[int, Any]:
+        """
+        Makes a rate limited HTTP request. Returns the response status and parsed JSON body. Raises AsyncHTTPError on an
+        unsuccessful response once retries are exhausted.
+        """
+        attempt = 0
+        while True:
+            request_headers = await self._headers()
+            request_headers.update(headers or {})
+            async with rate_limiter:
+                requested_at = time.monotonic()
+                try:
+                    async with self.session.request(method, url, headers=request_headers, **kwargs) as response:
+                        body = await response.read()
+                        status = response.status
+                        response_headers = dict(response.headers)
+                except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                    self._observe_response(time.monotonic() - requested_at, None, None)
+                    # Connection errors, including stale keep-alive connections, are retried with backoff
+                    if attempt >= self._retries:
+                        raise
+                    delay = retry_after_seconds({}, attempt, self._backoff_factor)
+                    log.debug(f"retrying {method} {url} after {e!r} in {delay:.2f} seconds")
+                    attempt += 1
+                    await asyncio.sleep(delay)
+                    continue
+            self._observe_response(
+                time.monotonic() - requested_at, status, http_utils.parse_retry_after(response_headers)
+            )
+
+            if status < 400:
+                return status, json.loads(body) if body else None
+
+            if status == 401 and attempt == 0 and await self._on_unauthorized():
+                attempt += 1
+                continue
+
+            if status in RETRY_STATUS_CODES and attempt < self._retries:
+                delay = retry_after_seconds(response_headers, attempt, self._backoff_factor)
+                log.debug(f"retrying {method} {url} after HTTP {status} in {delay:.2f} seconds")
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+
+            try:
+                error_body = json.loads(body) if body else {}
+            except ValueError:
+                error_body = {}
+            raise AsyncHTTPError(
+                status,
+                error_body.get("code") if isinstance(error_body, dict) else None,
+                error_body.get("message", "") if isinstance(error_body, dict) else "",
+                response_headers,
+            )
+
+    async def close(self) -> None:
+        """
+        Closes the pooled HTTP session
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class AsyncMCASClient(AsyncHTTPClient):
+    """
+    asyncio Microsoft Cloud App Security REST client
+    """
+
+    def __init__(
+            self,
+            subdomain: str,
+            api_token: str,
+            rate_limiter: AsyncRateLimiter,
+            limit: Optional[int] = None,
+            base_url: Optional[str] = None,
+            **kwargs
+    ) -> AsyncMCASClient:
+        super().__init__(**kwargs)
+        self._base_url: str = base_url or f"https://{subdomain}.portal.cloudappsecurity.com"
+        self._limit: Optional[int] = limit
+        self._api_token: str = api_token
+        self._rate_limiter: AsyncRateLimiter = rate_limiter
+
+    async def _headers(self) -> dict:
+        return {"Authorization": f"Token {self._api_token}"}
+
+    async def poll_files(
+            self,
+            mcas_policy_id: str,
+            paginate: int,
+            modified_since: Optional[datetime.datetime] = None
+    ) -> mcas.FilesPage:
+        """
+        Polls the MCAS files endpoint for a page of an MCAS DLP policy's triggers, optionally of files modified since a
+        time. Returns the parsed page.
+        """
+        _, mcas_post_files_resp_json = await self.request(
+            "POST",
+            f"{self._base_url}/api/v1/files/?skip={paginate}",
+            self._rate_limiter,
+            json=mcas.files_request_body(mcas_policy_id, self._limit, modified_since),
+        )
+        policy_triggers = mcas_post_files_resp_json.get("data") or []
+        poll_mcas_file_again = bool(mcas_post_files_resp_json.get("hasNext"))
+
+        return mcas.FilesPage(
+            policy_triggers,
+            poll_mcas_file_again,
+            paginate + len(policy_triggers) if poll_mcas_file_again else paginate
+        )
+
+
+class AsyncBoxClient(AsyncHTTPClient):
+    """
+    asyncio Box Platform REST client. Authenticates with the access token of a boxsdk OAuth2 object, refreshing it
+    off the event loop when it expires.
+    """
+
+    def __init__(
+            self,
+            box_auth: boxsdk.OAuth2,
+            rate_limiters: Dict[str, AsyncRateLimiter],
+            **kwargs
+    ) -> AsyncBoxClient:
+        super().__init__(**kwargs)
+        self._box_auth: boxsdk.OAuth2 = box_auth
+        self._rate_limiters: Dict[str, AsyncRateLimiter] = rate_limiters
+        self._refresh_lock: Optional[asyncio.Lock] = None
+
+    async def _headers(self) -> dict:
+        return {"Authorization": f"Bearer {self._box_auth.access_token}"}
+
+    async def _on_unauthorized(self) -> bool:
+        if self._refresh_lock is None:
+            self._refresh_lock = asyncio.Lock()
+
+        access_token = self._box_auth.access_token
+        async with self._refresh_lock:
+            # Only the first coroutine to see the expired token refreshes it
+            if self._box_auth.access_token == access_token:
+                await asyncio.get_event_loop().run_in_executor(None, self._box_auth.refresh, access_token)
+
+        return True
+
+    def _metadata_url(self, box_file_id: str) -> str:
+        return f"{API.BASE_API_URL}/files/{box_file_id}/metadata/enterprise/{box.CLASSIFICATION_TEMPLATE_KEY}"
+
+    async def lookup_box_user_id(self, email: str) -> Tuple[str, Any]:
+        """
+        Looks up a Box user ID by email from the Box users endpoint. Returns None as the user ID if there is no Box user
+        with the email, or cache.MISSING if the lookup failed.
+        """
+        try:
+            _, users = await self.request(
+                "GET",
+                f"{API.BASE_API_URL}/users",
+                self._rate_limiters[http_utils.BOX_USER_GET],
+                params={"filter_term": email, "limit": 1},
+            )
+        except Exception as e:
+            log.error(f"failed to look up Box user with email {email} with {e}")
+            return email, cache.MISSING
+
+        entries = users.get("entries") or []
+        if not entries:
+            log.info("no Box user found with email %s", email)
+            return email, None
+
+        return email, entries[0]["id"]
+
+    async def apply_classification(self, box_user_id: str, box_file_id: str, box_classification_name: str) -> bool:
+        """
+        Applies a classification to a Box file as a Box user. Mirrors box.apply_classification: creates the
+        classification metadata directly, and on conflict only rewrites it when it differs. Returns False if the file
+        already carried the classification and nothing was written.
+        """
+        as_user_headers = {"As-User": box_user_id}
+        try:
+            await self.request(
+                "POST",
+                self._metadata_url(box_file_id),
+                self._rate_limiters[http_utils.BOX_CLASSIFICATION_PUT],
+                headers=as_user_headers,
+                json={box.CLASSIFICATION_INSTANCE_KEY: box_classification_name},
+            )
+
+            return True
+        except AsyncHTTPError as e:
+            if e.status != 409:
+                raise
+
+        _, classification = await self.request(
+            "GET",
+            self._metadata_url(box_file_id),
+            self._rate_limiters[http_utils.BOX_FILE_GET],
+            headers=as_user_headers,
+        )
+        if (classification or {}).get(box.CLASSIFICATION_INSTANCE_KEY) == box_classification_name:
+            return False
+
+        await self.request(
+            "PUT",
+            self._metadata_url(box_file_id),
+            self._rate_limiters[http_utils.BOX_CLASSIFICATION_PUT],
+            headers=dict(as_user_headers, **{"Content-Type": "application/json-patch+json"}),
+            data=json.dumps([
+                {"op": "add", "path": f"/{box.CLASSIFICATION_INSTANCE_KEY}", "value": box_classification_name}
+            ]),
+        )
+
+        return True
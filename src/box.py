@@ -3,22 +3,45 @@ Box Platform utilities
 """
 
 from __future__ import annotations
+import datetime
 import logging
-from typing import Tuple, Dict
+import threading
+import time
+from typing import Any, Tuple, Dict, Iterable, List, Optional, Set
 
 import boxsdk
+from boxsdk.config import API
+from boxsdk.network.default_network import DefaultNetwork
 
+from src import cache
 from src import http_utils
+from src import metrics
+from src import thread
+from src.sql.models.box_user import BoxUserSQLManager
 
 
 log = logging.getLogger(__name__)
 
 
-def configure_box_auth(config: dict) -> boxsdk.JWTAuth:
+# Box Shield classification metadata template and instance keys
+CLASSIFICATION_TEMPLATE_KEY = "securityClassification-6VMVochwUWo"
+CLASSIFICATION_INSTANCE_KEY = "Box__Security__Classification__Key"
+
+BOX_RATE_LIMITED_ENDPOINTS = [
+    http_utils.BOX_FILE_GET,
+    http_utils.BOX_CLASSIFICATION_PUT,
+    http_utils.BOX_USER_GET,
+]
+
+
+def configure_box_auth(config: dict) -> boxsdk.OAuth2:
     """
     Instantiates a boxsdk.JWTAuth object from a configuration dictionary and authenticates it against
-    Box Platform's authentication service
+    Box Platform's authentication service. A configured access_token, such as a developer token, is used as is instead.
     """
+    if config["box"].get("access_token"):
+        return boxsdk.OAuth2(client_id=None, client_secret=None, access_token=config["box"]["access_token"])
+
     box_auth = boxsdk.JWTAuth.from_settings_dictionary(config["box"]["jwt"])
     box_auth.authenticate_instance()
 
@@ -27,70 +50,352 @@ def configure_box_auth(config: dict) -> boxsdk.JWTAuth:
 
 def configure_box_client(config: dict) -> BoxClient:
     """
-    Configures a Box Platform REST client from a configuration dictionary
+    Configures a Box Platform REST client from a configuration dictionary. A configured api_base_url replaces the Box
+    API URL for every Box client in the process.
     """
+    if config["box"].get("api_base_url"):
+        API.BASE_API_URL = config["box"]["api_base_url"]
     box_auth = configure_box_auth(config)
-    box_client = BoxClient(box_auth)
+    box_client = BoxClient(
+        box_auth,
+        rate_limiters=http_utils.configure_rate_limiters(
+            config, BOX_RATE_LIMITED_ENDPOINTS
+        )
+    )
 
     return box_client
 
 
-def as_user_client(client: boxsdk.Client, user_email: str) -> BoxClient:
+def apply_classification(box_client: BoxClient, box_file_id: str, box_classification_name: str) -> bool:
     """
-    Returns a Box Platform as-user REST client
+    Applies a classification to a Box file by creating its classification metadata directly, without first GETting the
+    file. If the file is already classified, its classification is read and only rewritten when it differs. Every Box
+    call is rate limited. Returns False if the file already carried the classification and nothing was written.
     """
+    classification_metadata = box_client.file(file_id=box_file_id).metadata(
+        "enterprise", CLASSIFICATION_TEMPLATE_KEY
+    )
     try:
-        user = client.users(filter_term=user_email, limit=1).next()
+        with box_client.rate_limiter(http_utils.BOX_CLASSIFICATION_PUT):
+            classification_metadata.create({CLASSIFICATION_INSTANCE_KEY: box_classification_name})
 
-        return client.as_user(user)
-    except StopIteration:
-        log.info(f"no Box user found with email {user_email}")
+        return True
+    except boxsdk.BoxAPIException as e:
+        # A 409 conflict means the file already has a classification metadata instance
+        if e.status != 409:
+            raise
 
+    with box_client.rate_limiter(http_utils.BOX_FILE_GET):
+        current_classification_name = classification_metadata.get().get(CLASSIFICATION_INSTANCE_KEY)
+    if current_classification_name == box_classification_name:
+        return False
 
-def get_cached_box_as_user_client(
-        box_as_user_clients: Dict[str, BoxClient],
+    with box_client.rate_limiter(http_utils.BOX_CLASSIFICATION_PUT):
+        classification_update = classification_metadata.start_update()
+        classification_update.add(f"/{CLASSIFICATION_INSTANCE_KEY}", box_classification_name)
+        classification_metadata.update(classification_update)
+
+    return True
+
+
+def configure_box_user_resolver(
+        config: dict,
         box_client: BoxClient,
-        box_file_owner: str
-) -> Tuple[Dict[str, BoxClient], BoxClient]:
+        box_user_sql_manager: Optional[BoxUserSQLManager] = None
+) -> BoxUserResolver:
+    """
+    Configures a Box file owner email to as-user REST client resolver from a configuration dictionary
     """
-    Checks for a cached Box Platform as-user REST client. Gets and cached a Box Platform as-user REST client if none is
-    found
+    user_cache_config = config["box"].get("user_cache") or {}
+    box_user_resolver = BoxUserResolver(
+        box_client,
+        box_user_sql_manager,
+        max_size=user_cache_config.get("max_size", 10000),
+        ttl=user_cache_config.get("ttl", 86400),
+        negative_ttl=user_cache_config.get("negative_ttl", 3600),
+        lookup_workers=user_cache_config.get("lookup_workers", 10),
+    )
+
+    return box_user_resolver
+
+
+class BoxUserResolver:
     """
-    box_as_user_client = box_as_user_clients.get(box_file_owner)
-    if not box_as_user_client:
-        box_client = BoxClient(box_client._oauth)
-        box_as_user_client = as_user_client(
-            box_client, box_file_owner
+    Resolves Box file owner emails to Box as-user REST clients. Resolved Box user IDs, including emails with no Box
+    user, are held in a TTL and LRU bounded cache in front of the box_user SQL table so resolutions survive restarts.
+    Cache misses are looked up in bulk, and every as-user client shares the admin client's rate limiters.
+    """
+
+    def __init__(
+            self,
+            box_client: BoxClient,
+            box_user_sql_manager: Optional[BoxUserSQLManager] = None,
+            max_size: int = 10000,
+            ttl: float = 86400,
+            negative_ttl: float = 3600,
+            lookup_workers: int = 10,
+    ) -> BoxUserResolver:
+        self._box_client: BoxClient = box_client
+        self._box_user_sql_manager: Optional[BoxUserSQLManager] = box_user_sql_manager
+        self._sql_lock: threading.Lock = threading.Lock()
+        # Emails being looked up, to the event set once their lookup completes
+        self._in_flight_lock: threading.Lock = threading.Lock()
+        self._in_flight: Dict[str, threading.Event] = dict()
+        self._ttl: float = ttl
+        self._negative_ttl: float = negative_ttl
+        self._lookup_workers: int = lookup_workers
+        self._box_user_ids: cache.LRUCache = cache.LRUCache(max_size, ttl)
+        self._as_user_clients: cache.LRUCache = cache.LRUCache(max_size)
+        self._lookup_seconds: metrics.Histogram = metrics.registry.histogram(
+            "box_user_lookup_seconds", "Box user lookup latency, including rate limiter waits"
         )
-        if box_as_user_client:
-            box_as_user_clients[box_file_owner] = box_as_user_client
-            log.info(f"cached Box as-user client for user {box_file_owner}")
-        else:
-            log.info(f"no Box as user client cached for file owner {box_file_owner}")
-    else:
-        log.info(f"got cached Box as-user client for user {box_file_owner}")
+        metrics.registry.gauge("box_user_cache_size", "Cached Box user IDs").set_function(self._box_user_ids.__len__)
+        metrics.registry.gauge(
+            "box_as_user_client_cache_size", "Cached Box as-user clients"
+        ).set_function(self._as_user_clients.__len__)
+
+    def __len__(self) -> int:
+        return len(self._box_user_ids)
+
+    def trim(self, fraction: float) -> int:
+        """
+        Evicts a fraction of the cached Box user IDs and as-user clients, least recently used first. Evicted Box user
+        IDs are resolved from the box_user SQL table again. Returns the number of evicted items.
+        """
+        return self._box_user_ids.trim(fraction) + self._as_user_clients.trim(fraction)
 
-    return box_as_user_clients, box_as_user_client
+    def _cache_box_user_id(self, email: str, box_user_id: Optional[str], ttl: Optional[float] = None) -> None:
+        """
+        Caches a resolved Box user ID. Emails with no Box user are cached for the shorter negative TTL.
+        """
+        if ttl is None:
+            ttl = self._ttl if box_user_id else self._negative_ttl
+        self._box_user_ids.set(email, box_user_id, ttl)
+
+    def _lookup_box_user_id(self, email: str) -> Tuple[str, Any]:
+        """
+        Looks up a Box user ID by email from the Box users endpoint. Returns cache.MISSING as the user ID if the lookup
+        failed.
+        """
+        try:
+            with self._lookup_seconds.time(), self._box_client.rate_limiter(http_utils.BOX_USER_GET):
+                user = self._box_client.users(filter_term=email, limit=1).next()
+        except StopIteration:
+            log.info("no Box user found with email %s", email)
+            return email, None
+        except Exception as e:
+            log.error(f"failed to look up Box user with email {email} with {e}")
+            return email, cache.MISSING
+
+        return email, user.object_id
+
+    def resolve_cached(self, emails: Iterable[str]) -> Tuple[Dict[str, Optional[str]], Set[str]]:
+        """
+        Resolves emails from the in-process cache, then the box_user SQL table in one query. Returns a dictionary of
+        email to Box user ID for the resolved emails, and the set of emails that still need a Box user lookup.
+        """
+        box_user_ids = dict()
+        unresolved_emails = set()
+        for email in set(emails):
+            box_user_id = self._box_user_ids.get(email, cache.MISSING)
+            if box_user_id is cache.MISSING:
+                unresolved_emails.add(email)
+            else:
+                box_user_ids[email] = box_user_id
+
+        if unresolved_emails and self._box_user_sql_manager:
+            now = datetime.datetime.utcnow()
+            with self._sql_lock:
+                box_user_records = self._box_user_sql_manager.get_many(unresolved_emails)
+
+            for email, box_user_record in box_user_records.items():
+                ttl = self._ttl if box_user_record.BOX_USER_ID else self._negative_ttl
+                remaining_ttl = ttl - (now - box_user_record.RESOLVED_AT).total_seconds()
+                if remaining_ttl > 0:
+                    box_user_ids[email] = box_user_record.BOX_USER_ID
+                    self._cache_box_user_id(email, box_user_record.BOX_USER_ID, remaining_ttl)
+                    unresolved_emails.discard(email)
+
+        return box_user_ids, unresolved_emails
+
+    def save_resolved(self, box_user_ids: Dict[str, Optional[str]]) -> None:
+        """
+        Caches and persists Box user IDs looked up from the Box users endpoint
+        """
+        for email, box_user_id in box_user_ids.items():
+            self._cache_box_user_id(email, box_user_id)
+
+        if box_user_ids and self._box_user_sql_manager:
+            with self._sql_lock:
+                self._box_user_sql_manager.save_many(box_user_ids, datetime.datetime.utcnow())
+
+    def resolve(self, emails: Iterable[str]) -> Dict[str, Optional[str]]:
+        """
+        Returns a dictionary of email to Box user ID, or None for emails with no Box user. Emails are resolved from the
+        in-process cache, then the box_user SQL table in one query, then concurrent Box user lookups. Emails another
+        thread is already looking up are waited on rather than looked up again. Emails whose lookup failed are omitted.
+        """
+        box_user_ids, unresolved_emails = self.resolve_cached(emails)
+        if not unresolved_emails:
+            return box_user_ids
+
+        lookups_done = threading.Event()
+        with self._in_flight_lock:
+            awaited_lookups = {email: self._in_flight[email] for email in unresolved_emails if email in self._in_flight}
+            claimed_emails = unresolved_emails.difference(awaited_lookups)
+            for email in claimed_emails:
+                self._in_flight[email] = lookups_done
+
+        try:
+            if claimed_emails:
+                looked_up_box_user_ids = {
+                    email: box_user_id
+                    for email, box_user_id in thread.run_in_thread_pool(
+                        self._lookup_box_user_id,
+                        [[email] for email in claimed_emails],
+                        max_workers=min(self._lookup_workers, len(claimed_emails))
+                    )
+                    if box_user_id is not cache.MISSING
+                }
+                self.save_resolved(looked_up_box_user_ids)
+                box_user_ids.update(looked_up_box_user_ids)
+                log.info(f"resolved {len(looked_up_box_user_ids)} of {len(claimed_emails)} Box users from the Box API")
+        finally:
+            with self._in_flight_lock:
+                for email in claimed_emails:
+                    del self._in_flight[email]
+            lookups_done.set()
+
+        for email, lookup_done in awaited_lookups.items():
+            lookup_done.wait()
+            box_user_id = self._box_user_ids.get(email, cache.MISSING)
+            if box_user_id is not cache.MISSING:
+                box_user_ids[email] = box_user_id
+
+        return box_user_ids
+
+    def as_user_client(self, email: str) -> Optional[BoxClient]:
+        """
+        Returns a Box Platform as-user REST client for a Box file owner email, or None if there is no Box user with the
+        email. Raises LookupError if the Box user lookup failed.
+        """
+        box_user_id = self.resolve([email]).get(email, cache.MISSING)
+        if box_user_id is cache.MISSING:
+            raise LookupError(f"failed to resolve Box user with email {email}")
+        if box_user_id is None:
+            return None
+
+        box_as_user_client = self._as_user_clients.get(box_user_id)
+        if box_as_user_client is None:
+            box_as_user_client = self._box_client.as_user(self._box_client.user(box_user_id))
+            self._as_user_clients.set(box_user_id, box_as_user_client)
+
+        return box_as_user_client
+
+
+class ObservedNetwork(DefaultNetwork):
+    """
+    boxsdk network layer that calls response observers with the latency, status and Retry-After delay of every Box API
+    call, including the calls boxsdk retries
+    """
+
+    def __init__(self) -> ObservedNetwork:
+        super().__init__()
+        self.observers: List[http_utils.ResponseObserver] = list()
+
+    def _observe(self, latency: float, status: Optional[int], retry_after: Optional[float]) -> None:
+        """
+        Calls the response observers, logging rather than raising their errors
+        """
+        for observer in self.observers:
+            try:
+                observer(latency, status, retry_after)
+            except Exception as e:
+                log.error(f"failed to observe a Box API response with {e!r}")
+
+    def request(self, method, url, access_token, **kwargs):
+        """
+        DefaultNetwork.request override that times the call and reports its response, or None on a connection error
+        """
+        requested_at = time.monotonic()
+        try:
+            network_response = super().request(method, url, access_token, **kwargs)
+        except Exception:
+            self._observe(time.monotonic() - requested_at, None, None)
+            raise
+
+        self._observe(
+            time.monotonic() - requested_at,
+            network_response.status_code,
+            http_utils.parse_retry_after(network_response.headers),
+        )
+
+        return network_response
 
 
 class BoxClient(boxsdk.Client):
     """
-    boxsdk.Client subclass implementing rate limiting
+    boxsdk.Client subclass implementing rate limiting. Rate limiters and the network layer are shared with cloned and
+    as-user clients so every client draws from the same per-endpoint budgets and reports to the same response
+    observers.
     """
 
-    def __init__(self, oauth, session=None, rate_limit=12) -> BoxClient:
+    def __init__(
+            self,
+            oauth,
+            session=None,
+            rate_limiters: Optional[Dict[str, http_utils.RateLimiter]] = None,
+            network: Optional[ObservedNetwork] = None
+    ) -> BoxClient:
+        if session is None:
+            network = network or ObservedNetwork()
+            session = self.authorized_session_class(
+                oauth, **self.unauthorized_session_class(network_layer=network).get_constructor_kwargs()
+            )
         super().__init__(oauth, session)
-        self._rate_limiter = http_utils.RateLimiter(rate_limit)
+        if rate_limiters is None:
+            rate_limiters = http_utils.configure_rate_limiters(
+                dict(), BOX_RATE_LIMITED_ENDPOINTS
+            )
+        self._rate_limiters = rate_limiters
+        self._network: Optional[ObservedNetwork] = network
+
+    def clone(self, session=None) -> BoxClient:
+        """
+        boxsdk.Client.clone override that shares the rate limiters and network layer with the cloned client
+        """
+        return self.__class__(
+            oauth=self._oauth,
+            session=(session or self._session),
+            rate_limiters=self._rate_limiters,
+            network=self._network
+        )
+
+    def add_response_observer(self, observer: http_utils.ResponseObserver) -> None:
+        """
+        Adds an observer called with the latency, status and Retry-After delay of every Box API call made through this
+        client's network layer
+        """
+        if self._network is None:
+            raise ValueError("Box client was created with a session and has no observed network layer")
+
+        self._network.observers.append(observer)
+
+    def rate_limiter(self, endpoint_alias: str) -> http_utils.RateLimiter:
+        """
+        Returns the rate limiter for a Box endpoint alias
+        """
+        return self._rate_limiters[endpoint_alias]
 
     def __enter__(self) -> None:
         """
-        Context manager enter that blocks until a rate limited call can be made
+        Context manager enter that blocks until a rate limited classification call can be made
         """
-        with self._rate_limiter:
+        with self.rate_limiter(http_utils.BOX_CLASSIFICATION_PUT):
             return
 
     def __exit__(self, exc_type, exc_val, exc_tb) -> None:
         """
         Context manager exit
         """
-        pass
\ No newline at end of file
+        pass
@@ -0,0 +1,109 @@
+"""
+In-process caching utilities
+"""
+
+from __future__ import annotations
+from collections import OrderedDict
+import threading
+import time
+from typing import Any, Hashable, Optional
+
+
+# Default returned by LRUCache.get for keys that are not cached, distinguishing a miss from a cached None
+MISSING = object()
+
+
+class LRUCache:
+    """
+    Thread safe bounded least recently used cache. The least recently used item is evicted when an insert would grow
+    the cache past max_size. Items optionally expire ttl seconds after they are cached.
+    """
+
+    def __init__(self, max_size: int = 100000, ttl: Optional[float] = None) -> LRUCache:
+        if max_size <= 0:
+            raise ValueError("max_size must be greater than 0")
+
+        self._max_size: int = max_size
+        self._ttl: Optional[float] = ttl
+        self._items: OrderedDict = OrderedDict()
+        self._lock: threading.Lock = threading.Lock()
+
+    @property
+    def max_size(self) -> int:
+        """
+        Maximum number of cached items
+        """
+        return self._max_size
+
+    def _get_item(self, key: Hashable) -> Any:
+        """
+        Returns a cached value and marks it as most recently used, evicting it if it has expired. Must be called with
+        the lock held.
+        """
+        try:
+            value, expires_at = self._items[key]
+        except KeyError:
+            return MISSING
+
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._items[key]
+            return MISSING
+
+        self._items.move_to_end(key)
+        return value
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Returns a cached value and marks it as most recently used, or the default if the key is not cached
+        """
+        with self._lock:
+            value = self._get_item(key)
+
+        return default if value is MISSING else value
+
+    def set(self, key: Hashable, value: Any = True, ttl: Optional[float] = None) -> None:
+        """
+        Caches a value as the most recently used item, evicting the least recently used item if the cache is full. The
+        ttl overrides the cache's default time to live for this item.
+        """
+        ttl = ttl if ttl is not None else self._ttl
+        with self._lock:
+            self._items[key] = (value, time.monotonic() + ttl if ttl is not None else None)
+            self._items.move_to_end(key)
+            while len(self._items) > self._max_size:
+                self._items.popitem(last=False)
+
+    def discard(self, key: Hashable) -> None:
+        """
+        Removes a key from the cache if it is cached
+        """
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self) -> None:
+        """
+        Removes every item from the cache
+        """
+        with self._lock:
+            self._items.clear()
+
+    def trim(self, fraction: float) -> int:
+        """
+        Evicts a fraction of the cached items, least recently used first. Returns the number of evicted items.
+        """
+        with self._lock:
+            evict_count = int(len(self._items) * min(1.0, max(0.0, fraction)))
+            for _ in range(evict_count):
+                self._items.popitem(last=False)
+
+        return evict_count
+
+    def __contains__(self, key: Hashable) -> bool:
+        """
+        Checks if a key is cached and marks it as most recently used
+        """
+        with self._lock:
+            return self._get_item(key) is not MISSING
+
+    def __len__(self) -> int:
+        return len(self._items)
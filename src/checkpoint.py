@@ -0,0 +1,258 @@
+"""
+MCAS DLP policy polling checkpoint stores
+"""
+
+from __future__ import annotations
+from abc import ABCMeta, abstractmethod
+import datetime
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, Iterable, NamedTuple, Optional
+
+from src.sql import sql
+from src.sql.models.mcas_policy_checkpoint import (
+    MCASPolicyCheckpoint,
+    MCASPolicyCheckpointSQLManager
+)
+
+
+log = logging.getLogger(__name__)
+
+
+class Checkpoint(NamedTuple):
+    """
+    An MCAS DLP policy's files endpoint pagination cursor, and when the policy's triggers were last fully processed.
+    With watermark polling, also the latest file modification processed and when a full reconciliation scan of the
+    policy's triggers last completed.
+    """
+    paginate: int = 0
+    processed_all_at: datetime.datetime = datetime.datetime.min
+    watermark: datetime.datetime = datetime.datetime.min
+    reconciled_at: datetime.datetime = datetime.datetime.min
+
+
+def configure_checkpoint_store(env: str, config: dict) -> CheckpointStore:
+    """
+    Configures a checkpoint store from a configuration dictionary. Checkpoints are stored in a SQL table by default,
+    or in a local JSON file when the "checkpoint" section's backend is "file".
+    """
+    checkpoint_config = config.get("checkpoint") or {}
+    flush_interval = checkpoint_config.get("flush_interval", 5)
+    if checkpoint_config.get("backend", "sql") == "file":
+        checkpoint_store = FileCheckpointStore(
+            checkpoint_config.get("path") or os.path.join(
+                os.path.dirname(__file__),
+                "..",
+                "configuration",
+                f"{env}.checkpoint.json",
+            ),
+            flush_interval
+        )
+    else:
+        checkpoint_store = SQLCheckpointStore(sql.connection, flush_interval)
+
+    # Seed checkpoints for policies that still carry the legacy YAML pagination values
+    for box_mcas_classification in config["box"]["mcas_classifications"]:
+        mcas_policy_id = box_mcas_classification["mcas_id"]
+        if mcas_policy_id not in checkpoint_store and "paginate" in box_mcas_classification:
+            checkpoint_store.set(
+                mcas_policy_id,
+                paginate=box_mcas_classification["paginate"],
+                processed_all_at=box_mcas_classification.get("processed_all_at") or datetime.datetime.min
+            )
+            log.info(f"seeded checkpoint for MCAS DLP ID {mcas_policy_id} from configuration")
+    checkpoint_store.flush()
+
+    return checkpoint_store
+
+
+class CheckpointStore(metaclass=ABCMeta):
+    """
+    Thread safe MCAS DLP policy checkpoint store abstract class. Checkpoints are read once at startup and held in
+    memory. Writes are coalesced and flushed together in one transaction at most every flush_interval seconds.
+    """
+
+    def __init__(self, flush_interval: float = 5) -> CheckpointStore:
+        self._flush_interval: float = flush_interval
+        self._lock: threading.RLock = threading.RLock()
+        self._checkpoints: Dict[str, Checkpoint] = self._read()
+        self._dirty: set = set()
+        self._flushed_at: float = time.monotonic()
+        log.debug(f"loaded {len(self._checkpoints)} MCAS DLP policy checkpoints")
+
+    @abstractmethod
+    def _read(self) -> Dict[str, Checkpoint]:
+        """
+        Reads every stored checkpoint
+        """
+        pass
+
+    @abstractmethod
+    def _write(self, checkpoints: Dict[str, Checkpoint]) -> None:
+        """
+        Durably writes a dictionary of checkpoints in a single transaction
+        """
+        pass
+
+    def get(self, mcas_policy_id: str) -> Checkpoint:
+        """
+        Returns an MCAS DLP policy's checkpoint
+        """
+        with self._lock:
+            return self._checkpoints.get(mcas_policy_id, Checkpoint())
+
+    def set(
+            self,
+            mcas_policy_id: str,
+            paginate: Optional[int] = None,
+            processed_all_at: Optional[datetime.datetime] = None,
+            flush: bool = False,
+            watermark: Optional[datetime.datetime] = None,
+            reconciled_at: Optional[datetime.datetime] = None
+    ) -> Checkpoint:
+        """
+        Updates an MCAS DLP policy's checkpoint. The write is flushed with other pending writes once the flush interval
+        has elapsed, or immediately if flush is True.
+        """
+        with self._lock:
+            checkpoint = self.get(mcas_policy_id)
+            if paginate is not None:
+                checkpoint = checkpoint._replace(paginate=paginate)
+            if processed_all_at is not None:
+                checkpoint = checkpoint._replace(processed_all_at=processed_all_at)
+            if watermark is not None:
+                checkpoint = checkpoint._replace(watermark=watermark)
+            if reconciled_at is not None:
+                checkpoint = checkpoint._replace(reconciled_at=reconciled_at)
+
+            self._checkpoints[mcas_policy_id] = checkpoint
+            self._dirty.add(mcas_policy_id)
+            if flush or time.monotonic() - self._flushed_at >= self._flush_interval:
+                self.flush()
+
+        return checkpoint
+
+    def flush(self) -> None:
+        """
+        Writes every pending checkpoint
+        """
+        with self._lock:
+            if self._dirty:
+                self._write({mcas_policy_id: self._checkpoints[mcas_policy_id] for mcas_policy_id in self._dirty})
+                log.debug(f"flushed {len(self._dirty)} MCAS DLP policy checkpoints")
+                self._dirty.clear()
+
+            self._flushed_at = time.monotonic()
+
+    def reload(self, mcas_policy_ids: Iterable[str]) -> None:
+        """
+        Re-reads the stored checkpoints of a set of MCAS DLP policies, such as shards just claimed from another sync
+        worker. Checkpoints with pending writes keep their in-memory value.
+        """
+        with self._lock:
+            stored_checkpoints = self._read()
+            for mcas_policy_id in mcas_policy_ids:
+                if mcas_policy_id in stored_checkpoints and mcas_policy_id not in self._dirty:
+                    self._checkpoints[mcas_policy_id] = stored_checkpoints[mcas_policy_id]
+
+    def __contains__(self, mcas_policy_id: str) -> bool:
+        with self._lock:
+            return mcas_policy_id in self._checkpoints
+
+
+class SQLCheckpointStore(CheckpointStore):
+    """
+    Checkpoint store backed by the mcas_policy_checkpoint SQL table
+    """
+
+    def __init__(self, sql_connection, flush_interval: float = 5) -> SQLCheckpointStore:
+        MCASPolicyCheckpoint.__table__.create(sql_connection, checkfirst=True)
+        self._sql_manager = MCASPolicyCheckpointSQLManager(sql_connection)
+        super().__init__(flush_interval)
+
+    def _read(self) -> Dict[str, Checkpoint]:
+        # Each read is a unit of work that starts with no records loaded, so a re-read sees checkpoints written by other
+        # sync workers
+        with self._sql_manager.unit_of_work():
+            return {
+                record.MCAS_POLICY_ID: Checkpoint(
+                    record.PAGINATE or 0,
+                    record.PROCESSED_ALL_AT or datetime.datetime.min,
+                    record.WATERMARK or datetime.datetime.min,
+                    record.RECONCILED_AT or datetime.datetime.min
+                )
+                for record in self._sql_manager.get_all()
+            }
+
+    def _write(self, checkpoints: Dict[str, Checkpoint]) -> None:
+        for mcas_policy_id, checkpoint in checkpoints.items():
+            self._sql_manager.session.merge(
+                self._sql_manager.model(
+                    MCAS_POLICY_ID=mcas_policy_id,
+                    PAGINATE=checkpoint.paginate,
+                    # datetime.min is outside the SQL Server DATETIME range, so never processed is stored as NULL
+                    PROCESSED_ALL_AT=(
+                        None if checkpoint.processed_all_at == datetime.datetime.min else checkpoint.processed_all_at
+                    ),
+                    WATERMARK=None if checkpoint.watermark == datetime.datetime.min else checkpoint.watermark,
+                    RECONCILED_AT=(
+                        None if checkpoint.reconciled_at == datetime.datetime.min else checkpoint.reconciled_at
+                    )
+                )
+            )
+        self._sql_manager.commit()
+
+
+class FileCheckpointStore(CheckpointStore):
+    """
+    Checkpoint store backed by a local JSON file. Writes go to a temporary file that atomically replaces the checkpoint
+    file, so a crash mid-write never leaves a partial file.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 5) -> FileCheckpointStore:
+        self._path: str = os.path.abspath(path)
+        super().__init__(flush_interval)
+
+    def _read(self) -> Dict[str, Checkpoint]:
+        if not os.path.exists(self._path):
+            return dict()
+
+        with open(self._path, "r") as fh:
+            return {
+                mcas_policy_id: Checkpoint(
+                    checkpoint["paginate"],
+                    datetime.datetime.fromisoformat(checkpoint["processed_all_at"]),
+                    datetime.datetime.fromisoformat(checkpoint.get("watermark", datetime.datetime.min.isoformat())),
+                    datetime.datetime.fromisoformat(checkpoint.get("reconciled_at", datetime.datetime.min.isoformat()))
+                )
+                for mcas_policy_id, checkpoint in json.load(fh).items()
+            }
+
+    def _write(self, checkpoints: Dict[str, Checkpoint]) -> None:
+        # The file holds every checkpoint, so write the full in-memory state rather than only the pending ones
+        file_descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(self._path), suffix=".tmp")
+        try:
+            with os.fdopen(file_descriptor, "w") as fh:
+                json.dump(
+                    {
+                        mcas_policy_id: {
+                            "paginate": checkpoint.paginate,
+                            "processed_all_at": checkpoint.processed_all_at.isoformat(),
+                            "watermark": checkpoint.watermark.isoformat(),
+                            "reconciled_at": checkpoint.reconciled_at.isoformat()
+                        }
+                        for mcas_policy_id, checkpoint in self._checkpoints.items()
+                    },
+                    fh
+                )
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.replace(temp_path, self._path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
@@ -2,28 +2,104 @@
 Click command and utilities for a Microsoft Cloud App Security DLP file policy trigger to Box file classification sync
 """
 
+from __future__ import annotations
 import logging
-import json
-from typing import Dict, List
+import functools
+import collections
+import concurrent.futures
+import queue
+import threading
+import time
+from typing import Callable, Hashable, Iterable, Iterator, List, Optional, Tuple, NamedTuple
 import datetime
 
 import click
 
 from src import config as config_utils
+from src import adaptive
+from src import checkpoint
+from src import lease
 from src import box
+from src import cache
 from src import mcas
+from src import memory
+from src import metrics
 from src import thread
+from src import pipeline
+from src import scheduler
+from src import profiling
+from src import traffic
 from src.sql import sql
 from src.sql.models.box_classification import (
     BoxClassification,
-    BoxClassificationSQLManager
+    BoxClassificationSQLManager,
+    RETRY_SERVER_ERROR,
+    retry_failure_type,
+    schedule_retry
 )
-from src.http_utils import RateLimiter
+from src.sql.models.box_user import BoxUser, BoxUserSQLManager
 
 
 log = logging.getLogger(__name__)
 
 
+triggers_seen = metrics.registry.counter("mcas_triggers_seen_total", "MCAS DLP policy triggers polled")
+triggers_skipped = metrics.registry.counter(
+    "mcas_triggers_skipped_total", "MCAS DLP policy triggers skipped as they already have a box_classification record"
+)
+classifications_applied = metrics.registry.counter(
+    "box_classifications_applied_total", "Box classifications applied, or found already applied"
+)
+classifications_forbidden = metrics.registry.counter(
+    "box_classifications_forbidden_total", "Box classification applys forbidden for the file owner"
+)
+classifications_no_user = metrics.registry.counter(
+    "box_classifications_no_user_total", "Box classification applys skipped as the file owner has no Box user"
+)
+classifications_failed = metrics.registry.counter(
+    "box_classifications_failed_total", "Box classification applys that failed and will be retried"
+)
+apply_seconds = metrics.registry.histogram(
+    "box_classification_apply_seconds", "Box classification apply latency, including rate limiter waits"
+)
+
+
+# Scheduler task names. Shard polls are scheduled as (POLL_TASK, shard ID).
+POLL_TASK = "poll"
+RETRY_TASK = "retry"
+REBALANCE_TASK = "rebalance"
+
+POLLING_OFFSET = "offset"
+POLLING_WATERMARK = "watermark"
+
+
+class PollingConfig(NamedTuple):
+    """
+    How MCAS DLP policy triggers are polled. By skip offset, or by file modification watermark with a periodic full
+    reconciliation scan by offset.
+    """
+    mode: str = POLLING_OFFSET
+    reconcile_interval: datetime.timedelta = datetime.timedelta(days=1)
+    watermark_overlap: datetime.timedelta = datetime.timedelta(minutes=5)
+
+
+def configure_polling(config: dict) -> PollingConfig:
+    """
+    Configures MCAS DLP policy trigger polling from the "polling" settings of a configuration dictionary's "sync"
+    section
+    """
+    polling_config = config.get("sync", {}).get("polling") or {}
+    polling_mode = polling_config.get("mode", POLLING_OFFSET)
+    if polling_mode not in (POLLING_OFFSET, POLLING_WATERMARK):
+        raise ValueError(f"unknown MCAS polling mode {polling_mode}")
+
+    return PollingConfig(
+        polling_mode,
+        datetime.timedelta(seconds=polling_config.get("reconcile_interval", 24 * 60 * 60)),
+        datetime.timedelta(seconds=polling_config.get("watermark_overlap", 5 * 60)),
+    )
+
+
 def box_classification_apply(
         box_client: box.BoxClient,
         box_file_id: str,
@@ -37,197 +113,986 @@ def box_classification_apply(
     # Construct a SQL classification_assign object. Constructing it does not insert a record it into the database.
     # All classification_assign records are inserted in bulk at the end of the script.
     try:
-
-        # Make the Box file classification policy set API call
-        box_file = box_client.file(file_id=box_file_id).get()
-
-        # Call the context manager rate limiter
-        with box_client:
-            classification = box_file.set_classification(box_classification_name)
-            log.info(f"applied Box classification {classification} to file {box_file}")
+        # Make the rate limited Box file classification apply API call
+        with apply_seconds.time():
+            applied = box.apply_classification(box_client, box_file_id, box_classification_name)
+        if applied:
+            log.info("applied Box classification %s to file with ID %s", box_classification_name, box_file_id)
+        else:
+            log.info("Box file with ID %s already has classification %s", box_file_id, box_classification_name)
 
         # Update the classification_assign SQL record status
         box_classification_record.APPLIED = True
+        classifications_applied.inc()
     except Exception as e:
         if hasattr(e, "code") and e.status == 403:
             box_classification_record.APPLY_ERROR_FORBIDDEN = True
+            classifications_forbidden.inc()
         else:
             box_classification_record.APPLY_ERROR_EXCEPTION_MESSAGE = str(e)
+            schedule_retry(box_classification_record, retry_failure_type(e))
+            classifications_failed.inc()
+
+        log.info(
+            "failed to apply classification %s to file with ID %s with %s", box_classification_name, box_file_id, e
+        )
+
+
+class ApplyBatch:
+    """
+    Commit progress of a batch of box_classification records submitted to a BoxClassificationApplyStream
+    """
+
+    def __init__(self, record_count: int, on_committed: Optional[Callable] = None) -> ApplyBatch:
+        self.record_count: int = record_count
+        self.committed_count: int = 0
+        self.on_committed: Optional[Callable] = on_committed
+
+
+class BoxClassificationApplyStream:
+    """
+    Streams Box classification apply tasks through a long-lived worker pool. box_classification records are committed
+    in small rolling groups as their tasks complete, so a slow Box call only holds back its own record. A submitted
+    batch's on_committed callback runs once every record in the batch is committed. Tasks are submitted to the worker
+    pool flow of the stream's MCAS DLP policy shard, so concurrent policies share the pool fairly.
+    """
+
+    def __init__(
+            self,
+            worker_pool: thread.WorkerPool,
+            box_classification_sql_manager: BoxClassificationSQLManager,
+            flush_size: int = 50,
+            flush_interval: float = 1,
+            flow: Hashable = None
+    ) -> BoxClassificationApplyStream:
+        self._worker_pool: thread.WorkerPool = worker_pool
+        self._flow: Hashable = flow
+        self._sql_manager: BoxClassificationSQLManager = box_classification_sql_manager
+        self._flush_size: int = flush_size
+        self._flush_interval: float = flush_interval
+        # Each stream reads its own results queue, so results of an abandoned stream never leak into another
+        self._results: queue.Queue = queue.Queue()
+        self._completed: List[Tuple[ApplyBatch, BoxClassification]] = list()
+        self._outstanding: int = 0
+        self._flushed_at: float = time.monotonic()
+
+    @property
+    def outstanding(self) -> int:
+        """
+        Number of submitted Box classification apply tasks that have not completed
+        """
+        return self._outstanding
+
+    def submit(
+            self,
+            box_classification_tasks: list,
+            box_classification_records: List[BoxClassification],
+            on_committed: Optional[Callable] = None
+    ) -> None:
+        """
+        Submits a batch of Box classification apply tasks to the worker pool. Records without a task, such as records
+        with no Box user, are committed with the next group.
+        """
+        apply_batch = ApplyBatch(len(box_classification_records), on_committed)
+        if not box_classification_records:
+            if on_committed:
+                on_committed()
+            return
+
+        task_record_ids = {id(box_classification_task[3]) for box_classification_task in box_classification_tasks}
+        for box_classification_record in box_classification_records:
+            if id(box_classification_record) not in task_record_ids:
+                self._completed.append((apply_batch, box_classification_record))
+
+        for box_classification_task in box_classification_tasks:
+            self._outstanding += 1
+            # Blocks while the worker pool's submission queue is full
+            self._worker_pool.submit(
+                box_classification_apply,
+                *box_classification_task,
+                tag=(apply_batch, box_classification_task[3]),
+                results=self._results,
+                flow=self._flow
+            )
+            self.poll()
+
+    def poll(self, block: bool = False) -> None:
+        """
+        Collects completed Box classification apply tasks, and commits their records once a group of flush_size records
+        has completed or flush_interval seconds have passed. Waits for at most flush_interval seconds for a task to
+        complete if block is True.
+        """
+        timeout = self._flush_interval if block and self._outstanding else None
+        while self._outstanding:
+            try:
+                task_result = self._results.get(block=timeout is not None, timeout=timeout)
+            except queue.Empty:
+                break
 
-        log.info(f"failed to apply classification {box_classification_name} to file with ID {box_file_id} with {e}")
+            timeout = None
+            self._outstanding -= 1
+            apply_batch, box_classification_record = task_result.tag
+            if task_result.error:
+                box_classification_record.APPLY_ERROR_EXCEPTION_MESSAGE = str(task_result.error)
+                schedule_retry(box_classification_record, retry_failure_type(task_result.error))
+                classifications_failed.inc()
+            self._completed.append((apply_batch, box_classification_record))
 
+        if len(self._completed) >= self._flush_size or (
+                self._completed and time.monotonic() - self._flushed_at >= self._flush_interval
+        ):
+            self.flush()
 
-def process_box_classification_apply_batch(
+    def flush(self) -> None:
+        """
+        Commits the records of completed Box classification apply tasks, and runs the callback of every batch whose
+        records are now all committed
+        """
+        completed, self._completed = self._completed, list()
+        self._flushed_at = time.monotonic()
+        if not completed:
+            return
+
+        # Update the the box_classification SQL records' sync status
+        self._sql_manager.bulk_update([box_classification_record for _, box_classification_record in completed])
+        for apply_batch, _ in completed:
+            apply_batch.committed_count += 1
+            if apply_batch.committed_count == apply_batch.record_count and apply_batch.on_committed:
+                apply_batch.on_committed()
+
+    def join(self) -> None:
+        """
+        Waits for every submitted Box classification apply task to complete, and commits the remaining records
+        """
+        while self._outstanding:
+            self.poll(block=True)
+        self.flush()
+
+    def drain(self) -> None:
+        """
+        Waits for every submitted Box classification apply task to complete, discarding the records left uncommitted.
+        Used when the stream cannot commit, so none of its tasks is left calling Box.
+        """
+        while self._outstanding:
+            self._results.get()
+            self._outstanding -= 1
+        self._completed = list()
+
+
+def configure_box_classification_apply_stream(
+        config: dict,
+        worker_pool: thread.WorkerPool,
         box_classification_sql_manager: BoxClassificationSQLManager,
-        box_classification_tasks: list,
-        box_classification_records: List[BoxClassification]
+        flow: Hashable = None
+) -> BoxClassificationApplyStream:
+    """
+    Configures a BoxClassificationApplyStream from the "sync" section of a configuration dictionary
+    """
+    sync_config = config.get("sync", {})
+
+    return BoxClassificationApplyStream(
+        worker_pool,
+        box_classification_sql_manager,
+        sync_config.get("flush_size", 50),
+        sync_config.get("flush_interval", 1),
+        flow
+    )
+
+
+def configure_policy_concurrency(config: dict) -> int:
+    """
+    Returns the number of MCAS DLP policy polls and retries run at once, from the "policies" settings of a
+    configuration dictionary's "sync" section
+    """
+    return max(1, ((config.get("sync") or {}).get("policies") or {}).get("concurrency", 4))
+
+
+def configure_policy_flow(
+        config: dict,
+        worker_pool: thread.WorkerPool,
+        box_mcas_classification: dict,
+        flow: Hashable
 ) -> None:
     """
-    Runs a list of Box file classification apply tasks in a thread pool. Updates box_classification records with the
-    classification apply status.
+    Configures the worker pool flow of an MCAS DLP policy's Box classification apply tasks from the "policies" settings
+    of a configuration dictionary's "sync" section. A policy's own weight and max_concurrency override the defaults.
+    """
+    policies_config = (config.get("sync") or {}).get("policies") or {}
+    worker_pool.configure_flow(
+        flow,
+        box_mcas_classification.get("weight", policies_config.get("weight", 1)),
+        box_mcas_classification.get("max_concurrency", policies_config.get("max_concurrency")),
+    )
+
+
+def box_classification_key(
+        file_policy_trigger: dict,
+        box_classification_name: str,
+        mcas_policy_id: str
+) -> Tuple[str, str, str]:
+    """
+    Returns the (BOX_FILE_ID, BOX_CLASSIFICATION_NAME, MCAS_POLICY_ID) box_classification key of an MCAS DLP policy
+    trigger
+    """
+    return file_policy_trigger["boxItem"]["id"], box_classification_name, mcas_policy_id
+
+
+def dedupe_policy_triggers(
+        box_classification_sql_manager: BoxClassificationSQLManager,
+        seen_box_classification_keys: cache.LRUCache,
+        file_policy_triggers: List[dict],
+        box_classification_name: str,
+        mcas_policy_id: str
+) -> List[dict]:
+    """
+    Filters a page of MCAS DLP policy triggers down to triggers without a box_classification record. Keys already
+    seen by this process are skipped without a database round trip, and the rest are checked with a single bulk query.
     """
-    # Run the Box classification apply tasks in a thread pool
-    thread.run_in_thread_pool(
-        box_classification_apply,
-        box_classification_tasks
+    unseen_triggers = dict()
+    for file_policy_trigger in file_policy_triggers:
+        try:
+            key = box_classification_key(file_policy_trigger, box_classification_name, mcas_policy_id)
+        except (KeyError, TypeError) as e:
+            log.error(f"failed to process DLP policy trigger with {e}")
+            continue
+
+        if key in unseen_triggers or key in seen_box_classification_keys:
+            log.info("skipping DLP policy trigger for Box file ID %s because record already exists", key[0])
+        else:
+            unseen_triggers[key] = file_policy_trigger
+
+    if not unseen_triggers:
+        triggers_skipped.inc(len(file_policy_triggers))
+        return list()
+
+    existing_keys = box_classification_sql_manager.existing_keys(unseen_triggers.keys())
+    triggers_skipped.inc(len(file_policy_triggers) - len(unseen_triggers) + len(existing_keys))
+    for key in existing_keys:
+        seen_box_classification_keys.set(key)
+        log.info("skipping DLP policy trigger for Box file ID %s because record already exists", key[0])
+
+    return [
+        file_policy_trigger
+        for key, file_policy_trigger in unseen_triggers.items()
+        if key not in existing_keys
+    ]
+
+
+def build_retry_box_classification_tasks(
+        box_user_resolver: box.BoxUserResolver,
+        box_classification_records: List[BoxClassification]
+) -> list:
+    """
+    Builds Box classification apply tasks for a batch of failed box_classification records. The batch's Box file owners
+    are resolved in bulk.
+    """
+    box_user_resolver.resolve(
+        box_classification_record.BOX_FILE_OWNER for box_classification_record in box_classification_records
     )
-    # Update the the box_classification_apply SQL record's sync status
-    box_classification_sql_manager.bulk_update(box_classification_records)
+    box_classification_tasks = list()
+    for box_classification_record in box_classification_records:
+        box_classification_record.APPLY_ATTEMPTS += 1
+        try:
+            box_as_user_client = box_user_resolver.as_user_client(box_classification_record.BOX_FILE_OWNER)
+        except LookupError as e:
+            schedule_retry(box_classification_record, RETRY_SERVER_ERROR)
+            log.error(f"failed to retry Box classification apply for record {box_classification_record} with {e}")
+            continue
+
+        if not box_as_user_client:
+            box_classification_record.APPLY_ERROR_NO_BOX_USER = True
+            classifications_no_user.inc()
+        else:
+            box_classification_tasks.append(
+                [
+                    box_as_user_client,
+                    box_classification_record.BOX_FILE_ID,
+                    box_classification_record.BOX_CLASSIFICATION_NAME,
+                    box_classification_record
+                ]
+            )
+
+    return box_classification_tasks
 
 
 def retry_failed_box_classification_applys(
+        config: dict,
+        worker_pool: thread.WorkerPool,
         box_classification_sql_manager: BoxClassificationSQLManager,
-        box_client: box.BoxClient,
-        box_as_user_clients: Dict[str, box.BoxClient]
+        box_user_resolver: box.BoxUserResolver,
+        shards: Optional[List[lease.Shard]] = None
 ) -> None:
     """
-    Gets failed box_classification apply records from a SQL database, and re attempts to apply a Box file classifications
+    Gets box_classification records with failed applys that are due a retry from a SQL database in chunks, and re
+    attempts to apply their Box file classifications. Only records belonging to one of a list of shards are retried if
+    shards is set.
+    """
+    if shards is not None and not shards:
+        return
+
+    apply_stream = configure_box_classification_apply_stream(
+        config, worker_pool, box_classification_sql_manager, RETRY_TASK
+    )
+    # Records come back detached, so worker threads never lazy load through the shared session
+    for box_classification_records in box_classification_sql_manager.due_retry_records(
+            mcas_policy_ids={shard.mcas_policy_id for shard in shards} if shards is not None else None
+    ):
+        if shards is not None:
+            box_classification_records = [
+                box_classification_record
+                for box_classification_record in box_classification_records
+                if any(
+                    shard.owns(box_classification_record.MCAS_POLICY_ID, box_classification_record.BOX_FILE_OWNER)
+                    for shard in shards
+                )
+            ]
+        apply_stream.submit(
+            build_retry_box_classification_tasks(box_user_resolver, box_classification_records),
+            box_classification_records
+        )
+    apply_stream.join()
+
+
+class PolicyPageBatch(NamedTuple):
+    """
+    Box classification apply tasks and box_classification records built from a page of MCAS DLP policy triggers, and
+    the page's latest file modification
+    """
+    paginate: int
+    poll_again: bool
+    box_classification_tasks: list
+    box_classification_records: List[BoxClassification]
+    watermark: Optional[datetime.datetime] = None
+
+
+def build_box_classification_batch(
+        box_classification_sql_manager: BoxClassificationSQLManager,
+        seen_box_classification_keys: cache.LRUCache,
+        box_user_resolver: box.BoxUserResolver,
+        box_classification_name: str,
+        mcas_policy_id: str,
+        shard: Optional[lease.Shard],
+        policy_page: mcas.FilesPage
+) -> PolicyPageBatch:
     """
-    retry_batch_size = 0
+    Builds Box classification apply tasks and box_classification records from a page of MCAS DLP policy triggers.
+    Keys of the built records are claimed in the seen key cache so later pages in flight skip them. The page's Box file
+    owners are resolved in bulk. Triggers of Box file owners outside the shard are left to the shard's sibling shards.
+    """
+    file_policy_triggers, poll_mcas_file_again, mcas_files_paginate = policy_page
+    watermark = mcas.page_watermark(file_policy_triggers)
+    if shard is not None and shard.owner_shard_count > 1:
+        file_policy_triggers = [
+            file_policy_trigger
+            for file_policy_trigger in file_policy_triggers
+            if shard.owns(
+                mcas_policy_id,
+                ((file_policy_trigger.get("boxItem") or {}).get("owned_by") or {}).get("login")
+            )
+        ]
+    triggers_seen.inc(len(file_policy_triggers))
+
+    # Set a list to hold Box classification apply tasks to run in a thread pool
     box_classification_tasks = list()
     box_classification_records = list()
-    for box_classification_record in box_classification_sql_manager.failed_apply_retry_records():
-        if retry_batch_size == 1000:
-            process_box_classification_apply_batch(
-                box_classification_sql_manager,
-                box_classification_tasks,
-                box_classification_records
+
+    file_policy_triggers = dedupe_policy_triggers(
+        box_classification_sql_manager,
+        seen_box_classification_keys,
+        file_policy_triggers,
+        box_classification_name,
+        mcas_policy_id
+    )
+    box_user_resolver.resolve(
+        file_policy_trigger["boxItem"]["owned_by"]["login"]
+        for file_policy_trigger in file_policy_triggers
+        if (file_policy_trigger["boxItem"].get("owned_by") or {}).get("login")
+    )
+    # Iterate the MCAS file endpoint response policy triggers without box_classification records
+    for file_policy_trigger in file_policy_triggers:
+        try:
+            # Get the policy trigger's Box file information
+            box_file_id = file_policy_trigger["boxItem"]["id"]
+            box_file_name = file_policy_trigger["boxItem"]["name"]
+            box_file_owner = file_policy_trigger["boxItem"]["owned_by"]["login"]
+            log.info(
+                "processing DLP policy trigger with ID %s Box file ID %s Box file name %s",
+                file_policy_trigger["id"],
+                box_file_id,
+                box_file_name
             )
-            retry_batch_size = 0
-            box_classification_tasks = list()
-            box_classification_records = list()
 
-        retry_batch_size += 1
-        box_classification_records.append(box_classification_record)
-        box_classification_record.APPLY_ATTEMPTS += 1
-        box_as_user_clients, box_as_user_client = box.get_cached_box_as_user_client(
-            box_as_user_clients, box_client, box_classification_record.BOX_FILE_OWNER
+            # Insert a box_classification_apply SQL record
+            box_classification_record = box_classification_sql_manager.new_record(
+                box_file_id,
+                box_file_name,
+                box_file_owner,
+                box_classification_name,
+                mcas_policy_id
+            )
+            box_classification_records.append(box_classification_record)
+            seen_box_classification_keys.set((box_file_id, box_classification_name, mcas_policy_id))
+
+            # Get a Box as user client associated to the MCAS policy trigger Box file owner
+            box_as_user_client = box_user_resolver.as_user_client(box_file_owner)
+            if not box_as_user_client:
+                box_classification_record.APPLY_ERROR_NO_BOX_USER = True
+                classifications_no_user.inc()
+            else:
+                # Add the Box classification apply task arguments to a list
+                box_classification_tasks.append(
+                    [
+                        box_as_user_client,
+                        box_file_id,
+                        box_classification_name,
+                        box_classification_record
+                    ]
+                )
+        except Exception as e:
+            log.error(f"failed to process DLP policy trigger with {e}")
+
+    return PolicyPageBatch(
+        mcas_files_paginate,
+        poll_mcas_file_again,
+        box_classification_tasks,
+        box_classification_records,
+        watermark
+    )
+
+
+def checkpoint_offset_page(
+        checkpoint_store: checkpoint.CheckpointStore,
+        checkpoint_key: str,
+        policy_page_batch: PolicyPageBatch
+) -> None:
+    """
+    Checkpoints an MCAS DLP policy's pagination value past a committed page
+    """
+    if policy_page_batch.poll_again:
+        checkpoint_store.set(checkpoint_key, paginate=policy_page_batch.paginate)
+    else:
+        checkpoint_store.set(
+            checkpoint_key,
+            paginate=policy_page_batch.paginate,
+            processed_all_at=datetime.datetime.utcnow(),
+            flush=True
+        )
+
+
+def checkpoint_watermark_page(
+        checkpoint_store: checkpoint.CheckpointStore,
+        checkpoint_key: str,
+        policy_page_batch: PolicyPageBatch
+) -> None:
+    """
+    Advances an MCAS DLP policy's watermark to the latest file modification of a committed page
+    """
+    watermark = max(
+        checkpoint_store.get(checkpoint_key).watermark,
+        policy_page_batch.watermark or datetime.datetime.min
+    )
+    if policy_page_batch.poll_again:
+        checkpoint_store.set(checkpoint_key, watermark=watermark)
+    else:
+        checkpoint_store.set(
+            checkpoint_key,
+            watermark=watermark,
+            processed_all_at=datetime.datetime.utcnow(),
+            flush=True
         )
-        box_classification_tasks.append(
+
+
+def checkpoint_reconcile_page(
+        checkpoint_store: checkpoint.CheckpointStore,
+        checkpoint_key: str,
+        policy_page_batch: PolicyPageBatch
+) -> None:
+    """
+    Checkpoints an MCAS DLP policy's reconciliation scan pagination value past a committed page, and restarts the next
+    scan from the first page once the scan completes
+    """
+    if policy_page_batch.poll_again:
+        checkpoint_store.set(checkpoint_key, paginate=policy_page_batch.paginate)
+    else:
+        checkpoint_store.set(checkpoint_key, paginate=0, reconciled_at=datetime.datetime.utcnow(), flush=True)
+        log.info(f"reconciled MCAS DLP policy checkpoint {checkpoint_key}")
+
+
+def sync_mcas_policy(
+        config: dict,
+        box_mcas_classification: dict,
+        checkpoint_store: checkpoint.CheckpointStore,
+        box_classification_sql_manager: BoxClassificationSQLManager,
+        dedupe_sql_manager: BoxClassificationSQLManager,
+        seen_box_classification_keys: cache.LRUCache,
+        box_user_resolver: box.BoxUserResolver,
+        mcas_client: mcas.MCASClient,
+        worker_pool: thread.WorkerPool,
+        shard: Optional[lease.Shard] = None,
+        lease_keeper: Optional[lease.LeaseKeeper] = None
+) -> int:
+    """
+    Syncs an MCAS DLP policy's triggers to Box file classifications through a three stage pipeline. MCAS pages are
+    prefetched ahead of the build stage, which dedupes triggers and builds apply tasks while the apply stage streams
+    earlier batches through the worker pool. The policy's checkpoint only advances past a page once its records, and
+    the records of every earlier page, are committed.
+
+    With offset polling, every cycle pages through the policy's triggers from the checkpointed skip offset. With
+    watermark polling, every cycle polls only the files modified since the checkpointed watermark, less an overlap for
+    late arriving modifications, and a full reconciliation scan by offset runs every reconcile_interval.
+
+    If a shard is set, only the shard's triggers are synced under the shard's checkpoint. The sync stops at the next
+    page if a lease keeper no longer holds the shard's lease.
+
+    Returns the number of new Box classification records built from the policy's triggers.
+    """
+    box_classification_name = box_mcas_classification["box_name"]
+    mcas_policy_id = box_mcas_classification["mcas_id"]
+    shard = shard or lease.Shard(mcas_policy_id)
+    checkpoint_key = shard.shard_id
+    polling = configure_polling(config)
+
+    def sync_pages(policy_pages: Iterator[mcas.FilesPage], checkpoint_page: Callable) -> int:
+        """
+        Syncs pages of the MCAS DLP policy's triggers, checkpointing every committed page not preceded by a pending page
+        in order. Returns the number of new Box classification records built.
+        """
+        policy_pipeline = pipeline.Pipeline(
+            policy_pages,
             [
-                box_as_user_client,
-                box_classification_record.BOX_FILE_ID,
-                box_classification_record.BOX_CLASSIFICATION_NAME,
-                box_classification_record
-            ]
+                functools.partial(
+                    build_box_classification_batch,
+                    dedupe_sql_manager,
+                    seen_box_classification_keys,
+                    box_user_resolver,
+                    box_classification_name,
+                    mcas_policy_id,
+                    shard
+                )
+            ],
+            queue_size=config.get("sync", {}).get("prefetch_pages", 2),
+            name=f"mcas-policy-{checkpoint_key}"
+        )
+        apply_stream = configure_box_classification_apply_stream(
+            config, worker_pool, box_classification_sql_manager, checkpoint_key
         )
+        # Pages with records in flight in submission order, and the pages among them whose records are all committed
+        pending_page_batches = collections.deque()
+        committed_page_batches = set()
+        # The batch in hand when the shard's lease was lost, which is never submitted
+        dropped_page_batches = list()
+        new_record_count = 0
 
-    if retry_batch_size:
-        process_box_classification_apply_batch(
-            box_classification_sql_manager,
-            box_classification_tasks,
-            box_classification_records
+        def release_keys(policy_page_batches: Iterable[PolicyPageBatch]) -> None:
+            """
+            Releases the claimed keys of batches' records so their triggers are picked up when polled again
+            """
+            for policy_page_batch in policy_page_batches:
+                for box_classification_record in policy_page_batch.box_classification_records:
+                    seen_box_classification_keys.discard(
+                        (box_classification_record.BOX_FILE_ID, box_classification_name, mcas_policy_id)
+                    )
+
+        def checkpoint_committed_pages(policy_page_batch: PolicyPageBatch) -> None:
+            """
+            Checkpoints every committed page not preceded by a pending page
+            """
+            committed_page_batches.add(id(policy_page_batch))
+            while pending_page_batches and id(pending_page_batches[0]) in committed_page_batches:
+                committed_page_batch = pending_page_batches.popleft()
+                committed_page_batches.discard(id(committed_page_batch))
+                checkpoint_page(committed_page_batch)
+
+        try:
+            with policy_pipeline:
+                for policy_page_batch in policy_pipeline:
+                    if lease_keeper is not None and not lease_keeper.holds(shard):
+                        log.warning(f"stopped syncing shard {checkpoint_key} as its lease is no longer held")
+                        dropped_page_batches.append(policy_page_batch)
+                        break
+
+                    # Stream the batch of Box classification apply tasks through the worker pool
+                    pending_page_batches.append(policy_page_batch)
+                    new_record_count += len(policy_page_batch.box_classification_records)
+                    apply_stream.submit(
+                        policy_page_batch.box_classification_tasks,
+                        policy_page_batch.box_classification_records,
+                        functools.partial(checkpoint_committed_pages, policy_page_batch)
+                    )
+            apply_stream.join()
+        except Exception:
+            # Commit the records of the apply tasks in flight before their keys are released, so their triggers are
+            # not applied again when polled again. If committing fails too, the tasks are only waited for.
+            try:
+                apply_stream.join()
+            except Exception as e:
+                log.error(f"failed to commit the in-flight Box classification applys of {checkpoint_key} with {e}")
+                apply_stream.drain()
+            # Release the claimed keys of uncheckpointed pages, and of batches built but dropped in the pipeline
+            release_keys(list(pending_page_batches) + dropped_page_batches + policy_pipeline.unconsumed)
+            raise
+
+        # Keys claimed by the batches dropped when the lease was lost would otherwise be skipped if the shard is
+        # claimed again. The submitted batches are committed, and other shards' claims are left alone.
+        release_keys(dropped_page_batches + policy_pipeline.unconsumed)
+
+        return new_record_count
+
+    policy_checkpoint = checkpoint_store.get(checkpoint_key)
+    if polling.mode != POLLING_WATERMARK:
+        return sync_pages(
+            mcas_client.iter_pages(mcas_policy_id, policy_checkpoint.paginate),
+            functools.partial(checkpoint_offset_page, checkpoint_store, checkpoint_key)
         )
 
+    if policy_checkpoint.watermark == datetime.datetime.min:
+        # Watermark polling starts from now, leaving the policy's earlier triggers to the reconciliation scan
+        policy_checkpoint = checkpoint_store.set(checkpoint_key, watermark=datetime.datetime.utcnow(), flush=True)
+    new_record_count = sync_pages(
+        mcas_client.iter_pages(mcas_policy_id, 0, policy_checkpoint.watermark - polling.watermark_overlap),
+        functools.partial(checkpoint_watermark_page, checkpoint_store, checkpoint_key)
+    )
+
+    # A reconciliation scan in progress has a pagination value, and resumes from it
+    policy_checkpoint = checkpoint_store.get(checkpoint_key)
+    if policy_checkpoint.paginate or (
+            datetime.datetime.utcnow() - policy_checkpoint.reconciled_at >= polling.reconcile_interval
+    ):
+        log.info(f"reconciling MCAS DLP ID {mcas_policy_id} shard {checkpoint_key} from {policy_checkpoint.paginate}")
+        new_record_count += sync_pages(
+            mcas_client.iter_pages(mcas_policy_id, policy_checkpoint.paginate),
+            functools.partial(checkpoint_reconcile_page, checkpoint_store, checkpoint_key)
+        )
+
+    return new_record_count
+
 
 @click.command()
 @click.option(
     "-e", "--env", default="dev_local", help="env environment alias", type=str,
 )
+@click.option(
+    "--engine",
+    default="thread",
+    help="execution engine, a thread pool or an asyncio event loop",
+    type=click.Choice(["thread", "asyncio"]),
+)
+@click.option(
+    "--cycles", default=0, help="number of sync cycles to run before exiting, or 0 to run forever", type=int,
+)
+@click.option(
+    "--worker",
+    is_flag=True,
+    help="run as one of several sync workers that share the MCAS DLP policies through SQL work leases",
+)
+@click.option(
+    "--record",
+    "record_dir",
+    default=None,
+    help="record every MCAS and Box request and response to compressed JSONL files in a directory",
+    type=click.Path(file_okay=False),
+)
+@click.option(
+    "--replay",
+    "replay_dir",
+    default=None,
+    help="serve the MCAS and Box responses recorded in a directory instead of calling the MCAS and Box APIs",
+    type=click.Path(exists=True, file_okay=False),
+)
+@click.option(
+    "--replay-timing",
+    default=traffic.REPLAY_ORIGINAL_TIMING,
+    help="serve replayed responses with their recorded latency or as fast as possible",
+    type=click.Choice([traffic.REPLAY_ORIGINAL_TIMING, traffic.REPLAY_FAST]),
+)
+@click.option(
+    "--profile",
+    is_flag=True,
+    help="profile every sync cycle, writing CPU profiles and allocation growth reports to the logs directory",
+)
 @config_utils.config_env
-def mcas_policy_box_classification_sync(env, config):
+def mcas_policy_box_classification_sync(
+        env, engine, cycles, worker, record_dir, replay_dir, replay_timing, profile, config
+):
     """
     Click CLI command to sync MCAS DLP policy trigger events with Box file classifications
     """
+    if worker and engine == "asyncio":
+        raise click.UsageError("--worker is only supported by the thread engine")
+    if worker and (config.get("checkpoint") or {}).get("backend", "sql") != "sql":
+        raise click.UsageError("--worker requires the sql checkpoint backend")
+    if record_dir and replay_dir:
+        raise click.UsageError("--record and --replay cannot be used together")
+
+    # Record the MCAS and Box traffic, or replay a recording of it in place of the MCAS and Box APIs
+    traffic_recorder = traffic.TrafficRecorder(record_dir).start() if record_dir else None
+    replay_server = traffic.configure_replay_server(config, replay_dir, replay_timing) if replay_dir else None
+
     # Setup a Box Platform API client
     box_client = box.configure_box_client(config)
-    box_as_user_clients = dict()
-
-    # Get MCAS API information
-    mcas_subdomain = config["mcas"]["subdomain"]
-    mcas_api_token = config["mcas"]["api_token"]
-    mcas_rate_limiter = RateLimiter()
 
     # Connect to the SQL database
     sql.configure_connection(config)
     box_classification_sql_manager = BoxClassificationSQLManager(sql.connection)
-    while True:
-        # Get a MCAS policy from configuration
-        for box_mcas_classification in config["box"]["mcas_classifications"]:
-            box_classification_name = box_mcas_classification["box_name"]
-            mcas_policy_id = box_mcas_classification["mcas_id"]
-            mcas_files_paginate = box_mcas_classification["paginate"]
-            processed_all_at = box_mcas_classification["processed_all_at"]
-            now = datetime.datetime.utcnow()
-            if (now - processed_all_at) > datetime.timedelta(minutes=1):
-                while True:
-                    # Set a list to hold Box classification apply tasks to run in a thread pool
-                    box_classification_tasks = list()
-                    box_classification_records = list()
-
-                    # Poll the MCAS file endpoint
-                    files_response, poll_mcas_file_again, mcas_files_paginate = mcas.poll_files(
-                        mcas_subdomain, mcas_api_token, mcas_policy_id, mcas_files_paginate, mcas_rate_limiter
-                    )
+    seen_box_classification_keys = cache.LRUCache(
+        config.get("sync", {}).get("dedupe_cache_size", 100000)
+    )
 
-                    # Load the MCAS file response data to a dictionary
-                    file_response_content = json.loads(files_response.content)
-                    file_policy_triggers = file_response_content.get("data", [])
-                    # Iterate the MCAS file endpoint response policy triggers
-                    for file_policy_trigger in file_policy_triggers:
-                        try:
-                            # Get the policy trigger's Box file information
-                            box_file_id = file_policy_trigger["boxItem"]["id"]
-                            box_file_name = file_policy_trigger["boxItem"]["name"]
-                            box_file_owner = file_policy_trigger["boxItem"]["owned_by"]["login"]
-                            log.info(f"processing DLP policy trigger with ID {file_policy_trigger['id']} Box file ID {box_file_id} Box file name {box_file_name}")
-
-                            if box_classification_sql_manager.exists(
-                                BOX_FILE_ID=box_file_id,
-                                BOX_CLASSIFICATION_NAME=box_classification_name,
-                                MCAS_POLICY_ID=mcas_policy_id
-                            ):
-                                log.info(f"skipping DLP policy trigger because record already exists")
-                            else:
-                                # Insert a box_classification_apply SQL record
-                                box_classification_record = box_classification_sql_manager.new_record(
-                                    box_file_id,
-                                    box_file_name,
-                                    box_file_owner,
-                                    box_classification_name,
-                                    mcas_policy_id
-                                )
-                                box_classification_records.append(box_classification_record)
-
-                                # Get a Box as user client associated to the MCAS policy trigger Box file owner
-                                box_as_user_clients, box_as_user_client = box.get_cached_box_as_user_client(
-                                    box_as_user_clients, box_client, box_file_owner
-                                )
-                                if not box_as_user_client:
-                                    box_classification_record.APPLY_ERROR_NO_BOX_USER = True
-                                else:
-                                    # Add the Box classification apply task arguments to a list
-                                    box_classification_tasks.append(
-                                        [
-                                            box_as_user_client,
-                                            box_file_id,
-                                            box_classification_name,
-                                            box_classification_record
-                                        ]
-                                    )
-                        except Exception as e:
-                            log.error(f"failed to process DLP policy trigger with {e}")
-
-                    # Process the batch of Box classification apply tasks
-                    process_box_classification_apply_batch(
-                        box_classification_sql_manager,
-                        box_classification_tasks,
-                        box_classification_records
-                    )
+    # Setup the Box file owner to as-user client resolver backed by the box_user SQL table
+    BoxUser.__table__.create(sql.connection, checkfirst=True)
+    box_user_resolver = box.configure_box_user_resolver(config, box_client, BoxUserSQLManager(sql.connection))
 
-                    # Applied the configuration's MCAS classification item's pagination value
-                    box_mcas_classification["paginate"] = mcas_files_paginate
-                    config_utils.write_configuration(env, config)
-                    if not poll_mcas_file_again:
-                        box_mcas_classification["processed_all_at"] = datetime.datetime.utcnow()
-                        config_utils.write_configuration(env, config)
-                        break
-            else:
-                log.debug(f"time threshold for processing new MCAS DLP ID {mcas_policy_id} for Box classification {box_classification_name} has not elapsed")
+    # Load the MCAS DLP policy checkpoints
+    checkpoint_store = checkpoint.configure_checkpoint_store(env, config)
+
+    # Serve the sync's metrics
+    metrics.configure_metrics(config)
+
+    # Profile every sync cycle
+    cycle_profiler = profiling.configure_cycle_profiler(config).start() if profile else None
+
+    # Trim the in-process caches whenever the process's memory passes its high water mark
+    memory_guard = memory.configure_memory_guard(config, [seen_box_classification_keys, box_user_resolver])
+
+    if engine == "asyncio":
+        # Imported on demand as the asyncio engine requires aiohttp
+        from src.commands import mcas_asyncio
+
+        try:
+            mcas_asyncio.run(
+                config,
+                checkpoint_store,
+                box_classification_sql_manager,
+                seen_box_classification_keys,
+                box_user_resolver,
+                box_client,
+                cycles,
+                cycle_profiler
+            )
+        finally:
+            if memory_guard:
+                memory_guard.stop()
+            if cycle_profiler:
+                cycle_profiler.stop()
+            if traffic_recorder:
+                traffic_recorder.stop()
+            if replay_server:
+                replay_server.stop()
+        return
+
+    # Setup a pooled MCAS API client, as the asyncio engine has its own
+    mcas_client = mcas.configure_mcas_client(config)
+
+    # Start the worker pool that runs Box classification apply tasks for the life of the command
+    worker_pool = thread.configure_worker_pool(config)
+
+    # Adapt the Box rate limits and the worker pool's concurrency to Box's responses
+    aimd_controller = adaptive.configure_aimd_controller(
+        config,
+        {
+            endpoint_alias: box_client.rate_limiter(endpoint_alias)
+            for endpoint_alias in box.BOX_RATE_LIMITED_ENDPOINTS
+        },
+        {"worker_pool": worker_pool},
+    )
+    if aimd_controller:
+        box_client.add_response_observer(aimd_controller.observe)
 
-        # Retry failed Box classification apply tasks from SQL records
+    # Claim a share of the MCAS DLP policy shards through SQL work leases
+    lease_keeper = lease.configure_lease_keeper(config, sql.connection) if worker else None
+    box_mcas_classifications = {
+        box_mcas_classification["mcas_id"]: box_mcas_classification
+        for box_mcas_classification in config["box"]["mcas_classifications"]
+    }
+
+    # Each shard is polled on its own adaptive interval, and retries and lease rebalancing run on their own intervals
+    sync_scheduler = scheduler.Scheduler()
+    schedule_config = scheduler.configure_schedule(config)
+    scheduled_shards = dict()
+    poll_intervals = dict()
+    poll_counts = collections.Counter()
+    retry_count = 0
+
+    # Polls and retries run concurrently on policy threads, and share the MCAS and Box rate limiters and the worker
+    # pool. Each policy thread has its own SQL sessions, as the apply stream commits and the pipeline build stage
+    # dedupes triggers on separate sessions.
+    policy_concurrency = configure_policy_concurrency(config)
+    policy_executor = concurrent.futures.ThreadPoolExecutor(policy_concurrency, thread_name_prefix="policy")
+    policy_sql_managers = threading.local()
+    running_tasks = dict()
+
+    def sql_managers() -> Tuple[BoxClassificationSQLManager, BoxClassificationSQLManager]:
+        """
+        Returns the calling policy thread's box_classification SQL managers for applys and for dedupe
+        """
+        if not hasattr(policy_sql_managers, "apply"):
+            policy_sql_managers.apply = BoxClassificationSQLManager(sql.connection)
+            policy_sql_managers.dedupe = BoxClassificationSQLManager(sql.connection)
+
+        return policy_sql_managers.apply, policy_sql_managers.dedupe
+
+    def poll_shard(shard: lease.Shard) -> int:
+        """
+        Syncs a shard's MCAS DLP policy triggers on a policy thread. Returns the number of new records built.
+        """
+        apply_sql_manager, dedupe_sql_manager = sql_managers()
+
+        return sync_mcas_policy(
+            config,
+            box_mcas_classifications[shard.mcas_policy_id],
+            checkpoint_store,
+            apply_sql_manager,
+            dedupe_sql_manager,
+            seen_box_classification_keys,
+            box_user_resolver,
+            mcas_client,
+            worker_pool,
+            shard,
+            lease_keeper
+        )
+
+    def retry_shards() -> None:
+        """
+        Retries failed Box classification apply tasks from SQL records on a policy thread
+        """
         retry_failed_box_classification_applys(
-            box_classification_sql_manager,
-            box_client,
-            box_as_user_clients
+            config,
+            worker_pool,
+            sql_managers()[0],
+            box_user_resolver,
+            lease_keeper.held_shards if lease_keeper else None
         )
+
+    def schedule_shards(shards: List[lease.Shard]) -> None:
+        """
+        Schedules the polls of newly held shards, due once their poll interval has passed since they were last fully
+        processed, and unschedules the polls of shards no longer held
+        """
+        for shard in shards:
+            if shard.shard_id not in scheduled_shards:
+                scheduled_shards[shard.shard_id] = shard
+                box_mcas_classification = box_mcas_classifications[shard.mcas_policy_id]
+                poll_interval = poll_intervals.setdefault(
+                    shard.shard_id, scheduler.configure_poll_interval(config, box_mcas_classification)
+                )
+                configure_policy_flow(config, worker_pool, box_mcas_classification, shard.shard_id)
+                processed_all_at = checkpoint_store.get(shard.shard_id).processed_all_at
+                processed_ago = (datetime.datetime.utcnow() - processed_all_at).total_seconds()
+                sync_scheduler.schedule((POLL_TASK, shard.shard_id), poll_interval.interval - processed_ago)
+        for shard_id in set(scheduled_shards) - {shard.shard_id for shard in shards}:
+            del scheduled_shards[shard_id]
+            sync_scheduler.cancel((POLL_TASK, shard_id))
+
+    def held_shards() -> List[lease.Shard]:
+        """
+        Rebalances the worker's shard leases. Returns the shards the worker holds.
+        """
+        try:
+            shards = lease_keeper.rebalance()
+        except Exception as e:
+            log.error(f"failed to rebalance sync worker {lease_keeper.worker_id} shards with {e}")
+            shards = lease_keeper.held_shards
+        # Pick up the progress of shards claimed from other workers
+        checkpoint_store.reload(shard.shard_id for shard in shards)
+        lease.seed_shard_checkpoints(checkpoint_store, shards)
+
+        return shards
+
+    if lease_keeper:
+        schedule_shards(held_shards())
+        sync_scheduler.schedule(REBALANCE_TASK, lease_keeper.rebalance_interval)
+    else:
+        schedule_shards([lease.Shard(mcas_policy_id) for mcas_policy_id in box_mcas_classifications])
+    sync_scheduler.schedule(RETRY_TASK)
+
+    if cycle_profiler:
+        poll_shard = cycle_profiler.wrap(poll_shard)
+        retry_shards = cycle_profiler.wrap(retry_shards)
+
+    # A cycle is done once every shard has been polled and failed applys retried
+    while not cycles or retry_count < cycles or min(
+            (poll_counts[shard_id] for shard_id in scheduled_shards), default=cycles
+    ) < cycles:
+        # Wait for the next task to fall due, unless every policy thread is busy, or for a running task to complete
+        due_in = sync_scheduler.due_in() if len(running_tasks) < policy_concurrency else None
+        if running_tasks:
+            completed_futures, _ = concurrent.futures.wait(
+                running_tasks, timeout=due_in, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+        else:
+            completed_futures = set()
+            if due_in:
+                log.debug(f"sleeping {due_in:.1f} seconds until the next scheduled task")
+                time.sleep(due_in)
+
+        for completed_future in completed_futures:
+            task = running_tasks.pop(completed_future)
+            if task == RETRY_TASK:
+                try:
+                    completed_future.result()
+                except Exception as e:
+                    log.error(f"failed to retry failed Box classification applys with {e}")
+                retry_count += 1
+                sync_scheduler.schedule(RETRY_TASK, schedule_config["retry_interval"])
+                continue
+
+            shard = task[1]
+            box_mcas_classification = box_mcas_classifications[shard.mcas_policy_id]
+            box_classification_name = box_mcas_classification["box_name"]
+            mcas_policy_id = box_mcas_classification["mcas_id"]
+            new_record_count = 0
+            try:
+                new_record_count = completed_future.result()
+            except Exception as e:
+                log.error(f"failed to sync MCAS DLP ID {mcas_policy_id} shard {shard.shard_id} for Box classification {box_classification_name} with {e}")
+            poll_counts[shard.shard_id] += 1
+            poll_interval = poll_intervals[shard.shard_id].update(new_record_count)
+            if shard.shard_id in scheduled_shards:
+                sync_scheduler.schedule((POLL_TASK, shard.shard_id), poll_interval)
+                log.debug(f"polling MCAS DLP ID {mcas_policy_id} shard {shard.shard_id} again in {poll_interval:.0f} seconds after {new_record_count} new triggers")
+        if cycle_profiler and min(
+                [retry_count] + [poll_counts[shard_id] for shard_id in scheduled_shards]
+        ) >= cycle_profiler.cycle:
+            cycle_profiler.end_cycle()
+        if completed_futures or len(running_tasks) >= policy_concurrency:
+            continue
+
+        task = sync_scheduler.pop_due()
+        if task is None:
+            continue
+
+        if task == RETRY_TASK:
+            running_tasks[policy_executor.submit(retry_shards)] = RETRY_TASK
+            continue
+
+        if task == REBALANCE_TASK:
+            schedule_shards(held_shards())
+            sync_scheduler.schedule(REBALANCE_TASK, lease_keeper.rebalance_interval)
+            continue
+
+        # Get a MCAS policy from configuration
+        shard = scheduled_shards[task[1]]
+        if lease_keeper and not lease_keeper.holds(shard):
+            # The shard is scheduled again if the next rebalance claims it back
+            del scheduled_shards[shard.shard_id]
+            continue
+        if (POLL_TASK, shard) in running_tasks.values():
+            # A shard released and claimed back while its poll was running is rescheduled once the poll completes
+            continue
+
+        running_tasks[policy_executor.submit(poll_shard, shard)] = (POLL_TASK, shard)
+
+    policy_executor.shutdown()
+    if lease_keeper:
+        lease_keeper.stop()
+    worker_pool.shutdown()
+    mcas_client.close()
+    checkpoint_store.flush()
+    if memory_guard:
+        memory_guard.stop()
+    if cycle_profiler:
+        cycle_profiler.stop()
+    if traffic_recorder:
+        traffic_recorder.stop()
+    if replay_server:
+        replay_server.stop()
@@ -0,0 +1,513 @@
+"""
+asyncio execution engine for the Microsoft Cloud App Security DLP file policy trigger to Box file classification sync
+"""
+
+from __future__ import annotations
+import asyncio
+import concurrent.futures
+import contextlib
+import datetime
+import functools
+import logging
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from src import adaptive
+from src import aio
+from src import box
+from src import cache
+from src import checkpoint
+from src import http_utils
+from src import mcas
+from src import profiling
+from src import scheduler
+from src.commands import mcas as mcas_command
+from src.commands.mcas import dedupe_policy_triggers
+from src.sql.models.box_classification import (
+    BoxClassification,
+    BoxClassificationSQLManager,
+    RETRY_SERVER_ERROR,
+    retry_failure_type,
+    schedule_retry
+)
+
+
+log = logging.getLogger(__name__)
+
+
+def run(
+        config: dict,
+        checkpoint_store: checkpoint.CheckpointStore,
+        box_classification_sql_manager: BoxClassificationSQLManager,
+        seen_box_classification_keys: cache.LRUCache,
+        box_user_resolver: box.BoxUserResolver,
+        box_client: box.BoxClient,
+        cycles: int = 0,
+        cycle_profiler: Optional[profiling.CycleProfiler] = None
+) -> None:
+    """
+    Runs the MCAS DLP policy trigger to Box file classification sync on an asyncio event loop, forever or for a number
+    of cycles. A cycle_profiler profiles the event loop's thread and ends a cycle as each sync cycle completes.
+    """
+    async_sync = AsyncSync(
+        config,
+        checkpoint_store,
+        box_classification_sql_manager,
+        seen_box_classification_keys,
+        box_user_resolver,
+        box_client
+    )
+    loop = asyncio.new_event_loop()
+    try:
+        with cycle_profiler.profile_thread() if cycle_profiler else contextlib.ExitStack():
+            loop.run_until_complete(async_sync.run(cycles, cycle_profiler))
+    finally:
+        loop.run_until_complete(async_sync.close())
+        loop.close()
+
+
+class AsyncSync:
+    """
+    asyncio MCAS DLP policy trigger to Box file classification sync. MCAS polling, Box user lookups and Box
+    classification applies are coroutines, with in-flight Box calls bounded by a concurrency limiter and every call
+    drawing from async rate limiters with the configured budgets, which box.adaptive settings adapt to Box's responses.
+    SQL work runs on a single dedicated thread so the ORM session is never shared across threads.
+    """
+
+    def __init__(
+            self,
+            config: dict,
+            checkpoint_store: checkpoint.CheckpointStore,
+            box_classification_sql_manager: BoxClassificationSQLManager,
+            seen_box_classification_keys: cache.LRUCache,
+            box_user_resolver: box.BoxUserResolver,
+            box_client: box.BoxClient
+    ) -> AsyncSync:
+        asyncio_config = (config.get("sync") or {}).get("asyncio") or {}
+        mcas_config = config["mcas"]
+        self._config: dict = config
+        self._checkpoint_store: checkpoint.CheckpointStore = checkpoint_store
+        self._box_classification_sql_manager: BoxClassificationSQLManager = box_classification_sql_manager
+        self._seen_box_classification_keys: cache.LRUCache = seen_box_classification_keys
+        self._box_user_resolver: box.BoxUserResolver = box_user_resolver
+        self._concurrency: int = asyncio_config.get("concurrency", 500)
+        self._polling: mcas_command.PollingConfig = mcas_command.configure_polling(config)
+        self._semaphore: Optional[aio.AsyncConcurrencyLimiter] = None
+        self._policy_concurrency: int = mcas_command.configure_policy_concurrency(config)
+        # Per policy caps on in-flight Box classification applys
+        self._policy_semaphores: Dict[str, asyncio.Semaphore] = dict()
+        self._box_user_lookups: Dict[str, asyncio.Future] = dict()
+        self._sql_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="sql")
+        self._mcas_client = aio.AsyncMCASClient(
+            mcas_config.get("subdomain"),
+            mcas_config["api_token"],
+            aio.AsyncRateLimiter.from_rate_limiter(
+                http_utils.configure_rate_limiter(config, http_utils.MCAS_FILES)
+            ),
+            pool_size=mcas_config.get("pool_size", 10),
+            connect_timeout=mcas_config.get("connect_timeout", 10),
+            read_timeout=mcas_config.get("read_timeout", 60),
+            retries=mcas_config.get("retries", 5),
+            backoff_factor=mcas_config.get("backoff_factor", 1),
+            limit=mcas_config.get("limit"),
+            base_url=mcas.mcas_base_url(mcas_config),
+        )
+        self._box_rate_limiters: Dict[str, aio.AsyncRateLimiter] = {
+            endpoint_alias: aio.AsyncRateLimiter.from_rate_limiter(box_client.rate_limiter(endpoint_alias))
+            for endpoint_alias in box.BOX_RATE_LIMITED_ENDPOINTS
+        }
+        self._box_client = aio.AsyncBoxClient(
+            box_client.auth,
+            self._box_rate_limiters,
+            pool_size=asyncio_config.get("pool_size", 100),
+        )
+
+    async def _run_sql(self, function: Callable, *args) -> Any:
+        """
+        Runs a blocking SQL function on the dedicated SQL thread
+        """
+        return await asyncio.get_event_loop().run_in_executor(self._sql_executor, function, *args)
+
+    async def resolve_box_user_ids(self, emails: Iterable[str]) -> Dict[str, Optional[str]]:
+        """
+        Resolves Box file owner emails to Box user IDs from the resolver's cache and SQL table, looking up the misses
+        concurrently. Emails whose lookup failed are omitted.
+        """
+        box_user_ids, unresolved_emails = await self._run_sql(self._box_user_resolver.resolve_cached, list(emails))
+        if unresolved_emails:
+            looked_up_box_user_ids = {
+                email: box_user_id
+                for email, box_user_id in await asyncio.gather(
+                    *(self._lookup_box_user_id(email) for email in unresolved_emails)
+                )
+                if box_user_id is not cache.MISSING
+            }
+            await self._run_sql(self._box_user_resolver.save_resolved, looked_up_box_user_ids)
+            box_user_ids.update(looked_up_box_user_ids)
+            log.info(f"resolved {len(looked_up_box_user_ids)} of {len(unresolved_emails)} Box users from the Box API")
+
+        return box_user_ids
+
+    async def _lookup_box_user_id(self, email: str) -> tuple:
+        """
+        Looks up a Box user ID within the concurrency bound. Concurrent lookups of an email by several policies share
+        one Box call.
+        """
+        box_user_lookup = self._box_user_lookups.get(email)
+        if box_user_lookup is None:
+            box_user_lookup = self._box_user_lookups[email] = asyncio.ensure_future(self._request_box_user_id(email))
+            box_user_lookup.add_done_callback(lambda _: self._box_user_lookups.pop(email, None))
+
+        return await asyncio.shield(box_user_lookup)
+
+    async def _request_box_user_id(self, email: str) -> tuple:
+        """
+        Requests a Box user ID from the Box users endpoint within the concurrency bound
+        """
+        async with self._semaphore:
+            return await self._box_client.lookup_box_user_id(email)
+
+    async def box_classification_apply(
+            self,
+            box_user_id: str,
+            box_file_id: str,
+            box_classification_name: str,
+            box_classification_record: BoxClassification
+    ) -> None:
+        """
+        Applies a Box file classification from an MCAS DLP policy trigger. Updates a BoxClassification object with
+        the classification applys status
+        """
+        policy_semaphore = self._policy_semaphores.get(box_classification_record.MCAS_POLICY_ID)
+        try:
+            with mcas_command.apply_seconds.time():
+                async with policy_semaphore or contextlib.AsyncExitStack(), self._semaphore:
+                    applied = await self._box_client.apply_classification(
+                        box_user_id, box_file_id, box_classification_name
+                    )
+            if applied:
+                log.info("applied Box classification %s to file with ID %s", box_classification_name, box_file_id)
+            else:
+                log.info("Box file with ID %s already has classification %s", box_file_id, box_classification_name)
+
+            box_classification_record.APPLIED = True
+            mcas_command.classifications_applied.inc()
+        except Exception as e:
+            if hasattr(e, "code") and e.status == 403:
+                box_classification_record.APPLY_ERROR_FORBIDDEN = True
+                mcas_command.classifications_forbidden.inc()
+            else:
+                box_classification_record.APPLY_ERROR_EXCEPTION_MESSAGE = str(e)
+                schedule_retry(box_classification_record, retry_failure_type(e))
+                mcas_command.classifications_failed.inc()
+
+            log.info(
+                "failed to apply classification %s to file with ID %s with %s", box_classification_name, box_file_id, e
+            )
+
+    async def process_box_classification_records(self, box_classification_records: List[BoxClassification]) -> None:
+        """
+        Concurrently applies the Box classifications of a batch of box_classification records, then commits the
+        records' apply status
+        """
+        box_user_ids = await self.resolve_box_user_ids(
+            box_classification_record.BOX_FILE_OWNER for box_classification_record in box_classification_records
+        )
+        box_classification_applys = list()
+        for box_classification_record in box_classification_records:
+            box_user_id = box_user_ids.get(box_classification_record.BOX_FILE_OWNER, cache.MISSING)
+            if box_user_id is cache.MISSING:
+                schedule_retry(box_classification_record, RETRY_SERVER_ERROR)
+                log.error(f"failed to resolve Box user for record {box_classification_record}")
+            elif box_user_id is None:
+                box_classification_record.APPLY_ERROR_NO_BOX_USER = True
+                mcas_command.classifications_no_user.inc()
+            else:
+                box_classification_applys.append(
+                    self.box_classification_apply(
+                        box_user_id,
+                        box_classification_record.BOX_FILE_ID,
+                        box_classification_record.BOX_CLASSIFICATION_NAME,
+                        box_classification_record
+                    )
+                )
+
+        await asyncio.gather(*box_classification_applys)
+        await self._run_sql(self._box_classification_sql_manager.bulk_update, box_classification_records)
+
+    async def process_policy_page(
+            self,
+            file_policy_triggers: List[dict],
+            box_classification_name: str,
+            mcas_policy_id: str
+    ) -> int:
+        """
+        Dedupes a page of MCAS DLP policy triggers, then applies and commits the Box classifications of the new ones.
+        Returns the number of new Box classification records.
+        """
+        mcas_command.triggers_seen.inc(len(file_policy_triggers))
+        file_policy_triggers = await self._run_sql(
+            dedupe_policy_triggers,
+            self._box_classification_sql_manager,
+            self._seen_box_classification_keys,
+            file_policy_triggers,
+            box_classification_name,
+            mcas_policy_id
+        )
+        box_classification_records = list()
+        for file_policy_trigger in file_policy_triggers:
+            try:
+                box_file_id = file_policy_trigger["boxItem"]["id"]
+                box_file_name = file_policy_trigger["boxItem"]["name"]
+                box_file_owner = file_policy_trigger["boxItem"]["owned_by"]["login"]
+                log.info(
+                    "processing DLP policy trigger with ID %s Box file ID %s Box file name %s",
+                    file_policy_trigger["id"],
+                    box_file_id,
+                    box_file_name
+                )
+                box_classification_records.append(
+                    self._box_classification_sql_manager.new_record(
+                        box_file_id,
+                        box_file_name,
+                        box_file_owner,
+                        box_classification_name,
+                        mcas_policy_id
+                    )
+                )
+                self._seen_box_classification_keys.set((box_file_id, box_classification_name, mcas_policy_id))
+            except Exception as e:
+                log.error(f"failed to process DLP policy trigger with {e}")
+
+        try:
+            await self.process_box_classification_records(box_classification_records)
+        except Exception:
+            # Release the page's claimed keys so the triggers are picked up when the page is polled again
+            for box_classification_record in box_classification_records:
+                self._seen_box_classification_keys.discard(
+                    (box_classification_record.BOX_FILE_ID, box_classification_name, mcas_policy_id)
+                )
+            raise
+
+        return len(box_classification_records)
+
+    async def sync_policy_pages(
+            self,
+            box_classification_name: str,
+            mcas_policy_id: str,
+            paginate: int,
+            modified_since: Optional[datetime.datetime],
+            checkpoint_page: Callable
+    ) -> int:
+        """
+        Syncs pages of an MCAS DLP policy's triggers from a skip offset, or of the files modified since a time. The
+        next MCAS page is fetched while the current page's classifications are applied, and checkpoint_page runs on the
+        SQL thread, as it may flush, once a page's records are committed. Returns the number of new Box classification
+        records.
+        """
+        new_record_count = 0
+        next_page = asyncio.ensure_future(self._mcas_client.poll_files(mcas_policy_id, paginate, modified_since))
+        try:
+            while True:
+                file_policy_triggers, poll_mcas_file_again, mcas_files_paginate = await next_page
+                if poll_mcas_file_again:
+                    if modified_since is not None:
+                        modified_since, mcas_files_paginate = mcas.next_modified_cursor(
+                            modified_since, paginate, file_policy_triggers
+                        )
+                    paginate = mcas_files_paginate
+                    next_page = asyncio.ensure_future(
+                        self._mcas_client.poll_files(mcas_policy_id, paginate, modified_since)
+                    )
+
+                new_record_count += await self.process_policy_page(
+                    file_policy_triggers,
+                    box_classification_name,
+                    mcas_policy_id
+                )
+                await self._run_sql(
+                    checkpoint_page,
+                    mcas_command.PolicyPageBatch(
+                        mcas_files_paginate,
+                        poll_mcas_file_again,
+                        list(),
+                        list(),
+                        mcas.page_watermark(file_policy_triggers)
+                    )
+                )
+                if not poll_mcas_file_again:
+                    break
+        finally:
+            if not next_page.done():
+                next_page.cancel()
+
+        return new_record_count
+
+    async def sync_mcas_policy(self, box_mcas_classification: dict) -> int:
+        """
+        Syncs an MCAS DLP policy's triggers to Box file classifications. The policy's checkpoint only advances once a
+        page's records are committed. With watermark polling, only the files modified since the checkpointed watermark
+        are polled, and a full reconciliation scan by offset runs every reconcile_interval. Returns the number of new Box
+        classification records.
+        """
+        box_classification_name = box_mcas_classification["box_name"]
+        mcas_policy_id = box_mcas_classification["mcas_id"]
+        checkpoint_store = self._checkpoint_store
+
+        policy_checkpoint = checkpoint_store.get(mcas_policy_id)
+        if self._polling.mode != mcas_command.POLLING_WATERMARK:
+            return await self.sync_policy_pages(
+                box_classification_name,
+                mcas_policy_id,
+                policy_checkpoint.paginate,
+                None,
+                functools.partial(mcas_command.checkpoint_offset_page, checkpoint_store, mcas_policy_id)
+            )
+
+        if policy_checkpoint.watermark == datetime.datetime.min:
+            # Watermark polling starts from now, leaving the policy's earlier triggers to the reconciliation scan
+            policy_checkpoint = await self._run_sql(
+                functools.partial(
+                    checkpoint_store.set, mcas_policy_id, watermark=datetime.datetime.utcnow(), flush=True
+                )
+            )
+        new_record_count = await self.sync_policy_pages(
+            box_classification_name,
+            mcas_policy_id,
+            0,
+            policy_checkpoint.watermark - self._polling.watermark_overlap,
+            functools.partial(mcas_command.checkpoint_watermark_page, checkpoint_store, mcas_policy_id)
+        )
+
+        # A reconciliation scan in progress has a pagination value, and resumes from it
+        policy_checkpoint = checkpoint_store.get(mcas_policy_id)
+        if policy_checkpoint.paginate or (
+                datetime.datetime.utcnow() - policy_checkpoint.reconciled_at >= self._polling.reconcile_interval
+        ):
+            log.info(f"reconciling MCAS DLP ID {mcas_policy_id} from {policy_checkpoint.paginate}")
+            new_record_count += await self.sync_policy_pages(
+                box_classification_name,
+                mcas_policy_id,
+                policy_checkpoint.paginate,
+                None,
+                functools.partial(mcas_command.checkpoint_reconcile_page, checkpoint_store, mcas_policy_id)
+            )
+
+        return new_record_count
+
+    async def retry_failed_box_classification_applys(self) -> None:
+        """
+        Gets box_classification records with failed applys that are due a retry from a SQL database in chunks, and re
+        attempts to apply their Box file classifications
+        """
+        due_retry_records = self._box_classification_sql_manager.due_retry_records()
+        while True:
+            # Each chunk is a keyset paginated query run on the SQL thread
+            box_classification_records_batch = await self._run_sql(next, due_retry_records, None)
+            if box_classification_records_batch is None:
+                return
+
+            for box_classification_record in box_classification_records_batch:
+                box_classification_record.APPLY_ATTEMPTS += 1
+
+            await self.process_box_classification_records(box_classification_records_batch)
+
+    async def run(self, cycles: int = 0, cycle_profiler: Optional[profiling.CycleProfiler] = None) -> None:
+        """
+        Runs the sync loop, forever or for a number of cycles. Each MCAS DLP policy is polled on its own adaptive
+        interval and failed applys are retried every retry_interval. Up to the policy concurrency of polls and retries
+        run at once, and a policy's max_concurrency caps its in-flight Box classification applys. A cycle is done once
+        every policy has been polled and failed applys retried.
+        """
+        self._semaphore = aio.AsyncConcurrencyLimiter(self._concurrency)
+        aimd_controller = adaptive.configure_aimd_controller(
+            self._config, self._box_rate_limiters, {"asyncio": self._semaphore}
+        )
+        if aimd_controller:
+            self._box_client.add_response_observer(aimd_controller.observe)
+        sync_scheduler = scheduler.Scheduler()
+        schedule_config = scheduler.configure_schedule(self._config)
+        policies_config = (self._config.get("sync") or {}).get("policies") or {}
+        box_mcas_classifications = {
+            box_mcas_classification["mcas_id"]: box_mcas_classification
+            for box_mcas_classification in self._config["box"]["mcas_classifications"]
+        }
+        poll_intervals = dict()
+        poll_counts = {mcas_policy_id: 0 for mcas_policy_id in box_mcas_classifications}
+        retry_count = 0
+        running_tasks = dict()
+        for mcas_policy_id, box_mcas_classification in box_mcas_classifications.items():
+            max_concurrency = box_mcas_classification.get("max_concurrency", policies_config.get("max_concurrency"))
+            if max_concurrency:
+                self._policy_semaphores[mcas_policy_id] = asyncio.Semaphore(max_concurrency)
+            poll_intervals[mcas_policy_id] = scheduler.configure_poll_interval(self._config, box_mcas_classification)
+            processed_all_at = self._checkpoint_store.get(mcas_policy_id).processed_all_at
+            processed_ago = (datetime.datetime.utcnow() - processed_all_at).total_seconds()
+            sync_scheduler.schedule(
+                (mcas_command.POLL_TASK, mcas_policy_id), poll_intervals[mcas_policy_id].interval - processed_ago
+            )
+        sync_scheduler.schedule(mcas_command.RETRY_TASK)
+
+        try:
+            while not cycles or retry_count < cycles or min(poll_counts.values(), default=cycles) < cycles:
+                # Wait for the next task to fall due, unless every policy slot is busy, or for a running task to complete
+                due_in = sync_scheduler.due_in() if len(running_tasks) < self._policy_concurrency else None
+                if running_tasks:
+                    completed_tasks, _ = await asyncio.wait(
+                        running_tasks, timeout=due_in, return_when=asyncio.FIRST_COMPLETED
+                    )
+                else:
+                    completed_tasks = set()
+                    if due_in:
+                        log.debug(f"sleeping {due_in:.1f} seconds until the next scheduled task")
+                        await asyncio.sleep(due_in)
+
+                for completed_task in completed_tasks:
+                    task = running_tasks.pop(completed_task)
+                    if task == mcas_command.RETRY_TASK:
+                        try:
+                            completed_task.result()
+                        except Exception as e:
+                            log.error(f"failed to retry failed Box classification applys with {e}")
+                        retry_count += 1
+                        sync_scheduler.schedule(mcas_command.RETRY_TASK, schedule_config["retry_interval"])
+                        continue
+
+                    mcas_policy_id = task[1]
+                    box_classification_name = box_mcas_classifications[mcas_policy_id]["box_name"]
+                    new_record_count = 0
+                    try:
+                        new_record_count = completed_task.result()
+                    except Exception as e:
+                        log.error(f"failed to sync MCAS DLP ID {mcas_policy_id} for Box classification {box_classification_name} with {e}")
+                    poll_counts[mcas_policy_id] += 1
+                    poll_interval = poll_intervals[mcas_policy_id].update(new_record_count)
+                    sync_scheduler.schedule(task, poll_interval)
+                    log.debug(f"polling MCAS DLP ID {mcas_policy_id} again in {poll_interval:.0f} seconds after {new_record_count} new triggers")
+                if cycle_profiler and min([retry_count] + list(poll_counts.values())) >= cycle_profiler.cycle:
+                    cycle_profiler.end_cycle()
+                if completed_tasks or len(running_tasks) >= self._policy_concurrency:
+                    continue
+
+                task = sync_scheduler.pop_due()
+                if task is None:
+                    continue
+
+                if task == mcas_command.RETRY_TASK:
+                    # Retry failed Box classification apply tasks from SQL records
+                    running_tasks[asyncio.ensure_future(self.retry_failed_box_classification_applys())] = task
+                else:
+                    # Get a MCAS policy from configuration
+                    running_tasks[asyncio.ensure_future(
+                        self.sync_mcas_policy(box_mcas_classifications[task[1]])
+                    )] = task
+        finally:
+            if running_tasks:
+                await asyncio.wait(running_tasks)
+
+    async def close(self) -> None:
+        """
+        Closes the HTTP sessions and the SQL thread
+        """
+        await self._mcas_client.close()
+        await self._box_client.close()
+        self._sql_executor.shutdown()
@@ -5,10 +5,11 @@ Click commands for interfacing with a box_classification SQL table
 import logging
 
 import click
-from sqlalchemy_utils import create_database
 
 from src import config
-from src.sql.models.box_classification import BoxClassification
+from src.sql.models.box_classification import BoxClassification, BoxClassificationSQLManager
+# Imported to register their tables with the SQL model metadata
+from src.sql.models import box_user, mcas_policy_checkpoint, sync_lease  # noqa: F401
 from src.sql import sql
 
 
@@ -24,6 +25,9 @@ def sql_create_database(env, config):
     """
     Creates a SQL database
     """
+    # Imported on demand as sqlalchemy_utils is slow to import and only needed here
+    from sqlalchemy_utils import create_database
+
     sql.configure_connection(config)
     create_database(sql.connection.url)
     log.info("Created SQL box_mcas database")
@@ -36,13 +40,54 @@ def sql_create_database(env, config):
 @config.config_env
 def sql_create_table(env, config):
     """
-    Creates a SQL box_classification table
+    Creates the SQL box_classification, box_user and mcas_policy_checkpoint tables
     """
     sql.configure_connection(config)
     sql.model.metadata.create_all(sql.connection)
     log.info("Created SQL classification_assign table")
 
 
+@click.command()
+@click.option(
+    "-e", "--env", default="prod", help="env environment alias", type=str,
+)
+@click.option(
+    "-y", "--yes", is_flag=True, help="delete duplicate box_classification records without asking for confirmation",
+)
+@config.config_env
+def sql_migrate(env, yes, config):
+    """
+    Migrates existing SQL tables to the current models. Creates missing tables and columns, deletes duplicate
+    box_classification records once confirmed, then creates missing indexes. Safe to run more than once.
+    """
+    sql.configure_connection(config)
+    sql.model.metadata.create_all(sql.connection)
+    for table in sql.model.metadata.sorted_tables:
+        sql.add_missing_columns(sql.connection, table)
+
+    # The unique box_classification key index can only be created once duplicate records are gone
+    box_classification_sql_manager = BoxClassificationSQLManager(sql.connection)
+    duplicate_count = box_classification_sql_manager.count_duplicates()
+    if duplicate_count:
+        log.info(f"found {duplicate_count} duplicate box_classification records")
+        while not yes:
+            y_n = input(
+                f"\nAre you sure you want to delete {duplicate_count} duplicate SQL box_classification records? (Y/N): "
+            ).lower()
+            if y_n == "y":
+                break
+            elif y_n == "n":
+                log.info("Kept duplicate box_classification records, so missing indexes were not created")
+                exit()
+            else:
+                print("Invalid input")
+        box_classification_sql_manager.delete_duplicates()
+    for table in sql.model.metadata.sorted_tables:
+        sql.bound_indexed_columns(sql.connection, table)
+        sql.create_missing_indexes(sql.connection, table)
+    log.info("Migrated SQL tables")
+
+
 @click.command()
 @click.option(
     "-e", "--env", default="prod", help="env environment alias", type=str,
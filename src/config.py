@@ -5,20 +5,37 @@ Configuration utilities
 import logging.config
 import logging
 import os
+import copy
 import functools
-from typing import Callable
+import json
+from typing import Callable, Dict, Optional, Tuple
 
 import yaml
 
+from src import log_utils
+
 
 log = logging.getLogger(__name__)
 
+# Parsed configuration files by path, with the modification time they were parsed at
+_loaded_configurations: Dict[str, Tuple[int, dict]] = dict()
+# The "log" section last applied by configure_logging, as sorted JSON
+_configured_logging: Optional[str] = None
+
 
 def configure_logging(configuration: dict) -> None:
     """
-    Writes log files and configures logging from a configuration dictionary
+    Writes log files and configures logging from a configuration dictionary. If the "log" section sets queue to true,
+    the handlers of the root logger and the configured loggers run on background threads. Applying the same "log"
+    section again is skipped.
     """
-    log_dict_config = configuration["log"]
+    global _configured_logging
+    logging_key = json.dumps(configuration["log"], sort_keys=True, default=str)
+    if logging_key == _configured_logging:
+        return
+
+    log_dict_config = dict(configuration["log"])
+    queue_logging = log_dict_config.pop("queue", False)
     for handler_alias, handler_config in log_dict_config["handlers"].items():
         if "filename" in handler_config.keys():
             log_file_path = os.path.join(
@@ -33,26 +50,40 @@ def configure_logging(configuration: dict) -> None:
 
             handler_config["filename"] = log_file_path
 
+    log_utils.stop_queue_logging()
     logging.config.dictConfig(log_dict_config)
+    if queue_logging:
+        log_utils.configure_queue_logging(list(log_dict_config.get("loggers", {})))
+    _configured_logging = logging_key
     log.debug(f"configured logging")
 
 
 def load_configuration(env_alias: str) -> dict:
     """
-    Loads a YAML configuration file from its environment name alias
+    Loads a YAML configuration file from its environment name alias, or from a path to a .yml or .yaml file. A file
+    is only parsed again once it changes, and each caller gets its own copy of the configuration.
     """
-    with open(
-        os.path.join(
+    if env_alias.endswith((".yml", ".yaml")):
+        config_path = env_alias
+    else:
+        config_path = os.path.join(
             os.path.dirname(__file__),
             "..",
             "configuration",
             f"{env_alias}.yml",
-        ),
-        "r",
-    ) as fh:
-        config = yaml.load(fh, Loader=yaml.FullLoader)
+        )
+
+    config_path = os.path.abspath(config_path)
+    modified_at = os.stat(config_path).st_mtime_ns
+    loaded_configuration = _loaded_configurations.get(config_path)
+    if loaded_configuration is None or loaded_configuration[0] != modified_at:
+        with open(config_path, "r") as fh:
+            # The libyaml parser is used when PyYAML was built with it
+            config = yaml.load(fh, Loader=getattr(yaml, "CFullLoader", yaml.FullLoader))
+        _loaded_configurations[config_path] = (modified_at, config)
         log.debug("loaded configuration")
-        return config
+
+    return copy.deepcopy(_loaded_configurations[config_path][1])
 
 
 def write_configuration(env_alias: str, config_dict: dict) -> None:
@@ -4,48 +4,186 @@ HTTP utilities
 
 from __future__ import annotations
 from collections import deque
+import logging
+import threading
 import time
+from typing import Callable, Dict, List, Mapping, Optional
 
-from src import thread
+from src import metrics
+
+
+log = logging.getLogger(__name__)
+
+
+# Rate limited endpoint aliases. Budgets for each alias are read from the configuration "rate_limits" section.
+MCAS_FILES = "mcas_files"
+BOX_FILE_GET = "box_file_get"
+BOX_CLASSIFICATION_PUT = "box_classification_put"
+BOX_USER_GET = "box_user_get"
+
+RATE_LIMIT_DEFAULTS = {
+    MCAS_FILES: {"calls_per_second": 15, "burst": 1},
+    BOX_FILE_GET: {"calls_per_second": 12, "burst": 1},
+    BOX_CLASSIFICATION_PUT: {"calls_per_second": 12, "burst": 1},
+    BOX_USER_GET: {"calls_per_second": 12, "burst": 1},
+}
+
+# Called after every HTTP response with its latency in seconds, its status, or None on a connection error, and its
+# Retry-After delay in seconds, if any
+ResponseObserver = Callable[[float, Optional[int], Optional[float]], None]
+
+
+def parse_retry_after(headers: Mapping) -> Optional[float]:
+    """
+    Returns the seconds delay of a response's Retry-After header, or None if it has no delay in seconds
+    """
+    retry_after = headers.get("Retry-After")
+    if not retry_after:
+        return None
+
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        return None
 
 
 class RateLimiter:
     """
-    HTTP rate limiter
+    Thread safe token bucket HTTP rate limiter. Tokens refill continuously at rate_limit tokens per second up to a
+    bucket size of burst. Callers waiting on a token block on a condition variable until the exact time the next token
+    is available, and are released in FIFO order. A named rate limiter records its wait time, waiters and rate limit as
+    metrics.
     """
-    def __init__(self, rate_limit: int = 15) -> RateLimiter:
-        self._rate_limit: int = rate_limit
-        self._request_times: deque = deque()
+    def __init__(self, rate_limit: float = 15, burst: int = 1, name: Optional[str] = None) -> RateLimiter:
+        if rate_limit <= 0:
+            raise ValueError("rate_limit must be greater than 0")
 
-    @thread.thread_safe
-    def rate_limit(self) -> None:
+        self._rate_limit: float = float(rate_limit)
+        self._burst: int = max(1, int(burst))
+        self._tokens: float = float(self._burst)
+        self._refilled_at: float = time.monotonic()
+        self._lock: threading.Lock = threading.Lock()
+        self._waiters: deque = deque()
+        self._wait_seconds: Optional[metrics.Counter] = None
+        if name:
+            self._wait_seconds = metrics.registry.counter(
+                "rate_limiter_wait_seconds_total", "Seconds spent waiting for a rate limiter token", {"endpoint": name}
+            )
+            metrics.registry.gauge(
+                "rate_limiter_waiters", "Callers waiting for a rate limiter token", {"endpoint": name}
+            ).set_function(lambda: len(self._waiters))
+            metrics.registry.gauge(
+                "rate_limiter_calls_per_second", "Rate limit in calls per second", {"endpoint": name}
+            ).set_function(lambda: self._rate_limit)
+
+    @property
+    def calls_per_second(self) -> float:
         """
-        Thread safe method that returns when the next rate limited HTTP call can be made
+        Current rate limit in calls per second
         """
-        while True:
-            now = time.time()
+        return self._rate_limit
 
-            while self._request_times:
-                if now - self._request_times[0] > 1:
-                    self._request_times.popleft()
-                else:
-                    break
+    def set_rate(self, calls_per_second: float) -> None:
+        """
+        Changes the rate limit. Tokens accrued at the old rate are kept, and the caller at the head of the queue
+        re-times its wait for the next token at the new rate.
+        """
+        if calls_per_second <= 0:
+            raise ValueError("calls_per_second must be greater than 0")
 
-            if len(self._request_times) < self._rate_limit:
-                break
+        with self._lock:
+            self._refill()
+            self._rate_limit = float(calls_per_second)
+            if self._waiters:
+                self._waiters[0].notify()
 
-            time.sleep(0.00001)
+    @property
+    def burst(self) -> int:
+        """
+        Configured token bucket size
+        """
+        return self._burst
 
-        self._request_times.append(time.time())
+    def _refill(self) -> None:
+        """
+        Adds the tokens accrued since the last refill to the bucket. Must be called with the lock held.
+        """
+        now = time.monotonic()
+        self._tokens = min(self._burst, self._tokens + (now - self._refilled_at) * self._rate_limit)
+        self._refilled_at = now
+
+    def rate_limit(self) -> float:
+        """
+        Thread safe method that returns when the next rate limited HTTP call can be made. Returns the seconds spent
+        waiting.
+        """
+        started_at = time.monotonic()
+        with self._lock:
+            waiter = threading.Condition(self._lock)
+            self._waiters.append(waiter)
+            try:
+                while True:
+                    if self._waiters[0] is waiter:
+                        self._refill()
+                        if self._tokens >= 1:
+                            self._tokens -= 1
+                            break
+
+                        # Sleep until the exact time the next token is available
+                        waiter.wait((1 - self._tokens) / self._rate_limit)
+                    else:
+                        # Sleep until the waiter ahead in the queue is released
+                        waiter.wait()
+            finally:
+                is_head = self._waiters[0] is waiter
+                self._waiters.remove(waiter)
+                if is_head and self._waiters:
+                    self._waiters[0].notify()
+
+        waited = time.monotonic() - started_at
+        if self._wait_seconds is not None:
+            self._wait_seconds.inc(waited)
+
+        return waited
 
     def __enter__(self) -> None:
         """
         Context manager entry
         """
-        return self.rate_limit()
+        self.rate_limit()
 
     def __exit__(self, exc_type, exc_val, exc_tb) -> None:
         """
         Context manager exit
         """
         pass
+
+
+def configure_rate_limiter(config: dict, endpoint_alias: str) -> RateLimiter:
+    """
+    Instantiates a RateLimiter for an endpoint alias from the configuration dictionary "rate_limits" section, falling
+    back to the endpoint's default budget
+    """
+    rate_limit_config = dict(RATE_LIMIT_DEFAULTS.get(endpoint_alias, {}))
+    rate_limit_config.update((config.get("rate_limits") or {}).get(endpoint_alias) or {})
+    rate_limiter = RateLimiter(
+        rate_limit_config.get("calls_per_second", 15),
+        rate_limit_config.get("burst", 1),
+        endpoint_alias,
+    )
+    log.debug(
+        f"configured {endpoint_alias} rate limiter at {rate_limiter.calls_per_second} calls per second with burst "
+        f"{rate_limiter.burst}"
+    )
+
+    return rate_limiter
+
+
+def configure_rate_limiters(config: dict, endpoint_aliases: List[str]) -> Dict[str, RateLimiter]:
+    """
+    Instantiates a dictionary of endpoint alias to RateLimiter from a configuration dictionary
+    """
+    return {
+        endpoint_alias: configure_rate_limiter(config, endpoint_alias)
+        for endpoint_alias in endpoint_aliases
+    }
@@ -0,0 +1,257 @@
+"""
+Sharding of the MCAS DLP policy trigger to Box file classification sync across worker processes with SQL work leases
+"""
+
+from __future__ import annotations
+import logging
+import math
+import os
+import socket
+import threading
+import time
+import uuid
+import zlib
+from typing import Dict, FrozenSet, List, NamedTuple, Optional
+
+from src import checkpoint
+from src import metrics
+from src.sql.models.sync_lease import SyncLease, SyncLeaseSQLManager, SyncWorker, SyncWorkerSQLManager
+
+
+log = logging.getLogger(__name__)
+
+
+class Shard(NamedTuple):
+    """
+    A unit of sync work. An MCAS DLP policy's triggers, or when policies are split by Box file owner, the triggers of
+    the owners that hash to owner_shard.
+    """
+    mcas_policy_id: str
+    owner_shard: int = 0
+    owner_shard_count: int = 1
+
+    @property
+    def shard_id(self) -> str:
+        """
+        Lease and checkpoint key of the shard. A policy that is not split by owner keeps the policy ID as its key.
+        """
+        if self.owner_shard_count == 1:
+            return self.mcas_policy_id
+
+        return f"{self.mcas_policy_id}/{self.owner_shard}-of-{self.owner_shard_count}"
+
+    def owns(self, mcas_policy_id: str, box_file_owner: Optional[str]) -> bool:
+        """
+        Returns True if a trigger of an MCAS DLP policy for a file with a Box file owner belongs to the shard
+        """
+        return mcas_policy_id == self.mcas_policy_id and (
+            self.owner_shard_count == 1
+            or owner_shard_of(box_file_owner, self.owner_shard_count) == self.owner_shard
+        )
+
+
+def owner_shard_of(box_file_owner: Optional[str], owner_shard_count: int) -> int:
+    """
+    Returns the owner shard of a Box file owner's login. Uses CRC32 rather than hash(), which is salted per process.
+    """
+    return zlib.crc32((box_file_owner or "").lower().encode("utf-8")) % owner_shard_count
+
+
+def configure_shards(config: dict) -> List[Shard]:
+    """
+    Returns the shards of the MCAS DLP policies in a configuration dictionary. Each policy is split into the "sharding"
+    settings' owner_shards shards by Box file owner, or is a single shard by default.
+    """
+    owner_shard_count = max(1, ((config.get("sync") or {}).get("sharding") or {}).get("owner_shards", 1))
+
+    return [
+        Shard(box_mcas_classification["mcas_id"], owner_shard, owner_shard_count)
+        for box_mcas_classification in config["box"]["mcas_classifications"]
+        for owner_shard in range(owner_shard_count)
+    ]
+
+
+def seed_shard_checkpoints(checkpoint_store: checkpoint.CheckpointStore, shards: List[Shard]) -> None:
+    """
+    Seeds the checkpoints of owner shards without one from their MCAS DLP policy's checkpoint, so splitting a policy
+    by Box file owner does not poll its triggers again from the start
+    """
+    for shard in shards:
+        if shard.shard_id not in checkpoint_store and shard.mcas_policy_id in checkpoint_store:
+            policy_checkpoint = checkpoint_store.get(shard.mcas_policy_id)
+            checkpoint_store.set(
+                shard.shard_id,
+                policy_checkpoint.paginate,
+                policy_checkpoint.processed_all_at,
+                watermark=policy_checkpoint.watermark,
+                reconciled_at=policy_checkpoint.reconciled_at
+            )
+            log.info(f"seeded checkpoint for shard {shard.shard_id} from MCAS DLP ID {shard.mcas_policy_id}")
+
+
+def configure_lease_keeper(config: dict, sql_connection) -> LeaseKeeper:
+    """
+    Configures and starts a LeaseKeeper from the "sharding" settings of a configuration dictionary's "sync" section
+    """
+    sharding_config = (config.get("sync") or {}).get("sharding") or {}
+    SyncLease.__table__.create(sql_connection, checkfirst=True)
+    SyncWorker.__table__.create(sql_connection, checkfirst=True)
+    lease_keeper = LeaseKeeper(
+        SyncLeaseSQLManager(sql_connection),
+        SyncWorkerSQLManager(sql_connection),
+        configure_shards(config),
+        sharding_config.get("lease_ttl", 60),
+        sharding_config.get("heartbeat_interval"),
+        sharding_config.get("max_shards"),
+        rebalance_interval=sharding_config.get("rebalance_interval"),
+    )
+
+    return lease_keeper.start()
+
+
+class LeaseKeeper:
+    """
+    Holds a sync worker's SQL work leases. The worker registers itself and renews its leases from a heartbeat thread.
+    Every rebalance_interval seconds, rebalance claims unowned and expired shards up to the worker's fair share of the
+    shards among the live workers, and releases shards above it, so shards spread out as workers join and a crashed
+    worker's shards are picked up once its leases expire.
+
+    A lease is only trusted until lease_ttl seconds after its last successful renewal, so a worker cut off from the
+    database stops syncing its shards before another worker can claim them. API rate limits are per worker process.
+    """
+
+    def __init__(
+            self,
+            lease_sql_manager: SyncLeaseSQLManager,
+            worker_sql_manager: SyncWorkerSQLManager,
+            shards: List[Shard],
+            lease_ttl: float = 60,
+            heartbeat_interval: Optional[float] = None,
+            max_shards: Optional[int] = None,
+            worker_id: Optional[str] = None,
+            rebalance_interval: Optional[float] = None
+    ) -> LeaseKeeper:
+        self._lease_sql_manager: SyncLeaseSQLManager = lease_sql_manager
+        self._worker_sql_manager: SyncWorkerSQLManager = worker_sql_manager
+        self._shards: Dict[str, Shard] = {shard.shard_id: shard for shard in shards}
+        self._lease_ttl: float = lease_ttl
+        self._heartbeat_interval: float = heartbeat_interval or lease_ttl / 3
+        self._max_shards: Optional[int] = max_shards
+        self.rebalance_interval: float = rebalance_interval or lease_ttl
+        self._hostname: str = socket.gethostname()
+        self.worker_id: str = worker_id or f"{self._hostname}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        # Guards the SQL managers' sessions, which are shared by the sync and heartbeat threads. The held shard IDs are
+        # only ever replaced, never mutated, so they are read without waiting on SQL calls.
+        self._lock: threading.RLock = threading.RLock()
+        self._held: FrozenSet[str] = frozenset()
+        self._valid_until: float = 0
+        self._stopped: threading.Event = threading.Event()
+        self._heartbeat_thread: Optional[threading.Thread] = None
+        metrics.registry.gauge(
+            "sync_leases_held", "Sync shard leases held by this worker"
+        ).set_function(lambda: len(self.held_shards))
+
+    @property
+    def held_shards(self) -> List[Shard]:
+        """
+        Shards whose lease the worker holds and trusts, in shard ID order
+        """
+        held, valid_until = self._held, self._valid_until
+        if time.monotonic() >= valid_until:
+            return list()
+
+        return [self._shards[shard_id] for shard_id in sorted(held)]
+
+    def holds(self, shard: Shard) -> bool:
+        """
+        Returns True if the worker holds and trusts a shard's lease
+        """
+        return shard.shard_id in self._held and time.monotonic() < self._valid_until
+
+    def start(self) -> LeaseKeeper:
+        """
+        Registers the worker and its shards, claims its share of the shards and starts the heartbeat thread
+        """
+        with self._lock:
+            self._lease_sql_manager.add_shards(self._shards)
+            self._worker_sql_manager.heartbeat(self.worker_id, self._hostname, os.getpid(), self._lease_ttl)
+            self._valid_until = time.monotonic() + self._lease_ttl
+        self.rebalance()
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat_forever, name="lease-heartbeat", daemon=True)
+        self._heartbeat_thread.start()
+        log.info(f"started sync worker {self.worker_id} with {len(self._shards)} shards")
+
+        return self
+
+    def heartbeat(self) -> None:
+        """
+        Extends the worker's registration and the leases it still holds. Leases claimed by another worker after they
+        expired are dropped.
+        """
+        with self._lock:
+            renewing_at = time.monotonic()
+            self._worker_sql_manager.heartbeat(self.worker_id, self._hostname, os.getpid(), self._lease_ttl)
+            held = frozenset(
+                self._lease_sql_manager.renew(self.worker_id, self._held, self._lease_ttl) & set(self._shards)
+            )
+            for shard_id in self._held - held:
+                log.warning(f"sync worker {self.worker_id} lost the lease of shard {shard_id}")
+            self._held = held
+            self._valid_until = renewing_at + self._lease_ttl
+
+    def _heartbeat_forever(self) -> None:
+        """
+        Heartbeats every heartbeat_interval seconds until the worker stops
+        """
+        while not self._stopped.wait(self._heartbeat_interval):
+            try:
+                self.heartbeat()
+            except Exception as e:
+                self._lease_sql_manager.session.rollback()
+                self._worker_sql_manager.session.rollback()
+                log.error(f"failed to heartbeat sync worker {self.worker_id} leases with {e}")
+
+    def rebalance(self) -> List[Shard]:
+        """
+        Claims unowned and expired shards up to the worker's fair share of the shards among the live workers, and
+        releases the shards above it. Returns the shards the worker holds.
+        """
+        with self._lock:
+            self.heartbeat()
+            self._worker_sql_manager.delete_expired()
+            live_worker_count = max(1, self._worker_sql_manager.live_worker_count())
+            fair_share = math.ceil(len(self._shards) / live_worker_count)
+            if self._max_shards:
+                fair_share = min(fair_share, self._max_shards)
+
+            surplus_shard_ids = sorted(self._held)[fair_share:]
+            if surplus_shard_ids:
+                self._lease_sql_manager.release(self.worker_id, surplus_shard_ids)
+                self._held = self._held.difference(surplus_shard_ids)
+
+            for shard_id in self._lease_sql_manager.claimable_shard_ids(self._shards):
+                if len(self._held) >= fair_share:
+                    break
+                if self._lease_sql_manager.claim(shard_id, self.worker_id, self._lease_ttl):
+                    self._held = self._held.union([shard_id])
+                    log.info(f"sync worker {self.worker_id} claimed shard {shard_id}")
+
+            log.info(
+                f"sync worker {self.worker_id} holds {len(self._held)} of {len(self._shards)} shards "
+                f"with {live_worker_count} live workers"
+            )
+
+        return self.held_shards
+
+    def stop(self) -> None:
+        """
+        Stops heartbeating, releases the worker's leases and unregisters the worker
+        """
+        self._stopped.set()
+        if self._heartbeat_thread:
+            self._heartbeat_thread.join()
+        with self._lock:
+            self._lease_sql_manager.release(self.worker_id, self._held)
+            self._held = frozenset()
+            self._worker_sql_manager.unregister(self.worker_id)
+        log.info(f"stopped sync worker {self.worker_id}")
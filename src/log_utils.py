@@ -0,0 +1,166 @@
+"""
+Logging utilities
+"""
+
+from __future__ import annotations
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+from typing import Dict, List, Tuple, Union
+
+
+log = logging.getLogger(__name__)
+
+# Listeners started by configure_queue_logging, stopped when logging is configured again
+_queue_listeners: List[logging.handlers.QueueListener] = list()
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Rate limits each type of log message to burst records every interval seconds. A message type is a logger and an
+    unformatted %-style message, so per record messages must pass their values as arguments rather than as f-strings to
+    be sampled. Suppressed records are counted and reported on the next record of their type let through. Records
+    above max_level, and records outside the filter's logger name, are never suppressed. A record's sampling decision
+    is kept on the record, so a filter shared by several handlers counts each record once.
+    """
+
+    def __init__(
+            self,
+            burst: int = 10,
+            interval: float = 1.0,
+            max_level: Union[int, str] = logging.INFO,
+            max_message_types: int = 10000,
+            name: str = ""
+    ) -> SamplingFilter:
+        super().__init__(name)
+        self._burst: int = burst
+        self._interval: float = interval
+        self._max_level: int = logging._checkLevel(max_level)
+        self._max_message_types: int = max_message_types
+        # Message type to the start of its current window, the records let through in it and the records suppressed
+        self._windows: Dict[Tuple[str, str], List[float]] = dict()
+        self._lock: threading.Lock = threading.Lock()
+
+    @property
+    def max_level(self) -> int:
+        """
+        Highest level of the records the filter may suppress
+        """
+        return self._max_level
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > self._max_level or not super().filter(record):
+            return True
+        if hasattr(record, "sampled"):
+            return record.sampled
+
+        record.sampled = self._sample(record)
+
+        return record.sampled
+
+    def _sample(self, record: logging.LogRecord) -> bool:
+        """
+        Counts a record against its message type's window. Returns False if the record is suppressed.
+        """
+        message_type = (record.name, str(getattr(record, "template", record.msg)))
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(message_type)
+            if window is None:
+                if len(self._windows) >= self._max_message_types:
+                    # Unsampleable f-string messages would otherwise grow the windows without bound
+                    self._windows.clear()
+                window = self._windows[message_type] = [now, 0, 0]
+            elif now - window[0] >= self._interval:
+                window[0], window[1] = now, 0
+
+            if window[1] >= self._burst:
+                window[2] += 1
+                return False
+
+            window[1] += 1
+            suppressed_count, window[2] = window[2], 0
+
+        if suppressed_count:
+            record.msg = f"{record.msg} [{suppressed_count} similar messages suppressed]"
+
+        return True
+
+
+class TemplateQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that keeps a record's unformatted message as its template, so a SamplingFilter left on a
+    QueueListener's handlers still sees the record's message type
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        template = record.msg
+        record = super().prepare(record)
+        record.template = template
+
+        return record
+
+
+def queue_sampling_filters(handlers: List[logging.Handler]) -> List[SamplingFilter]:
+    """
+    Returns the SamplingFilters of a list of handlers that can run before records are queued for them. A filter can if
+    every handler either carries it, or only handles records above its max_level, which it never suppresses.
+    """
+    sampling_filters = list()
+    for handler in handlers:
+        for handler_filter in handler.filters:
+            if isinstance(handler_filter, SamplingFilter) and handler_filter not in sampling_filters:
+                sampling_filters.append(handler_filter)
+
+    return [
+        sampling_filter
+        for sampling_filter in sampling_filters
+        if all(
+            sampling_filter in handler.filters or handler.level > sampling_filter.max_level
+            for handler in handlers
+        )
+    ]
+
+
+def configure_queue_logging(logger_names: List[str]) -> List[logging.handlers.QueueListener]:
+    """
+    Moves the handlers of the root logger and a list of named loggers behind a TemplateQueueHandler each, so handler
+    I/O runs on a background QueueListener thread rather than under the handler locks of the logging threads. The
+    queue handler still formats each record's message on the logging thread, so SamplingFilters that can run before
+    queuing are moved onto it, and suppressed records are never formatted or queued. The listeners are stopped,
+    flushing queued records, at exit.
+    """
+    stop_queue_logging()
+    for logger in [logging.getLogger()] + [logging.getLogger(logger_name) for logger_name in logger_names]:
+        handlers = list(logger.handlers)
+        if not handlers:
+            continue
+
+        log_queue = queue.Queue()
+        queue_handler = TemplateQueueHandler(log_queue)
+        for sampling_filter in queue_sampling_filters(handlers):
+            queue_handler.addFilter(sampling_filter)
+            for handler in handlers:
+                handler.removeFilter(sampling_filter)
+        for handler in handlers:
+            logger.removeHandler(handler)
+        logger.addHandler(queue_handler)
+        queue_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        queue_listener.start()
+        _queue_listeners.append(queue_listener)
+
+    log.debug(f"moved {len(_queue_listeners)} loggers' handlers to background threads")
+
+    return list(_queue_listeners)
+
+
+@atexit.register
+def stop_queue_logging() -> None:
+    """
+    Stops the background QueueListener threads once they have handled every queued record
+    """
+    while _queue_listeners:
+        _queue_listeners.pop().stop()
@@ -2,16 +2,69 @@
 Application entry point
 """
 
+import importlib
+from typing import Dict, Optional, Tuple
+
 import click
 
-from src.commands import (
-    mcas,
-    sql,
-    process
-)
 
+# Command name to the "module:attribute" path of its Click command and its short help. Command modules import heavy
+# SDKs such as boxsdk, SQLAlchemy and psutil, so a module is only imported when one of its commands is run.
+COMMANDS: Dict[str, Tuple[str, str]] = {
+    "mcas-policy-box-classification-sync": (
+        "src.commands.mcas:mcas_policy_box_classification_sync",
+        "Click CLI command to sync MCAS DLP policy trigger events with Box file classifications",
+    ),
+    "sql-create-database": ("src.commands.sql:sql_create_database", "Creates a SQL database"),
+    "sql-create-table": (
+        "src.commands.sql:sql_create_table",
+        "Creates the SQL box_classification, box_user and mcas_policy_checkpoint tables",
+    ),
+    "sql-migrate": ("src.commands.sql:sql_migrate", "Migrates existing SQL tables to the current models"),
+    "sql-drop-table": ("src.commands.sql:sql_drop_table", "Drops a SQL box_classification table"),
+    "kill-pythonw-process": (
+        "src.commands.process:kill_pythonw_process",
+        "Click command to kill pythonw.exe Windows Python background process",
+    ),
+}
+
+
+class LazyGroup(click.Group):
+    """
+    Click group that imports a command's module only when the command is run. Command listings use the registered
+    short help, so --help imports no command module.
+    """
+
+    def __init__(self, *args, lazy_commands: Optional[Dict[str, Tuple[str, str]]] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lazy_commands: Dict[str, Tuple[str, str]] = dict(lazy_commands or {})
+
+    def list_commands(self, ctx: click.Context) -> list:
+        return sorted(set(super().list_commands(ctx)) | set(self.lazy_commands))
 
-@click.group()
+    def get_command(self, ctx: click.Context, cmd_name: str) -> Optional[click.Command]:
+        if cmd_name not in self.commands and cmd_name in self.lazy_commands:
+            module_name, attribute_name = self.lazy_commands[cmd_name][0].split(":")
+            self.add_command(getattr(importlib.import_module(module_name), attribute_name), cmd_name)
+
+        return super().get_command(ctx, cmd_name)
+
+    def format_commands(self, ctx: click.Context, formatter: click.HelpFormatter) -> None:
+        rows = list()
+        for cmd_name in self.list_commands(ctx):
+            if cmd_name in self.commands:
+                if self.commands[cmd_name].hidden:
+                    continue
+                rows.append((cmd_name, self.commands[cmd_name].get_short_help_str(formatter.width)))
+            else:
+                rows.append((cmd_name, self.lazy_commands[cmd_name][1]))
+
+        if rows:
+            with formatter.section("Commands"):
+                formatter.write_dl(rows)
+
+
+@click.group(cls=LazyGroup, lazy_commands=COMMANDS)
 def cli() -> None:
     """
     Click application group to support multiple commands
@@ -21,18 +74,8 @@ def cli() -> None:
 
 def main() -> None:
     """
-    Main application function. Registers Click CLI commands to a group, then runs the Click application.
+    Main application function. Runs the Click application, whose commands are imported on demand.
     """
-    commands = [
-        mcas.mcas_policy_box_classification_sync,
-        sql.sql_create_database,
-        sql.sql_create_table,
-        sql.sql_drop_table,
-        process.kill_pythonw_process
-    ]
-    for command in commands:
-        cli.add_command(command)
-
     cli()
 
 
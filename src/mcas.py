@@ -2,61 +2,406 @@
 Microsoft Cloud App Security API utilities
 """
 
+from __future__ import annotations
+import codecs
+import datetime
 import json
 import logging
-from typing import Optional, Tuple
+from typing import Any, Iterator, List, NamedTuple, Optional, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from src import http_utils
+from src import metrics
 
 
 log = logging.getLogger(__name__)
 
 
-def poll_files(
-        subdomain: str,
-        api_token: str,
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+page_fetch_seconds = metrics.registry.histogram(
+    "mcas_page_fetch_seconds", "MCAS files page request latency, excluding rate limiter waits"
+)
+
+
+class FilesPage(NamedTuple):
+    """
+    A parsed page of MCAS DLP policy triggers from the MCAS files endpoint, whether there is another page, and the skip
+    offset of the next page
+    """
+    policy_triggers: List[dict]
+    poll_again: bool
+    paginate: int
+
+
+def mcas_base_url(mcas_config: dict) -> str:
+    """
+    Returns the MCAS API base URL of the tenant in an "mcas" configuration section, or its base_url override
+    """
+    return mcas_config.get("base_url") or f"https://{mcas_config['subdomain']}.portal.cloudappsecurity.com"
+
+
+def configure_mcas_client(config: dict) -> MCASClient:
+    """
+    Configures a Microsoft Cloud App Security REST client from a configuration dictionary
+    """
+    mcas_config = config["mcas"]
+    mcas_client = MCASClient(
+        mcas_config.get("subdomain"),
+        mcas_config["api_token"],
+        http_utils.configure_rate_limiter(config, http_utils.MCAS_FILES),
+        pool_size=mcas_config.get("pool_size", 10),
+        connect_timeout=mcas_config.get("connect_timeout", 10),
+        read_timeout=mcas_config.get("read_timeout", 60),
+        retries=mcas_config.get("retries", 5),
+        backoff_factor=mcas_config.get("backoff_factor", 1),
+        limit=mcas_config.get("limit"),
+        stream=mcas_config.get("stream", False),
+        stream_chunk_size=mcas_config.get("stream_chunk_size", 100),
+        base_url=mcas_base_url(mcas_config),
+    )
+
+    return mcas_client
+
+
+def files_request_body(
         mcas_policy_id: str,
-        paginate: int,
-        rate_limiter: http_utils.RateLimiter,
-) -> Tuple[requests.Response, bool, int]:
-    """
-    Polls the MCAS files endpoint while enforcing rate limits
-    """
-    poll_mcas_file_again = False
-    try:
-        with rate_limiter:
-            mcas_post_files_body = {"filters": {
-                "fileType": {"neq": [6]},
-                "policy": {"cabinetmatchedrulesequals": [mcas_policy_id]}
-            }}
-            response = post_files(
-                subdomain, api_token, paginate, mcas_post_files_body,
-            )
-            log.debug(f"got MCAS files response {response}")
-            mcas_post_files_resp_json = json.loads(response.content)
-            if mcas_post_files_resp_json.get("hasNext"):
-                poll_mcas_file_again = True
-                paginate += 1
+        limit: Optional[int] = None,
+        modified_since: Optional[datetime.datetime] = None
+) -> dict:
+    """
+    Returns the MCAS files endpoint request body that filters files to an MCAS DLP policy's triggers. If modified_since
+    is set, only files modified since then are returned, oldest modification first.
+    """
+    mcas_post_files_body = {"filters": {
+        "fileType": {"neq": [6]},
+        "policy": {"cabinetmatchedrulesequals": [mcas_policy_id]}
+    }}
+    if modified_since is not None:
+        mcas_post_files_body["filters"]["modifiedDate"] = {"gte": epoch_milliseconds(modified_since)}
+        mcas_post_files_body["sortField"] = "modifiedDate"
+        mcas_post_files_body["sortDirection"] = "asc"
+    if limit:
+        mcas_post_files_body["limit"] = limit
 
-    except Exception as e:
-        log.error(f"{e}")
+    return mcas_post_files_body
 
-    return response, poll_mcas_file_again, paginate
+
+def epoch_milliseconds(utc_datetime: datetime.datetime) -> int:
+    """
+    Returns a naive UTC datetime as MCAS epoch milliseconds
+    """
+    return round((utc_datetime - EPOCH).total_seconds() * 1000)
 
 
-def post_files(
-        subdomain: str,
-        api_token: str,
-        paginate: int,
-        json_body: Optional[dict] = None
-) -> requests.Response:
+def modified_date(file_policy_trigger: dict) -> Optional[datetime.datetime]:
     """
-    POSTs to the MCAS files endpoint
+    Returns the naive UTC datetime an MCAS DLP policy trigger's file was last modified, or None if it has no
+    modifiedDate
     """
-    return requests.post(
-        f"https://{subdomain}.portal.cloudappsecurity.com/api/v1/files/?skip={paginate}",
-        headers={"Authorization": f"Token {api_token}"},
-        json=json_body,
+    modified_epoch_milliseconds = file_policy_trigger.get("modifiedDate")
+    if not isinstance(modified_epoch_milliseconds, (int, float)):
+        return None
+
+    return EPOCH + datetime.timedelta(milliseconds=modified_epoch_milliseconds)
+
+
+def page_watermark(file_policy_triggers: List[dict]) -> Optional[datetime.datetime]:
+    """
+    Returns the latest file modification of a page of MCAS DLP policy triggers, or None if none has a modifiedDate
+    """
+    return max(filter(None, map(modified_date, file_policy_triggers)), default=None)
+
+
+def next_modified_cursor(
+        modified_since: datetime.datetime,
+        skip: int,
+        file_policy_triggers: List[dict]
+) -> Tuple[datetime.datetime, int]:
+    """
+    Returns the (modified_since, skip) cursor of the page after a page of MCAS DLP policy triggers sorted by
+    modification. The next page starts at the page's latest modification, skipping the page's triggers modified at that
+    same time, so pages stay stable while older files are modified and move to the end of the results.
+    """
+    latest_modified_date = page_watermark(file_policy_triggers)
+    if latest_modified_date is None or latest_modified_date <= modified_since:
+        return modified_since, skip + len(file_policy_triggers)
+
+    return latest_modified_date, sum(
+        1 for file_policy_trigger in file_policy_triggers
+        if modified_date(file_policy_trigger) == latest_modified_date
     )
+
+
+class IncrementalJSONObjectParser:
+    """
+    Incremental parser for a JSON object read from a stream of byte chunks. Yields the object's top level keys and
+    values in document order, with the elements of selected array values yielded one at a time, so a large array is
+    never held in memory as a whole.
+    """
+
+    def __init__(self, byte_chunks: Iterator[bytes]) -> IncrementalJSONObjectParser:
+        self._byte_chunks: Iterator[bytes] = byte_chunks
+        self._decoder: codecs.IncrementalDecoder = codecs.getincrementaldecoder("utf-8")()
+        self._json_decoder: json.JSONDecoder = json.JSONDecoder()
+        self._buffer: str = ""
+        self._position: int = 0
+        self._exhausted: bool = False
+
+    def _fill(self) -> bool:
+        """
+        Appends the next decoded chunk to the buffer, dropping the consumed prefix. Returns False at the end of the
+        stream.
+        """
+        if self._exhausted:
+            return False
+
+        self._buffer = self._buffer[self._position:]
+        self._position = 0
+        try:
+            self._buffer += self._decoder.decode(next(self._byte_chunks))
+        except StopIteration:
+            self._buffer += self._decoder.decode(b"", final=True)
+            self._exhausted = True
+
+        return True
+
+    def _next_char(self) -> str:
+        """
+        Skips whitespace and returns the next character without consuming it
+        """
+        while True:
+            while self._position < len(self._buffer) and self._buffer[self._position].isspace():
+                self._position += 1
+            if self._position < len(self._buffer):
+                return self._buffer[self._position]
+            if not self._fill():
+                raise ValueError("unexpected end of JSON stream")
+
+    def _expect(self, chars: str) -> str:
+        """
+        Consumes and returns the next character, which must be one of chars
+        """
+        char = self._next_char()
+        if char not in chars:
+            raise ValueError(f"expected one of {chars!r} at JSON stream offset {self._position} but got {char!r}")
+        self._position += 1
+
+        return char
+
+    def _value(self) -> Any:
+        """
+        Consumes and returns the next complete JSON value
+        """
+        self._next_char()
+        while True:
+            try:
+                value, end = self._json_decoder.raw_decode(self._buffer, self._position)
+                # A number at the end of the buffer may continue in the next chunk
+                if end < len(self._buffer) or self._exhausted:
+                    self._position = end
+                    return value
+            except json.JSONDecodeError:
+                if self._exhausted:
+                    raise
+            self._fill()
+
+    def _array(self) -> Iterator[Any]:
+        """
+        Generator that consumes a JSON array, yielding its elements one at a time
+        """
+        self._expect("[")
+        if self._next_char() == "]":
+            self._position += 1
+            return
+
+        while True:
+            yield self._value()
+            if self._expect(",]") == "]":
+                return
+
+    def items(self, streamed_keys: Tuple[str, ...] = ()) -> Iterator[Tuple[str, Any]]:
+        """
+        Generator that yields the JSON object's top level key and value pairs. The value of a key in streamed_keys is
+        a generator of the array's elements, which must be consumed before the next pair is read.
+        """
+        self._expect("{")
+        if self._next_char() == "}":
+            self._position += 1
+            return
+
+        while True:
+            key = self._value()
+            self._expect(":")
+            if key in streamed_keys:
+                array_elements = self._array()
+                yield key, array_elements
+                # Consume any elements the caller left unread
+                for _ in array_elements:
+                    pass
+            else:
+                yield key, self._value()
+
+            if self._expect(",}") == "}":
+                return
+
+
+class MCASClient:
+    """
+    Microsoft Cloud App Security REST client. Owns a pooled keep-alive requests.Session that retries throttled and
+    failed calls with exponential backoff, honouring Retry-After headers.
+    """
+
+    def __init__(
+            self,
+            subdomain: str,
+            api_token: str,
+            rate_limiter: Optional[http_utils.RateLimiter] = None,
+            pool_size: int = 10,
+            connect_timeout: float = 10,
+            read_timeout: float = 60,
+            retries: int = 5,
+            backoff_factor: float = 1,
+            limit: Optional[int] = None,
+            stream: bool = False,
+            stream_chunk_size: int = 100,
+            base_url: Optional[str] = None,
+    ) -> MCASClient:
+        self._base_url: str = base_url or f"https://{subdomain}.portal.cloudappsecurity.com"
+        self._limit: Optional[int] = limit
+        self._stream: bool = stream
+        self._stream_chunk_size: int = stream_chunk_size
+        self._rate_limiter: http_utils.RateLimiter = rate_limiter or http_utils.RateLimiter()
+        self._timeout: Tuple[float, float] = (connect_timeout, read_timeout)
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUS_CODES,
+            method_whitelist=frozenset(["GET", "POST"]),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self._session: requests.Session = requests.Session()
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        self._session.headers.update({
+            "Authorization": f"Token {api_token}",
+            "Accept-Encoding": "gzip",
+            "Connection": "keep-alive",
+        })
+
+    def poll_files(
+            self,
+            mcas_policy_id: str,
+            paginate: int,
+            modified_since: Optional[datetime.datetime] = None
+    ) -> FilesPage:
+        """
+        Polls the MCAS files endpoint for a page of an MCAS DLP policy's triggers, optionally of files modified since a
+        time, while enforcing rate limits. Returns the parsed page.
+        """
+        with self._rate_limiter, page_fetch_seconds.time():
+            response = self.post_files(paginate, files_request_body(mcas_policy_id, self._limit, modified_since))
+            log.debug(f"got MCAS files response {response}")
+            response.raise_for_status()
+            mcas_post_files_resp_json = response.json()
+        policy_triggers = mcas_post_files_resp_json.get("data") or []
+        poll_mcas_file_again = bool(mcas_post_files_resp_json.get("hasNext"))
+
+        return FilesPage(
+            policy_triggers,
+            poll_mcas_file_again,
+            paginate + len(policy_triggers) if poll_mcas_file_again else paginate
+        )
+
+    def stream_files(
+            self,
+            mcas_policy_id: str,
+            paginate: int,
+            modified_since: Optional[datetime.datetime] = None
+    ) -> Iterator[FilesPage]:
+        """
+        Generator that polls the MCAS files endpoint for a page of an MCAS DLP policy's triggers, optionally of files
+        modified since a time, while enforcing rate limits, parsing the response body incrementally as it arrives.
+        Yields the page's triggers in chunks of at most stream_chunk_size. Every chunk but the last has another chunk to
+        follow, and the skip offset of the trigger after it. The last chunk carries the page's hasNext.
+        """
+        # The streamed body is parsed as it is processed, so only the time to the response headers is recorded
+        with self._rate_limiter, page_fetch_seconds.time():
+            response = self.post_files(
+                paginate, files_request_body(mcas_policy_id, self._limit, modified_since), stream=True
+            )
+
+        with response:
+            log.debug(f"got MCAS files response {response}")
+            response.raise_for_status()
+            page_paginate = paginate
+            policy_triggers = list()
+            poll_mcas_file_again = False
+            parser = IncrementalJSONObjectParser(response.iter_content(chunk_size=64 * 1024))
+            for key, value in parser.items(streamed_keys=("data",)):
+                if key == "hasNext":
+                    poll_mcas_file_again = bool(value)
+                elif key == "data":
+                    for file_policy_trigger in value:
+                        policy_triggers.append(file_policy_trigger)
+                        if len(policy_triggers) == self._stream_chunk_size:
+                            paginate += len(policy_triggers)
+                            yield FilesPage(policy_triggers, True, paginate)
+                            policy_triggers = list()
+
+        paginate += len(policy_triggers)
+        yield FilesPage(policy_triggers, poll_mcas_file_again, paginate if poll_mcas_file_again else page_paginate)
+
+    def iter_pages(
+            self,
+            mcas_policy_id: str,
+            paginate: int,
+            modified_since: Optional[datetime.datetime] = None
+    ) -> Iterator[FilesPage]:
+        """
+        Generator that polls the MCAS files endpoint page by page for an MCAS DLP policy's triggers, from a skip offset
+        until the last page. Pages are streamed in chunks if the client streams responses. If modified_since is set,
+        only files modified since then are polled, paging by modification time rather than by offset alone.
+        """
+        while True:
+            if self._stream:
+                files_pages = self.stream_files(mcas_policy_id, paginate, modified_since)
+            else:
+                files_pages = [self.poll_files(mcas_policy_id, paginate, modified_since)]
+
+            page_triggers = list()
+            for files_page in files_pages:
+                if modified_since is not None:
+                    page_triggers.extend(files_page.policy_triggers)
+                yield files_page
+
+            if not files_page.poll_again:
+                return
+            if modified_since is None:
+                paginate = files_page.paginate
+            else:
+                modified_since, paginate = next_modified_cursor(modified_since, paginate, page_triggers)
+
+    def post_files(self, paginate: int, json_body: Optional[dict] = None, stream: bool = False) -> requests.Response:
+        """
+        POSTs to the MCAS files endpoint
+        """
+        return self._session.post(
+            f"{self._base_url}/api/v1/files/?skip={paginate}",
+            json=json_body,
+            timeout=self._timeout,
+            stream=stream,
+        )
+
+    def close(self) -> None:
+        """
+        Closes the pooled HTTP session
+        """
+        self._session.close()
@@ -0,0 +1,135 @@
+"""
+Process memory high water mark guard
+"""
+
+from __future__ import annotations
+import ctypes
+import ctypes.util
+import gc
+import logging
+import sys
+import threading
+from typing import List, Optional
+
+import psutil
+
+from src import metrics
+
+
+log = logging.getLogger(__name__)
+
+
+def configure_memory_guard(config: dict, caches: List) -> Optional[MemoryGuard]:
+    """
+    Starts a MemoryGuard over a list of caches from the "memory" settings of a configuration dictionary's "sync"
+    section. Returns None if no high water mark is configured.
+    """
+    memory_config = (config.get("sync") or {}).get("memory") or {}
+    if not memory_config.get("high_water_mark_mb"):
+        return None
+
+    return MemoryGuard(
+        caches,
+        memory_config["high_water_mark_mb"] * 2 ** 20,
+        memory_config.get("trim_fraction", 0.5),
+        memory_config.get("check_interval", 30),
+    ).start()
+
+
+def release_free_memory() -> None:
+    """
+    Returns freed heap memory to the operating system with glibc's malloc_trim. A no-op on other C libraries.
+    """
+    if not sys.platform.startswith("linux"):
+        return
+
+    try:
+        ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+class MemoryGuard:
+    """
+    Watches the process's resident set size (RSS) on a daemon thread. Whenever the RSS is above the high water mark,
+    the guard evicts a fraction of every cache's least recently used items and collects garbage. A warning with the RSS
+    before and after is logged when the RSS passes the high water mark and whenever a trim evicts items. Caches are
+    objects with a trim(fraction) method, such as cache.LRUCache and box.BoxUserResolver.
+    """
+
+    def __init__(
+            self,
+            caches: List,
+            high_water_mark: int,
+            trim_fraction: float = 0.5,
+            check_interval: float = 30
+    ) -> MemoryGuard:
+        self._caches: List = list(caches)
+        self._high_water_mark: int = high_water_mark
+        self._trim_fraction: float = trim_fraction
+        self._check_interval: float = check_interval
+        self._process: psutil.Process = psutil.Process()
+        self._stopped: threading.Event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._above_high_water_mark: bool = False
+        self._trims: metrics.Counter = metrics.registry.counter(
+            "memory_guard_trims_total", "Cache trims after the process RSS passed the memory high water mark"
+        )
+        metrics.registry.gauge("process_resident_memory_bytes", "Process resident set size").set_function(self.rss)
+
+    def rss(self) -> int:
+        """
+        Returns the process's resident set size in bytes
+        """
+        return self._process.memory_info().rss
+
+    def check(self) -> bool:
+        """
+        Trims the caches if the RSS is above the high water mark. Returns True if the caches were trimmed.
+        """
+        rss = self.rss()
+        if rss <= self._high_water_mark:
+            self._above_high_water_mark = False
+            return False
+
+        evicted_count = sum(cache.trim(self._trim_fraction) for cache in self._caches)
+        gc.collect()
+        release_free_memory()
+        self._trims.inc()
+        # Once the caches are empty, further trims are logged at debug level until the RSS drops below the mark
+        log.log(
+            logging.WARNING if evicted_count or not self._above_high_water_mark else logging.DEBUG,
+            f"process RSS {rss / 2 ** 20:.0f} MiB is above the {self._high_water_mark / 2 ** 20:.0f} MiB memory high "
+            f"water mark, evicted {evicted_count} cached items, RSS now {self.rss() / 2 ** 20:.0f} MiB"
+        )
+        self._above_high_water_mark = True
+
+        return True
+
+    def _watch(self) -> None:
+        """
+        Checks the RSS every check interval until stopped
+        """
+        while not self._stopped.wait(self._check_interval):
+            try:
+                self.check()
+            except Exception as e:
+                log.error(f"failed to check process memory with {e}")
+
+    def start(self) -> MemoryGuard:
+        """
+        Starts watching the RSS on a daemon thread
+        """
+        self._thread = threading.Thread(target=self._watch, name="memory-guard", daemon=True)
+        self._thread.start()
+        log.debug(f"guarding process memory with a {self._high_water_mark / 2 ** 20:.0f} MiB high water mark")
+
+        return self
+
+    def stop(self) -> None:
+        """
+        Stops watching the RSS
+        """
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
@@ -0,0 +1,434 @@
+"""
+In-process metrics registry with counters, gauges and latency histograms. Metrics are exposed in the Prometheus text
+format from a local HTTP endpoint, and optionally dumped to a JSON file periodically.
+"""
+
+from __future__ import annotations
+import bisect
+import contextlib
+import http.server
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+
+log = logging.getLogger(__name__)
+
+
+# Latency histogram bucket upper bounds in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def label_key(labels: Optional[Dict[str, str]]) -> Tuple[Tuple[str, str], ...]:
+    """
+    Returns a hashable, ordered key for a dictionary of metric labels
+    """
+    return tuple(sorted((labels or {}).items()))
+
+
+def escape_label_value(value) -> str:
+    """
+    Escapes a metric label value for the Prometheus text format
+    """
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(labels: Tuple[Tuple[str, str], ...], **extra_labels) -> str:
+    """
+    Formats metric labels as a Prometheus text label set
+    """
+    label_pairs = list(labels) + sorted(extra_labels.items())
+    if not label_pairs:
+        return ""
+
+    return "{" + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in label_pairs) + "}"
+
+
+class Counter:
+    """
+    Thread safe monotonically increasing metric
+    """
+
+    type = "counter"
+
+    def __init__(self, name: str, labels: Tuple[Tuple[str, str], ...] = ()) -> Counter:
+        self.name: str = name
+        self.labels: Tuple[Tuple[str, str], ...] = labels
+        self._value: float = 0
+        self._lock: threading.Lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        """
+        Increments the counter
+        """
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self) -> float:
+        """
+        Current count
+        """
+        return self._value
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        """
+        Yields the metric's Prometheus sample names, label sets and values
+        """
+        yield self.name, format_labels(self.labels), self._value
+
+    def to_dict(self) -> float:
+        """
+        Returns the metric's JSON serializable value
+        """
+        return self._value
+
+
+class Gauge:
+    """
+    Thread safe metric that can go up and down. A gauge with a function reads its value from the function when
+    collected, which suits values such as queue depths and cache sizes that are owned elsewhere.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name: str, labels: Tuple[Tuple[str, str], ...] = ()) -> Gauge:
+        self.name: str = name
+        self.labels: Tuple[Tuple[str, str], ...] = labels
+        self._value: float = 0
+        self._function: Optional[Callable[[], float]] = None
+        self._lock: threading.Lock = threading.Lock()
+
+    def set(self, value: float) -> None:
+        """
+        Sets the gauge's value
+        """
+        with self._lock:
+            self._value = value
+
+    def inc(self, amount: float = 1) -> None:
+        """
+        Increments the gauge's value
+        """
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        """
+        Decrements the gauge's value
+        """
+        self.inc(-amount)
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        """
+        Reads the gauge's value from a function when it is collected
+        """
+        self._function = function
+
+    @property
+    def value(self) -> float:
+        """
+        Current value, read from the gauge's function if it has one
+        """
+        if self._function is not None:
+            try:
+                return self._function()
+            except Exception as e:
+                log.debug(f"failed to read gauge {self.name} with {e}")
+                return float("nan")
+
+        return self._value
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        """
+        Yields the metric's Prometheus sample names, label sets and values
+        """
+        yield self.name, format_labels(self.labels), self.value
+
+    def to_dict(self) -> float:
+        """
+        Returns the metric's JSON serializable value
+        """
+        return self.value
+
+
+class Histogram:
+    """
+    Thread safe histogram of observed values, usually latencies in seconds, counted into cumulative buckets
+    """
+
+    type = "histogram"
+
+    def __init__(
+            self,
+            name: str,
+            labels: Tuple[Tuple[str, str], ...] = (),
+            buckets: Tuple[float, ...] = DEFAULT_BUCKETS
+    ) -> Histogram:
+        self.name: str = name
+        self.labels: Tuple[Tuple[str, str], ...] = labels
+        self._buckets: Tuple[float, ...] = tuple(sorted(buckets))
+        self._bucket_counts: List[int] = [0] * (len(self._buckets) + 1)
+        self._count: int = 0
+        self._sum: float = 0
+        self._lock: threading.Lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        """
+        Records an observed value
+        """
+        bucket_index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._bucket_counts[bucket_index] += 1
+            self._count += 1
+            self._sum += value
+
+    @contextlib.contextmanager
+    def time(self) -> Iterator[None]:
+        """
+        Context manager that observes the seconds spent in its block
+        """
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started_at)
+
+    @property
+    def count(self) -> int:
+        """
+        Number of observed values
+        """
+        return self._count
+
+    def quantile(self, quantile: float) -> Optional[float]:
+        """
+        Returns an estimate of a quantile of the observed values, as the upper bound of the bucket it falls in. Returns
+        None if there are no observed values, or if the quantile falls past the largest bucket.
+        """
+        with self._lock:
+            bucket_counts = list(self._bucket_counts)
+            count = self._count
+        if not count:
+            return None
+
+        cumulative_count = 0
+        for bucket_upper_bound, bucket_count in zip(self._buckets, bucket_counts):
+            cumulative_count += bucket_count
+            if cumulative_count >= quantile * count:
+                return bucket_upper_bound
+
+        return None
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        """
+        Yields the metric's Prometheus sample names, label sets and values
+        """
+        with self._lock:
+            bucket_counts = list(self._bucket_counts)
+            count = self._count
+            total = self._sum
+
+        cumulative_count = 0
+        for bucket_upper_bound, bucket_count in zip(self._buckets + (float("inf"),), bucket_counts):
+            cumulative_count += bucket_count
+            upper_bound = "+Inf" if bucket_upper_bound == float("inf") else repr(float(bucket_upper_bound))
+            yield f"{self.name}_bucket", format_labels(self.labels, le=upper_bound), cumulative_count
+        yield f"{self.name}_count", format_labels(self.labels), count
+        yield f"{self.name}_sum", format_labels(self.labels), total
+
+    def to_dict(self) -> dict:
+        """
+        Returns the metric's count, sum and estimated quantiles as a JSON serializable dictionary
+        """
+        return {
+            "count": self._count,
+            "sum": self._sum,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+        }
+
+
+class MetricsRegistry:
+    """
+    Thread safe registry of named metrics. Getting a metric creates it on first use, so instrumented code never needs
+    to declare metrics up front.
+    """
+
+    def __init__(self) -> MetricsRegistry:
+        self._metrics: Dict[Tuple[str, tuple], object] = dict()
+        self._help: Dict[str, str] = dict()
+        self._lock: threading.Lock = threading.Lock()
+
+    def _metric(self, metric_class, name: str, help_text: str, labels: Optional[Dict[str, str]], **kwargs):
+        """
+        Returns the registered metric with a name and labels, registering it if it is new
+        """
+        key = (name, label_key(labels))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = metric_class(name, key[1], **kwargs)
+                    self._metrics[key] = metric
+                    if help_text:
+                        self._help.setdefault(name, help_text)
+        if not isinstance(metric, metric_class):
+            raise TypeError(f"metric {name} is a {metric.type}, not a {metric_class.type}")
+
+        return metric
+
+    def counter(self, name: str, help_text: str = "", labels: Optional[Dict[str, str]] = None) -> Counter:
+        """
+        Returns the counter with a name and labels
+        """
+        return self._metric(Counter, name, help_text, labels)
+
+    def gauge(self, name: str, help_text: str = "", labels: Optional[Dict[str, str]] = None) -> Gauge:
+        """
+        Returns the gauge with a name and labels
+        """
+        return self._metric(Gauge, name, help_text, labels)
+
+    def histogram(
+            self,
+            name: str,
+            help_text: str = "",
+            labels: Optional[Dict[str, str]] = None,
+            buckets: Tuple[float, ...] = DEFAULT_BUCKETS
+    ) -> Histogram:
+        """
+        Returns the histogram with a name and labels
+        """
+        return self._metric(Histogram, name, help_text, labels, buckets=buckets)
+
+    def metrics(self) -> list:
+        """
+        Returns every registered metric, ordered by name
+        """
+        with self._lock:
+            return [self._metrics[key] for key in sorted(self._metrics, key=lambda metric_key: metric_key)]
+
+    def prometheus_text(self) -> str:
+        """
+        Renders every registered metric in the Prometheus text exposition format
+        """
+        lines = list()
+        described_names = set()
+        for metric in self.metrics():
+            if metric.name not in described_names:
+                described_names.add(metric.name)
+                if metric.name in self._help:
+                    lines.append(f"# HELP {metric.name} {self._help[metric.name]}")
+                lines.append(f"# TYPE {metric.name} {metric.type}")
+            for sample_name, sample_labels, value in metric.samples():
+                lines.append(f"{sample_name}{sample_labels} {float(value)!r}")
+
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self) -> dict:
+        """
+        Returns every registered metric's current value as a JSON serializable dictionary
+        """
+        metrics_dict = dict()
+        for metric in self.metrics():
+            metrics_dict[f"{metric.name}{format_labels(metric.labels)}"] = metric.to_dict()
+
+        return metrics_dict
+
+
+# Process wide metrics registry
+registry = MetricsRegistry()
+
+
+class MetricsHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    HTTP request handler that serves the metrics registry in the Prometheus text format on /metrics
+    """
+
+    def do_GET(self) -> None:
+        """
+        Serves a GET request
+        """
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = registry.prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        """
+        Logs requests at debug level instead of writing them to stderr
+        """
+        log.debug(f"metrics HTTP request {format % args}")
+
+
+def start_http_server(port: int, host: str = "127.0.0.1") -> http.server.ThreadingHTTPServer:
+    """
+    Serves the metrics registry over HTTP on a daemon thread
+    """
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHTTPRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    log.info(f"serving metrics on http://{host}:{server.server_port}/metrics")
+
+    return server
+
+
+def write_json(path: str) -> None:
+    """
+    Atomically writes the metrics registry's current values to a JSON file
+    """
+    file_descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(file_descriptor, "w") as fh:
+            json.dump({"time": time.time(), "metrics": registry.to_dict()}, fh, indent=2, default=str)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def start_json_dump(path: str, interval: float = 60) -> threading.Thread:
+    """
+    Dumps the metrics registry to a JSON file every interval seconds on a daemon thread
+    """
+    def dump_json() -> None:
+        while True:
+            time.sleep(interval)
+            try:
+                write_json(path)
+            except Exception as e:
+                log.error(f"failed to dump metrics to {path} with {e}")
+
+    dump_thread = threading.Thread(target=dump_json, name="metrics-json", daemon=True)
+    dump_thread.start()
+    log.info(f"dumping metrics to {path} every {interval} seconds")
+
+    return dump_thread
+
+
+def configure_metrics(config: dict) -> None:
+    """
+    Starts the metrics HTTP endpoint and periodic JSON dump enabled in a configuration dictionary's "metrics" section
+    """
+    metrics_config = config.get("metrics") or {}
+    if metrics_config.get("http_port") is not None:
+        start_http_server(metrics_config["http_port"], metrics_config.get("http_host", "127.0.0.1"))
+    if metrics_config.get("json_path"):
+        json_path = metrics_config["json_path"]
+        if not os.path.isabs(json_path):
+            json_path = os.path.join(os.path.dirname(__file__), "..", json_path)
+        start_json_dump(os.path.abspath(json_path), metrics_config.get("json_interval", 60))
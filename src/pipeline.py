@@ -0,0 +1,169 @@
+"""
+Producer/consumer pipeline utilities
+"""
+
+from __future__ import annotations
+import logging
+import queue
+import threading
+from typing import Any, Callable, Iterable, Iterator, List, Optional
+
+
+log = logging.getLogger(__name__)
+
+
+class _StageDone:
+    """
+    Sentinel put on a stage output queue when the stage has no more items
+    """
+    def __init__(self, error: Optional[BaseException] = None) -> _StageDone:
+        self.error = error
+
+
+class Pipeline:
+    """
+    Runs a source iterable and a list of stage functions in their own threads, connected by bounded queues. Iterating
+    the pipeline yields the output of the last stage in source order. A full queue blocks the stage feeding it, so at
+    most queue_size items are buffered between any two stages. An exception raised by the source or a stage is
+    re-raised by the iterating thread. Once the pipeline is closed, unconsumed holds the last stage's outputs that were
+    never yielded.
+    """
+
+    def __init__(
+            self,
+            source: Iterable,
+            stages: List[Callable[[Any], Any]],
+            queue_size: int = 1,
+            name: str = "pipeline"
+    ) -> Pipeline:
+        self._stopped: threading.Event = threading.Event()
+        self.unconsumed: List = list()
+        # Last stage outputs that could not be queued as the pipeline was stopped
+        self._dropped: List = list()
+        self._queues: List[queue.Queue] = [queue.Queue(maxsize=max(1, queue_size)) for _ in range(len(stages) + 1)]
+        self._threads: List[threading.Thread] = [
+            threading.Thread(
+                target=self._run_source, args=(source, self._queues[0]), name=f"{name}-source", daemon=True
+            )
+        ]
+        for stage_index, stage in enumerate(stages):
+            self._threads.append(
+                threading.Thread(
+                    target=self._run_stage,
+                    args=(stage, self._queues[stage_index], self._queues[stage_index + 1]),
+                    name=f"{name}-{getattr(stage, '__name__', stage_index)}",
+                    daemon=True
+                )
+            )
+
+        for stage_thread in self._threads:
+            stage_thread.start()
+
+    def _put(self, output_queue: queue.Queue, item: Any) -> bool:
+        """
+        Puts an item on a bounded queue, blocking until there is room or the pipeline is stopped. Returns False if the
+        pipeline was stopped.
+        """
+        while not self._stopped.is_set():
+            try:
+                output_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def _get(self, input_queue: queue.Queue) -> Any:
+        """
+        Gets an item from a queue, blocking until one is available or the pipeline is stopped
+        """
+        while not self._stopped.is_set():
+            try:
+                return input_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+        return _StageDone()
+
+    def _run_source(self, source: Iterable, output_queue: queue.Queue) -> None:
+        """
+        Puts items from the source iterable on the first queue
+        """
+        try:
+            for item in source:
+                if not self._put(output_queue, item):
+                    return
+        except BaseException as e:
+            log.error(f"pipeline source failed with {e}")
+            self._put(output_queue, _StageDone(e))
+        else:
+            self._put(output_queue, _StageDone())
+
+    def _run_stage(self, stage: Callable[[Any], Any], input_queue: queue.Queue, output_queue: queue.Queue) -> None:
+        """
+        Applies a stage function to each item from an input queue and puts the results on an output queue
+        """
+        while True:
+            item = self._get(input_queue)
+            if isinstance(item, _StageDone):
+                self._put(output_queue, item)
+                return
+
+            try:
+                stage_output = stage(item)
+            except BaseException as e:
+                log.error(f"pipeline stage {getattr(stage, '__name__', stage)} failed with {e}")
+                self._put(output_queue, _StageDone(e))
+                return
+
+            if not self._put(output_queue, stage_output):
+                if output_queue is self._queues[-1]:
+                    self._dropped.append(stage_output)
+                return
+
+    def __iter__(self) -> Iterator:
+        """
+        Yields the last stage's output items in order
+        """
+        try:
+            while True:
+                item = self._get(self._queues[-1])
+                if isinstance(item, _StageDone):
+                    if item.error is not None:
+                        raise item.error
+                    return
+
+                yield item
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        """
+        Stops every pipeline thread, waits for them to exit and collects the last stage's outputs left on its queue
+        """
+        self._stopped.set()
+        for stage_thread in self._threads:
+            if stage_thread is not threading.current_thread():
+                stage_thread.join()
+        while True:
+            try:
+                item = self._queues[-1].get_nowait()
+            except queue.Empty:
+                break
+            if not isinstance(item, _StageDone):
+                self.unconsumed.append(item)
+        # Dropped outputs come after every queued output in source order
+        self.unconsumed.extend(self._dropped)
+        self._dropped = list()
+
+    def __enter__(self) -> Pipeline:
+        """
+        Context manager entry
+        """
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        """
+        Context manager exit that stops the pipeline
+        """
+        self.close()
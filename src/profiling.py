@@ -0,0 +1,323 @@
+"""
+Per cycle CPU and memory profiling of the sync loop
+"""
+
+from __future__ import annotations
+import collections
+import contextlib
+import cProfile
+import datetime
+import functools
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+
+log = logging.getLogger(__name__)
+
+
+PROFILE_SAMPLE = "sample"
+PROFILE_CPROFILE = "cprofile"
+
+# Allocation growth lines written to each cycle's allocation report
+ALLOCATION_REPORT_SIZE = 100
+
+# Functions that threads idle in while waiting for work. Left out of the logged summary of the slowest functions.
+IDLE_FUNCTIONS = {
+    ("threading.py", "wait"),
+    ("queue.py", "get"),
+    ("selectors.py", "select"),
+    ("base_events.py", "_run_once"),
+    ("thread.py", "_worker"),
+}
+
+# pstats function key, a file name, first line number and function name
+FunctionKey = Tuple[str, int, str]
+
+
+def configure_cycle_profiler(config: dict) -> CycleProfiler:
+    """
+    Configures a CycleProfiler from a configuration dictionary's "profile" section. Profiles are written to a new
+    directory under the profile directory, by default the logs directory.
+    """
+    profile_config = config.get("profile") or {}
+    profile_dir = profile_config.get("dir", "logs")
+    if not os.path.isabs(profile_dir):
+        profile_dir = os.path.join(os.path.dirname(__file__), "..", profile_dir)
+
+    return CycleProfiler(
+        os.path.join(
+            os.path.abspath(profile_dir), f"profile-{datetime.datetime.utcnow():%Y%m%dT%H%M%S}-{os.getpid()}"
+        ),
+        profile_config.get("mode", PROFILE_SAMPLE),
+        profile_config.get("sample_interval", 0.005),
+        profile_config.get("top", 10),
+        profile_config.get("tracemalloc_frames", 1),
+    )
+
+
+class CycleProfiler:
+    """
+    Profiles the sync one cycle at a time. Each cycle's CPU profile is written as a .pstats file, and the allocations
+    that grew over the cycle as a tracemalloc report, and the slowest functions and biggest allocation growth are
+    logged.
+
+    In sample mode a background thread samples the stacks of every thread, and the .pstats file is built from the
+    samples, with sample counts in place of call counts. In cprofile mode only the threads profiled with
+    profile_thread, or the functions wrapped with wrap, are profiled, with cProfile. Threads those functions start,
+    such as pipeline stages and the worker pool, are not. A tracemalloc_frames of 0 turns allocation tracing off.
+    """
+
+    def __init__(
+            self,
+            profile_dir: str,
+            mode: str = PROFILE_SAMPLE,
+            sample_interval: float = 0.005,
+            top: int = 10,
+            tracemalloc_frames: int = 1
+    ) -> CycleProfiler:
+        if mode not in (PROFILE_SAMPLE, PROFILE_CPROFILE):
+            raise ValueError(f"profile mode must be {PROFILE_SAMPLE} or {PROFILE_CPROFILE}, not {mode}")
+
+        self.profile_dir: str = profile_dir
+        self.mode: str = mode
+        self.cycle: int = 1
+        self._sample_interval: float = sample_interval
+        self._top: int = top
+        self._tracemalloc_frames: int = tracemalloc_frames
+        self._lock: threading.Lock = threading.Lock()
+        self._local: threading.local = threading.local()
+        # cProfile profiles of the current cycle's completed functions, in cprofile mode
+        self._profiles: List[cProfile.Profile] = list()
+        # Sample counts of the current cycle's stacks, outermost frame first, in sample mode
+        self._stack_samples: collections.Counter = collections.Counter()
+        self._sampler: Optional[threading.Thread] = None
+        # Thread ending a cycle, left out of the samples while it writes the cycle's profile
+        self._ending_thread_id: Optional[int] = None
+        self._stopped: threading.Event = threading.Event()
+        self._started_tracemalloc: bool = False
+        self._snapshot: Optional[tracemalloc.Snapshot] = None
+        self._cycle_started_at: float = time.monotonic()
+
+    def start(self) -> CycleProfiler:
+        """
+        Starts tracing allocations, and sampling in sample mode, from the start of the first cycle
+        """
+        os.makedirs(self.profile_dir, exist_ok=True)
+        if self._tracemalloc_frames and not tracemalloc.is_tracing():
+            tracemalloc.start(self._tracemalloc_frames)
+            self._started_tracemalloc = True
+        if tracemalloc.is_tracing():
+            self._snapshot = self._take_snapshot()
+        if self.mode == PROFILE_SAMPLE:
+            self._sampler = threading.Thread(target=self._sample, name="profile-sampler", daemon=True)
+            self._sampler.start()
+        self._cycle_started_at = time.monotonic()
+        log.info(f"profiling every sync cycle to {self.profile_dir} in {self.mode} mode")
+
+        return self
+
+    def stop(self) -> None:
+        """
+        Stops sampling and tracing allocations. The current cycle's profile is discarded.
+        """
+        self._stopped.set()
+        if self._sampler:
+            self._sampler.join()
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+
+    @contextlib.contextmanager
+    def profile_thread(self) -> Iterator[None]:
+        """
+        Profiles the calling thread with cProfile for the duration of the context, in cprofile mode. The profile is
+        added to the cycle the context exits in, and split at the end of every cycle ended on the profiled thread.
+        """
+        if self.mode != PROFILE_CPROFILE:
+            yield
+            return
+
+        self._local.profile = cProfile.Profile()
+        self._local.profile.enable()
+        try:
+            yield
+        finally:
+            self._local.profile.disable()
+            self._add_profile(self._local.profile)
+            del self._local.profile
+
+    def wrap(self, function: Callable) -> Callable:
+        """
+        Wraps a function to be profiled with profile_thread on the thread that calls it
+        """
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with self.profile_thread():
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    def _add_profile(self, profile: cProfile.Profile) -> None:
+        """
+        Snapshots a disabled profile's stats and adds it to the current cycle
+        """
+        profile.create_stats()
+        with self._lock:
+            self._profiles.append(profile)
+
+    def _sample(self) -> None:
+        """
+        Counts the stacks of every other thread every sample interval until stopped
+        """
+        sampler_thread_id = threading.get_ident()
+        while not self._stopped.wait(self._sample_interval):
+            stacks = list()
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id in (sampler_thread_id, self._ending_thread_id):
+                    continue
+                stack = list()
+                while frame is not None:
+                    stack.append((frame.f_code.co_filename, frame.f_code.co_firstlineno, frame.f_code.co_name))
+                    frame = frame.f_back
+                stacks.append(tuple(reversed(stack)))
+            with self._lock:
+                self._stack_samples.update(stacks)
+
+    def _sampled_stats(self, stack_samples: collections.Counter) -> pstats.Stats:
+        """
+        Builds pstats stats from stack samples. A function's call counts are the samples it is on the stack in, its
+        own time the samples it is the innermost frame of, and its cumulative time the samples it is anywhere on the
+        stack in, at sample_interval seconds per sample.
+        """
+        # Function key to samples on the stack, samples innermost, and callers' samples and samples innermost
+        sampled: Dict[FunctionKey, List] = dict()
+        for stack, sample_count in stack_samples.items():
+            seconds = sample_count * self._sample_interval
+            counted_functions = set()
+            counted_calls = set()
+            for frame_index, function_key in enumerate(stack):
+                innermost = frame_index == len(stack) - 1
+                if function_key not in sampled:
+                    sampled[function_key] = [0, 0.0, 0.0, collections.defaultdict(lambda: [0, 0.0, 0.0])]
+                function_samples = sampled[function_key]
+                if innermost:
+                    function_samples[1] += seconds
+                # Recursive functions are counted once a sample
+                if function_key not in counted_functions:
+                    counted_functions.add(function_key)
+                    function_samples[0] += sample_count
+                    function_samples[2] += seconds
+                if frame_index and (stack[frame_index - 1], function_key) not in counted_calls:
+                    counted_calls.add((stack[frame_index - 1], function_key))
+                    caller_samples = function_samples[3][stack[frame_index - 1]]
+                    caller_samples[0] += sample_count
+                    caller_samples[1] += seconds if innermost else 0.0
+                    caller_samples[2] += seconds
+
+        stats = pstats.Stats()
+        stats.stats = {
+            function_key: (
+                sample_count,
+                sample_count,
+                own_seconds,
+                cumulative_seconds,
+                {
+                    caller_key: (caller_count, caller_count, caller_own_seconds, caller_cumulative_seconds)
+                    for caller_key, (caller_count, caller_own_seconds, caller_cumulative_seconds) in callers.items()
+                },
+            )
+            for function_key, (sample_count, own_seconds, cumulative_seconds, callers) in sampled.items()
+        }
+        stats.get_top_level_stats()
+
+        return stats
+
+    def _cycle_stats(self) -> pstats.Stats:
+        """
+        Takes the current cycle's CPU profile
+        """
+        with self._lock:
+            profiles, self._profiles = self._profiles, list()
+            stack_samples, self._stack_samples = self._stack_samples, collections.Counter()
+
+        if self.mode == PROFILE_SAMPLE:
+            stats = self._sampled_stats(stack_samples)
+        else:
+            stats = pstats.Stats()
+            for profile in profiles:
+                stats.add(profile)
+
+        return stats
+
+    def _take_snapshot(self) -> tracemalloc.Snapshot:
+        """
+        Takes a tracemalloc snapshot of the sync's allocations, without the profiler's own
+        """
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, pstats.__file__),
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        ])
+
+    def end_cycle(self) -> None:
+        """
+        Ends the current cycle. Writes its CPU profile and allocation growth report, and logs a summary of both.
+        """
+        cycle_seconds = time.monotonic() - self._cycle_started_at
+        cycle_path = os.path.join(self.profile_dir, f"cycle-{self.cycle:05d}")
+        self._ending_thread_id = threading.get_ident()
+        thread_profile = getattr(self._local, "profile", None)
+        if thread_profile:
+            # The calling thread's profile is split at the cycle end
+            thread_profile.disable()
+            self._add_profile(thread_profile)
+        stats = self._cycle_stats()
+        stats.dump_stats(f"{cycle_path}.pstats")
+        slowest_functions = sorted(
+            (
+                (own_seconds, function_key)
+                for function_key, (_, _, own_seconds, _, _) in stats.stats.items()
+                if (os.path.basename(function_key[0]), function_key[2]) not in IDLE_FUNCTIONS
+            ),
+            reverse=True
+        )[:self._top]
+        summary_lines = [
+            f"{own_seconds:.3f}s {pstats.func_std_string(function_key)}"
+            for own_seconds, function_key in slowest_functions
+        ]
+
+        if self._snapshot:
+            snapshot = self._take_snapshot()
+            allocation_growth = [
+                statistic for statistic in snapshot.compare_to(self._snapshot, "lineno") if statistic.size_diff > 0
+            ]
+            self._snapshot = snapshot
+            traced_size, traced_peak = tracemalloc.get_traced_memory()
+            with open(f"{cycle_path}.allocations.txt", "w") as fh:
+                fh.write(f"traced memory {traced_size} bytes, peak {traced_peak} bytes\n")
+                fh.writelines(f"{statistic}\n" for statistic in allocation_growth[:ALLOCATION_REPORT_SIZE])
+            summary_lines.append(
+                f"traced memory {traced_size / 2 ** 20:.1f} MiB, peak {traced_peak / 2 ** 20:.1f} MiB, grown by"
+            )
+            summary_lines.extend(f"{statistic}" for statistic in allocation_growth[:self._top])
+
+        log.info(
+            "profiled sync cycle %d of %.1f seconds to %s, slowest functions by own time:\n  %s",
+            self.cycle,
+            cycle_seconds,
+            cycle_path,
+            "\n  ".join(summary_lines)
+        )
+        self.cycle += 1
+        self._cycle_started_at = time.monotonic()
+        if thread_profile:
+            self._local.profile = cProfile.Profile()
+            self._local.profile.enable()
+        self._ending_thread_id = None
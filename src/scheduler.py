@@ -0,0 +1,135 @@
+"""
+Scheduling of the MCAS DLP policy polls and failed Box classification apply retries of the sync
+"""
+
+from __future__ import annotations
+import heapq
+import itertools
+import logging
+import time
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+
+log = logging.getLogger(__name__)
+
+
+def configure_schedule(config: dict) -> dict:
+    """
+    Returns the "schedule" settings of a configuration dictionary's "sync" section with defaults filled in
+    """
+    schedule_config = (config.get("sync") or {}).get("schedule") or {}
+    poll_interval = schedule_config.get("poll_interval", 60)
+
+    return {
+        "poll_interval": poll_interval,
+        "min_poll_interval": schedule_config.get("min_poll_interval", min(poll_interval, 10)),
+        "max_poll_interval": schedule_config.get("max_poll_interval", max(poll_interval, 15 * 60)),
+        "retry_interval": schedule_config.get("retry_interval", 5 * 60),
+    }
+
+
+def configure_poll_interval(config: dict, box_mcas_classification: dict) -> AdaptiveInterval:
+    """
+    Configures an MCAS DLP policy's AdaptiveInterval from the "schedule" settings of a configuration dictionary's "sync"
+    section. A policy's own poll_interval, min_poll_interval and max_poll_interval override the defaults.
+    """
+    schedule_config = configure_schedule(config)
+
+    return AdaptiveInterval(
+        box_mcas_classification.get("poll_interval", schedule_config["poll_interval"]),
+        box_mcas_classification.get("min_poll_interval", schedule_config["min_poll_interval"]),
+        box_mcas_classification.get("max_poll_interval", schedule_config["max_poll_interval"]),
+    )
+
+
+class AdaptiveInterval:
+    """
+    Poll interval that adapts to how much new work recent polls found. The interval shrinks while polls find new work,
+    down to min_interval, and grows while polls come back empty, up to max_interval.
+    """
+
+    def __init__(
+            self,
+            interval: float,
+            min_interval: float,
+            max_interval: float,
+            speedup: float = 0.5,
+            slowdown: float = 1.5
+    ) -> AdaptiveInterval:
+        if not 0 < min_interval <= max_interval:
+            raise ValueError("poll intervals must satisfy 0 < min_interval <= max_interval")
+
+        self._min_interval: float = min_interval
+        self._max_interval: float = max_interval
+        self._speedup: float = speedup
+        self._slowdown: float = slowdown
+        self.interval: float = min(max_interval, max(min_interval, interval))
+
+    def update(self, new_count: int) -> float:
+        """
+        Adapts the interval to the number of new items the last poll found. Returns the new interval.
+        """
+        if new_count > 0:
+            self.interval = max(self._min_interval, self.interval * self._speedup)
+        else:
+            self.interval = min(self._max_interval, self.interval * self._slowdown)
+
+        return self.interval
+
+
+class Scheduler:
+    """
+    Heap of named tasks by due time. Rescheduling or cancelling a task leaves its old heap entry in place, and stale
+    entries are dropped when they reach the top of the heap.
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic) -> Scheduler:
+        self._clock: Callable[[], float] = clock
+        self._heap: List[Tuple[float, int, Hashable]] = list()
+        self._entries: Dict[Hashable, int] = dict()
+        self._sequence: itertools.count = itertools.count()
+
+    def schedule(self, name: Hashable, delay: float = 0) -> None:
+        """
+        Schedules a task to be due in delay seconds, replacing its earlier schedule. Tasks due at the same time are due
+        in the order they were scheduled.
+        """
+        sequence = next(self._sequence)
+        self._entries[name] = sequence
+        heapq.heappush(self._heap, (self._clock() + max(0, delay), sequence, name))
+
+    def cancel(self, name: Hashable) -> None:
+        """
+        Unschedules a task
+        """
+        self._entries.pop(name, None)
+
+    def _drop_stale(self) -> None:
+        """
+        Pops the heap entries of cancelled and rescheduled tasks from the top of the heap
+        """
+        while self._heap and self._entries.get(self._heap[0][2]) != self._heap[0][1]:
+            heapq.heappop(self._heap)
+
+    def due_in(self) -> Optional[float]:
+        """
+        Returns the seconds until the earliest task is due, 0 if a task is overdue, or None if no task is scheduled
+        """
+        self._drop_stale()
+        if not self._heap:
+            return None
+
+        return max(0, self._heap[0][0] - self._clock())
+
+    def pop_due(self) -> Optional[Hashable]:
+        """
+        Unschedules and returns the earliest due task, or returns None if no task is due yet
+        """
+        self._drop_stale()
+        if not self._heap or self._heap[0][0] > self._clock():
+            return None
+
+        _, _, name = heapq.heappop(self._heap)
+        del self._entries[name]
+
+        return name
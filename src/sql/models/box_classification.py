@@ -2,10 +2,12 @@
 box_classification SQL table model and manager
 """
 
+import datetime
 import logging
-from typing import List
+import random
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
 
-from sqlalchemy import Column, String, DateTime, Integer, Boolean, Text
+from sqlalchemy import Column, String, DateTime, Integer, Boolean, Text, Index, and_, or_
 from sqlalchemy import func as sql_func
 
 from src.sql import sql
@@ -14,24 +16,43 @@ from src.sql import sql
 log = logging.getLogger(__name__)
 
 
+# Failure types of a Box classification apply, which set how long a record backs off before it is retried
+RETRY_THROTTLED = "throttled"
+RETRY_SERVER_ERROR = "server_error"
+RETRY_CLIENT_ERROR = "client_error"
+
+# Base and maximum retry delay seconds by failure type. The delay doubles with each apply attempt.
+RETRY_BACKOFF = {
+    RETRY_THROTTLED: (60, 60 * 60),
+    RETRY_SERVER_ERROR: (5 * 60, 6 * 60 * 60),
+    RETRY_CLIENT_ERROR: (30 * 60, 24 * 60 * 60),
+}
+
+
 class BoxClassification(sql.model):
     """
     box_classification SQL table model
     """
 
     __tablename__ = "box_classification"
+    __table_args__ = (
+        Index("ix_box_classification_key", "BOX_FILE_ID", "BOX_CLASSIFICATION_NAME", "MCAS_POLICY_ID", unique=True),
+    )
 
     ID = Column(Integer, primary_key=True, autoincrement=True)
-    BOX_FILE_ID = Column(String)
+    # Key columns are bounded so SQL Server can index them
+    BOX_FILE_ID = Column(String(255))
     BOX_FILE_NAME = Column(String)
     BOX_FILE_OWNER = Column(String)
-    BOX_CLASSIFICATION_NAME = Column(String)
-    MCAS_POLICY_ID = Column(String)
+    BOX_CLASSIFICATION_NAME = Column(String(255))
+    MCAS_POLICY_ID = Column(String(255))
     APPLIED = Column(Boolean)
     APPLY_ATTEMPTS = Column(Integer)
     APPLY_ERROR_EXCEPTION_MESSAGE = Column(Text)
     APPLY_ERROR_FORBIDDEN = Column(Boolean)
     APPLY_ERROR_NO_BOX_USER = Column(Boolean)
+    # UTC time a failed apply is next due a retry. NULL is due immediately.
+    NEXT_RETRY_AT = Column(DateTime)
     CREATED = Column(DateTime, default=sql_func.now())
     UPDATED = Column(DateTime, default=sql_func.now(), onupdate=sql_func.now())
 
@@ -39,12 +60,67 @@ class BoxClassification(sql.model):
         return f"<{type(self).__name__}:{self.BOX_FILE_ID}:{self.BOX_CLASSIFICATION_NAME}>"
 
 
+def failed_apply_retry_criteria():
+    """
+    Returns the SQL criteria of box_classification records to retry failed Box classification applys for
+    """
+    return and_(
+        BoxClassification.APPLIED == False,
+        BoxClassification.APPLY_ERROR_FORBIDDEN == None,
+        BoxClassification.APPLY_ERROR_NO_BOX_USER == None,
+        BoxClassification.APPLY_ATTEMPTS < 10
+    )
+
+
+def retry_failure_type(exception: Exception) -> str:
+    """
+    Returns the retry failure type of an exception raised applying a Box classification. Exceptions without an HTTP
+    status, such as connection errors, are treated as server errors.
+    """
+    status = getattr(exception, "status", None)
+    if status == 429:
+        return RETRY_THROTTLED
+    if status is None or status >= 500:
+        return RETRY_SERVER_ERROR
+
+    return RETRY_CLIENT_ERROR
+
+
+def schedule_retry(
+        record: BoxClassification,
+        failure_type: str,
+        now: Optional[datetime.datetime] = None
+) -> datetime.datetime:
+    """
+    Sets when a box_classification record with a failed apply is next due a retry, with exponential backoff by apply
+    attempt and failure type. Jitter spreads out the retries of records that failed together.
+    """
+    base_delay, max_delay = RETRY_BACKOFF[failure_type]
+    delay = min(max_delay, base_delay * 2 ** max(0, (record.APPLY_ATTEMPTS or 1) - 1))
+    record.NEXT_RETRY_AT = (now or datetime.datetime.utcnow()) + datetime.timedelta(
+        seconds=random.uniform(delay / 2, delay)
+    )
+
+    return record.NEXT_RETRY_AT
+
+
+# Partial index holding only the records due a retry, which stays small as the table grows
+Index(
+    "ix_box_classification_retry",
+    BoxClassification.ID,
+    postgresql_where=failed_apply_retry_criteria(),
+    sqlite_where=failed_apply_retry_criteria(),
+    mssql_where=failed_apply_retry_criteria(),
+)
+
+
 class BoxClassificationSQLManager(sql.SQLManager):
     """
     box_classification SQL table manager
     """
 
     model = BoxClassification
+    unique_key = ("BOX_FILE_ID", "BOX_CLASSIFICATION_NAME", "MCAS_POLICY_ID")
 
     def new_record(
             self,
@@ -66,17 +142,92 @@ class BoxClassificationSQLManager(sql.SQLManager):
             APPLIED=False,
             APPLY_ATTEMPTS=1
         )
-        log.info(f"built {self.model.__tablename__} record {record}")
+        log.debug("built %s record %s", self.model.__tablename__, record)
 
         return record
 
-    def failed_apply_retry_records(self) -> List[BoxClassification]:
+    def due_retry_records(
+            self,
+            chunk_size: int = 1000,
+            now: Optional[datetime.datetime] = None,
+            mcas_policy_ids: Optional[Iterable[str]] = None
+    ) -> Iterator[List[BoxClassification]]:
         """
-        Returns a SQL result set of box_classification records for retrying failed sync to from MCAS to Box
+        Generator that yields chunks of box_classification records due a retry of a failed sync from MCAS to Box, in ID
+        order, optionally only of a set of MCAS DLP policies. Each chunk is a short keyset paginated query for the
+        records after the previous chunk's last ID, rather than one long-lived result set, run as its own unit of work.
+        Yielded records are detached from the SQL session.
         """
-        return self.model_query.filter(
-            self.model.APPLIED == False,
-            self.model.APPLY_ERROR_FORBIDDEN == None,
-            self.model.APPLY_ERROR_NO_BOX_USER == None,
-            self.model.APPLY_ATTEMPTS < 10
-        )
+        now = now or datetime.datetime.utcnow()
+        last_id = None
+        while True:
+            query = self.model_query.filter(
+                failed_apply_retry_criteria(),
+                or_(self.model.NEXT_RETRY_AT == None, self.model.NEXT_RETRY_AT <= now)
+            )
+            if mcas_policy_ids is not None:
+                query = query.filter(self.model.MCAS_POLICY_ID.in_(list(mcas_policy_ids)))
+            if last_id is not None:
+                query = query.filter(self.model.ID > last_id)
+            with self.unit_of_work():
+                records = query.order_by(self.model.ID).limit(chunk_size).all()
+            if not records:
+                return
+
+            yield records
+            if len(records) < chunk_size:
+                return
+            last_id = records[-1].ID
+
+    def _duplicate_ids_query(self):
+        """
+        Returns a query of the IDs of box_classification records that duplicate another record's (BOX_FILE_ID,
+        BOX_CLASSIFICATION_NAME, MCAS_POLICY_ID) key. An applied record is kept over a failed one, then the oldest.
+        """
+        ranked = self.session.query(
+            self.model.ID,
+            sql_func.row_number().over(
+                partition_by=[getattr(self.model, column_name) for column_name in self.unique_key],
+                order_by=[self.model.APPLIED.desc(), self.model.ID]
+            ).label("KEY_RANK")
+        ).subquery()
+
+        return self.session.query(ranked.c.ID).filter(ranked.c.KEY_RANK > 1)
+
+    def count_duplicates(self) -> int:
+        """
+        Returns the number of box_classification records that delete_duplicates would delete
+        """
+        with self.unit_of_work():
+            return self._duplicate_ids_query().count()
+
+    def delete_duplicates(self) -> int:
+        """
+        Deletes box_classification records that duplicate another record's (BOX_FILE_ID, BOX_CLASSIFICATION_NAME,
+        MCAS_POLICY_ID) key, keeping an applied record over a failed one, then the oldest. Returns the number of
+        deleted records.
+        """
+        deleted_count = self.model_query.filter(
+            self.model.ID.in_(self._duplicate_ids_query())
+        ).delete(synchronize_session=False)
+        self.commit()
+        log.info(f"deleted {deleted_count} duplicate {self.model.__tablename__} records")
+
+        return deleted_count
+
+    def existing_keys(
+            self,
+            keys: Iterable[Tuple[str, str, str]],
+            chunk_size: int = 1000
+    ) -> Set[Tuple[str, str, str]]:
+        """
+        Returns the subset of (BOX_FILE_ID, BOX_CLASSIFICATION_NAME, MCAS_POLICY_ID) keys that have a box_classification
+        record. Runs one BOX_FILE_ID IN query per classification and policy pair, chunked to stay under driver parameter
+        limits, in a single unit of work.
+        """
+        keys = list(keys)
+        if not keys:
+            return set()
+
+        with self.unit_of_work():
+            return super().existing_keys(keys, chunk_size)
@@ -0,0 +1,61 @@
+"""
+box_user SQL table model and manager
+"""
+
+import logging
+from typing import Dict, Iterable, Optional
+
+from sqlalchemy import Column, String, DateTime
+
+from src.sql import sql
+
+
+log = logging.getLogger(__name__)
+
+
+class BoxUser(sql.model):
+    """
+    box_user SQL table model. Maps a Box file owner email to a Box user ID. A NULL BOX_USER_ID records that no Box user
+    was found for the email.
+    """
+
+    __tablename__ = "box_user"
+
+    EMAIL = Column(String(255), primary_key=True)
+    BOX_USER_ID = Column(String(255))
+    RESOLVED_AT = Column(DateTime, nullable=False)
+
+    def __str__(self):
+        return f"<{type(self).__name__}:{self.EMAIL}:{self.BOX_USER_ID}>"
+
+
+class BoxUserSQLManager(sql.SQLManager):
+    """
+    box_user SQL table manager
+    """
+
+    model = BoxUser
+
+    def get_many(self, emails: Iterable[str], chunk_size: int = 1000) -> Dict[str, BoxUser]:
+        """
+        Returns a dictionary of email to box_user record for the emails with a record, using one IN query per chunk in
+        a single unit of work. The records are detached from the SQL session.
+        """
+        emails = list(set(emails))
+        records = dict()
+        with self.unit_of_work():
+            for chunk_start in range(0, len(emails), chunk_size):
+                for record in self.model_query.filter(
+                    self.model.EMAIL.in_(emails[chunk_start:chunk_start + chunk_size])
+                ):
+                    records[record.EMAIL] = record
+
+        return records
+
+    def save_many(self, box_user_ids: Dict[str, Optional[str]], resolved_at) -> None:
+        """
+        Inserts or updates box_user records from a dictionary of email to Box user ID in a single commit
+        """
+        for email, box_user_id in box_user_ids.items():
+            self.session.merge(self.model(EMAIL=email, BOX_USER_ID=box_user_id, RESOLVED_AT=resolved_at))
+        self.commit()
@@ -0,0 +1,40 @@
+"""
+mcas_policy_checkpoint SQL table model and manager
+"""
+
+import logging
+
+from sqlalchemy import Column, String, DateTime, Integer
+from sqlalchemy import func as sql_func
+
+from src.sql import sql
+
+
+log = logging.getLogger(__name__)
+
+
+class MCASPolicyCheckpoint(sql.model):
+    """
+    mcas_policy_checkpoint SQL table model
+    """
+
+    __tablename__ = "mcas_policy_checkpoint"
+
+    MCAS_POLICY_ID = Column(String(255), primary_key=True)
+    PAGINATE = Column(Integer, nullable=False, default=0)
+    PROCESSED_ALL_AT = Column(DateTime)
+    # Latest MCAS file modification processed by watermark polling, and when a full reconciliation scan last completed
+    WATERMARK = Column(DateTime)
+    RECONCILED_AT = Column(DateTime)
+    UPDATED = Column(DateTime, default=sql_func.now(), onupdate=sql_func.now())
+
+    def __str__(self):
+        return f"<{type(self).__name__}:{self.MCAS_POLICY_ID}:{self.PAGINATE}>"
+
+
+class MCASPolicyCheckpointSQLManager(sql.SQLManager):
+    """
+    mcas_policy_checkpoint SQL table manager
+    """
+
+    model = MCASPolicyCheckpoint
@@ -0,0 +1,209 @@
+"""
+sync_lease and sync_worker SQL table models and managers
+"""
+
+import datetime
+import logging
+from typing import Iterable, List, Optional, Set
+
+from sqlalchemy import Column, String, DateTime, Integer, or_
+from sqlalchemy import func as sql_func
+
+from src.sql import sql
+
+
+log = logging.getLogger(__name__)
+
+
+class SyncLease(sql.model):
+    """
+    sync_lease SQL table model. A lease row per sync shard, owned by at most one sync worker until it expires.
+    """
+
+    __tablename__ = "sync_lease"
+
+    SHARD_ID = Column(String(255), primary_key=True)
+    OWNER = Column(String(255))
+    EXPIRES_AT = Column(DateTime)
+    HEARTBEAT_AT = Column(DateTime)
+    CREATED = Column(DateTime, default=sql_func.now())
+    UPDATED = Column(DateTime, default=sql_func.now(), onupdate=sql_func.now())
+
+    def __str__(self):
+        return f"<{type(self).__name__}:{self.SHARD_ID}:{self.OWNER}>"
+
+
+class SyncWorker(sql.model):
+    """
+    sync_worker SQL table model. A row per live sync worker, so workers can size their fair share of the shards.
+    """
+
+    __tablename__ = "sync_worker"
+
+    WORKER_ID = Column(String(255), primary_key=True)
+    HOSTNAME = Column(String(255))
+    PID = Column(Integer)
+    EXPIRES_AT = Column(DateTime)
+    CREATED = Column(DateTime, default=sql_func.now())
+    UPDATED = Column(DateTime, default=sql_func.now(), onupdate=sql_func.now())
+
+    def __str__(self):
+        return f"<{type(self).__name__}:{self.WORKER_ID}>"
+
+
+class SyncLeaseSQLManager(sql.SQLManager):
+    """
+    sync_lease SQL table manager. Claims and renewals are single conditional UPDATE statements, so two workers racing
+    for a shard can never both own it.
+    """
+
+    model = SyncLease
+
+    def add_shards(self, shard_ids: Iterable[str]) -> None:
+        """
+        Inserts an unowned lease row for each shard that does not have one
+        """
+        self.bulk_insert_ignore_mappings([{"SHARD_ID": shard_id} for shard_id in shard_ids], ("SHARD_ID",))
+
+    def claim(self, shard_id: str, owner: str, ttl: float, now: Optional[datetime.datetime] = None) -> bool:
+        """
+        Claims a shard's lease for an owner if it is unowned, expired or already the owner's. Returns True if the owner
+        holds the lease.
+        """
+        now = now or datetime.datetime.utcnow()
+        claimed_count = self.model_query.filter(
+            self.model.SHARD_ID == shard_id,
+            or_(
+                self.model.OWNER == None,
+                self.model.OWNER == owner,
+                self.model.EXPIRES_AT == None,
+                self.model.EXPIRES_AT < now
+            )
+        ).update(
+            {
+                self.model.OWNER: owner,
+                self.model.EXPIRES_AT: now + datetime.timedelta(seconds=ttl),
+                self.model.HEARTBEAT_AT: now,
+            },
+            synchronize_session=False
+        )
+        self.commit()
+
+        return claimed_count == 1
+
+    def renew(
+            self,
+            owner: str,
+            shard_ids: Iterable[str],
+            ttl: float,
+            now: Optional[datetime.datetime] = None
+    ) -> Set[str]:
+        """
+        Extends the leases an owner still holds on a set of shards. Returns the shard IDs the owner holds.
+        """
+        now = now or datetime.datetime.utcnow()
+        shard_ids = list(shard_ids)
+        if shard_ids:
+            self.model_query.filter(
+                self.model.OWNER == owner,
+                self.model.SHARD_ID.in_(shard_ids)
+            ).update(
+                {self.model.EXPIRES_AT: now + datetime.timedelta(seconds=ttl), self.model.HEARTBEAT_AT: now},
+                synchronize_session=False
+            )
+            self.commit()
+
+        return self.owned_shard_ids(owner)
+
+    def owned_shard_ids(self, owner: str) -> Set[str]:
+        """
+        Returns the IDs of the shards whose lease an owner holds
+        """
+        return {row.SHARD_ID for row in self.session.query(self.model.SHARD_ID).filter(self.model.OWNER == owner)}
+
+    def release(self, owner: str, shard_ids: Iterable[str]) -> None:
+        """
+        Releases an owner's leases on a set of shards, so another worker can claim them without waiting for expiry
+        """
+        shard_ids = list(shard_ids)
+        if not shard_ids:
+            return
+
+        self.model_query.filter(
+            self.model.OWNER == owner,
+            self.model.SHARD_ID.in_(shard_ids)
+        ).update(
+            {self.model.OWNER: None, self.model.EXPIRES_AT: None},
+            synchronize_session=False
+        )
+        self.commit()
+        log.info(f"released {len(shard_ids)} {self.model.__tablename__} leases of {owner}")
+
+    def claimable_shard_ids(self, shard_ids: Iterable[str], now: Optional[datetime.datetime] = None) -> List[str]:
+        """
+        Returns the IDs of shards whose lease is unowned or expired, in shard ID order
+        """
+        now = now or datetime.datetime.utcnow()
+
+        return [
+            row.SHARD_ID
+            for row in self.session.query(self.model.SHARD_ID).filter(
+                self.model.SHARD_ID.in_(list(shard_ids)),
+                or_(self.model.OWNER == None, self.model.EXPIRES_AT == None, self.model.EXPIRES_AT < now)
+            ).order_by(self.model.SHARD_ID)
+        ]
+
+
+class SyncWorkerSQLManager(sql.SQLManager):
+    """
+    sync_worker SQL table manager
+    """
+
+    model = SyncWorker
+
+    def heartbeat(
+            self,
+            worker_id: str,
+            hostname: str,
+            pid: int,
+            ttl: float,
+            now: Optional[datetime.datetime] = None
+    ) -> None:
+        """
+        Registers a worker, or extends its registration
+        """
+        now = now or datetime.datetime.utcnow()
+        self.session.merge(
+            self.model(
+                WORKER_ID=worker_id,
+                HOSTNAME=hostname,
+                PID=pid,
+                EXPIRES_AT=now + datetime.timedelta(seconds=ttl)
+            )
+        )
+        self.commit()
+
+    def live_worker_count(self, now: Optional[datetime.datetime] = None) -> int:
+        """
+        Returns the number of workers whose registration has not expired
+        """
+        now = now or datetime.datetime.utcnow()
+
+        return self.model_query.filter(self.model.EXPIRES_AT >= now).count()
+
+    def delete_expired(self, now: Optional[datetime.datetime] = None) -> int:
+        """
+        Deletes the registrations of workers that stopped heartbeating. Returns the number of deleted registrations.
+        """
+        now = now or datetime.datetime.utcnow()
+        deleted_count = self.model_query.filter(self.model.EXPIRES_AT < now).delete(synchronize_session=False)
+        self.commit()
+
+        return deleted_count
+
+    def unregister(self, worker_id: str) -> None:
+        """
+        Deletes a worker's registration
+        """
+        self.model_query.filter(self.model.WORKER_ID == worker_id).delete(synchronize_session=False)
+        self.commit()
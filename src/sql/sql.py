@@ -2,14 +2,21 @@
 SQLAlchemy utilities for an interface into a SQL database
 """
 
+import contextlib
 import logging
 
 from abc import ABCMeta, abstractmethod
+from collections import defaultdict
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
 
 from sqlalchemy.orm import sessionmaker, scoped_session
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text, Table
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.ext.declarative import declarative_base
 
+from src import metrics
+
 
 log = logging.getLogger(__name__)
 
@@ -20,17 +27,93 @@ model = declarative_base()
 
 def configure_connection(config: dict) -> None:
     """
-    Connects to a SQL database defined in a configuration dictionary and set the connection as a global variable
+    Connects to a SQL database defined in a configuration dictionary and set the connection as a global variable. A
+    configured url, such as sqlite:///box_mcas.db, is used in place of the individual connection settings.
     """
     global connection
     sql_config = config["sql"]
-    if sql_config['driver'] == "mssql+pyodbc":
+    engine_kwargs = dict()
+    if sql_config.get("url"):
+        connection_string = sql_config["url"]
+        driver = make_url(connection_string).drivername
+        if driver == "mssql+pyodbc":
+            engine_kwargs["fast_executemany"] = True
+        elif driver in ("postgresql", "postgresql+psycopg2"):
+            engine_kwargs["executemany_mode"] = "values"
+        elif driver.startswith("sqlite"):
+            # SQL sessions are used from the pipeline and worker threads
+            engine_kwargs["connect_args"] = {"check_same_thread": False}
+    elif sql_config['driver'] == "mssql+pyodbc":
         connection_string = f"{sql_config['driver']}://{sql_config['username']}:{sql_config['password']}@{sql_config['host']}:{sql_config['port']}/{sql_config['database']}?driver=ODBC+Driver+17+for+SQL+Server;Encrypt=yes;TrustServerCertificate=no;"
+        # Send executemany parameter sets to SQL Server in one round trip instead of one per row
+        engine_kwargs["fast_executemany"] = True
     else:
         connection_string = f"{sql_config['driver']}://{sql_config['username']}:{sql_config['password']}@{sql_config['host']}:{sql_config['port']}/{sql_config['database']}"
+        if sql_config['driver'] in ("postgresql", "postgresql+psycopg2"):
+            # Batch executemany INSERTs into multi-row VALUES statements with psycopg2.extras.execute_values
+            engine_kwargs["executemany_mode"] = "values"
     print(connection_string)
-    connection = create_engine(connection_string)
-    log.debug(f"connected to SQL database {sql_config['host']}")
+    connection = create_engine(connection_string, **engine_kwargs)
+    log.debug(f"connected to SQL database {connection.url.host or connection.url.database}")
+
+
+def create_missing_indexes(sql_connection, table: Table) -> List[str]:
+    """
+    Creates a SQL table's declared indexes that do not exist in the database. Returns the names of the created indexes.
+    """
+    existing_index_names = {index["name"] for index in inspect(sql_connection).get_indexes(table.name)}
+    created_index_names = list()
+    for index in sorted(table.indexes, key=lambda table_index: table_index.name):
+        if index.name not in existing_index_names:
+            index.create(sql_connection)
+            created_index_names.append(index.name)
+            log.info(f"created SQL index {index.name} on {table.name}")
+
+    return created_index_names
+
+
+def add_missing_columns(sql_connection, table: Table) -> List[str]:
+    """
+    Adds a SQL table's declared nullable columns that do not exist in the database. Returns the names of the added
+    columns.
+    """
+    existing_column_names = {column["name"] for column in inspect(sql_connection).get_columns(table.name)}
+    preparer = sql_connection.dialect.identifier_preparer
+    added_column_names = list()
+    for column in table.columns:
+        if column.name not in existing_column_names and column.nullable:
+            sql_connection.execute(
+                f"ALTER TABLE {preparer.format_table(table)} ADD {preparer.quote(column.name)} "
+                f"{column.type.compile(dialect=sql_connection.dialect)}"
+            )
+            added_column_names.append(column.name)
+            log.info(f"added SQL column {table.name}.{column.name}")
+
+    return added_column_names
+
+
+def bound_indexed_columns(sql_connection, table: Table) -> List[str]:
+    """
+    Alters unbounded SQL Server string columns that a SQL table's declared indexes cover to their declared length, as
+    SQL Server cannot index VARCHAR(max) columns. Returns the names of the altered columns.
+    """
+    if sql_connection.dialect.name != "mssql":
+        return list()
+
+    existing_columns = {column["name"]: column for column in inspect(sql_connection).get_columns(table.name)}
+    preparer = sql_connection.dialect.identifier_preparer
+    altered_column_names = list()
+    for column in {column for index in table.indexes for column in index.columns}:
+        existing_length = getattr(existing_columns[column.name]["type"], "length", None)
+        if getattr(column.type, "length", None) and existing_length in (None, -1):
+            sql_connection.execute(
+                f"ALTER TABLE {preparer.format_table(table)} ALTER COLUMN {preparer.quote(column.name)} "
+                f"{column.type.compile(dialect=sql_connection.dialect)}"
+            )
+            altered_column_names.append(column.name)
+            log.info(f"altered SQL column {table.name}.{column.name} to {column.type}")
+
+    return altered_column_names
 
 
 class SQLManager(metaclass=ABCMeta):
@@ -38,6 +121,9 @@ class SQLManager(metaclass=ABCMeta):
     SQLAlchemy model manager abstract class with query utilities
     """
 
+    # Column names of a unique key. New records that match an existing record's unique key are skipped by bulk_update.
+    unique_key: Optional[Tuple[str, ...]] = None
+
     def __init__(self, sql_connection):
         self.session = self.session_from_connection(sql_connection)
 
@@ -52,9 +138,10 @@ class SQLManager(metaclass=ABCMeta):
     @staticmethod
     def session_from_connection(sql_connection):
         """
-        Returns a thread safe SQL session from a SQL connection object
+        Returns a thread safe SQL session from a SQL connection object. Commits do not expire the session's records, so
+        records detached at the end of a unit of work keep their loaded values rather than needing a reload.
         """
-        return scoped_session(sessionmaker(bind=sql_connection))()
+        return scoped_session(sessionmaker(bind=sql_connection, expire_on_commit=False))()
 
     def insert(self, **kwargs):
         """
@@ -62,27 +149,48 @@ class SQLManager(metaclass=ABCMeta):
         """
         record = self.model(**kwargs)
         self.update(record)
-        log.info(f"inserted {record}")
+        log.info("inserted %s", record)
 
         return record
 
     def commit(self):
         """
-        Commits a SQL session
+        Commits a SQL session, ending its unit of work. Every record is detached from the session whether the commit
+        succeeds or not, so the session's identity map only ever holds the records of the unit of work in progress.
         """
         try:
-            self.session.commit()
-            log.info(f"committed SQL session")
+            with metrics.registry.histogram(
+                    "sql_commit_seconds", "SQL commit latency", {"table": self.model.__tablename__}
+            ).time():
+                self.session.commit()
+            log.info("committed SQL session")
         except Exception as e:
             self.session.rollback()
             raise e
+        finally:
+            self.session.expunge_all()
+
+    @contextlib.contextmanager
+    def unit_of_work(self) -> Iterator:
+        """
+        Runs a batch of SQL work as a unit of work on the SQL session. The batch is committed when it completes, or
+        rolled back if it raises, and its records are detached from the session either way. Records loaded by the batch
+        keep their loaded values once detached.
+        """
+        try:
+            yield self.session
+        except Exception:
+            self.session.rollback()
+            self.session.expunge_all()
+            raise
+        self.commit()
 
     def update(self, record, commit=True):
         """
         Updates a SQL record
         """
         self.session.add(record)
-        log.info(f"added obj {record} to SQL session")
+        log.info("added obj %s to SQL session", record)
         if commit:
             self.commit()
 
@@ -130,12 +238,179 @@ class SQLManager(metaclass=ABCMeta):
         for record in records:
             self.delete(record)
 
+    def insert_mapping(self, record) -> dict:
+        """
+        Returns a SQL record's column values for a bulk INSERT. Unset primary keys and columns with defaults are left
+        out so the database fills them in.
+        """
+        mapping = dict()
+        for column_attr in inspect(self.model).column_attrs:
+            column = column_attr.columns[0]
+            value = getattr(record, column_attr.key)
+            if value is None and (column.primary_key or column.default is not None or column.server_default is not None):
+                continue
+            mapping[column_attr.key] = value
+
+        return mapping
+
+    def update_mapping(self, record) -> dict:
+        """
+        Returns a SQL record's primary key and loaded column values for a bulk UPDATE by primary key. Columns with an
+        onupdate value are left out so the database refreshes them.
+        """
+        return {
+            column_attr.key: record.__dict__[column_attr.key]
+            for column_attr in inspect(self.model).column_attrs
+            if column_attr.key in record.__dict__ and column_attr.columns[0].onupdate is None
+        }
+
+    def bulk_insert_mappings(self, mappings: List[dict], commit=True) -> None:
+        """
+        Inserts SQL records from a list of column value dictionaries with executemany INSERT statements
+        """
+        self.session.bulk_insert_mappings(self.model, mappings)
+        log.info(f"bulk inserted {len(mappings)} {self.model.__tablename__} records")
+        if commit:
+            self.commit()
+
+    def existing_keys(
+            self,
+            keys: Iterable[tuple],
+            chunk_size: int = 1000,
+            key_column_names: Optional[Tuple[str, ...]] = None
+    ) -> Set[tuple]:
+        """
+        Returns the subset of unique key tuples, by default of the manager's unique_key columns, that have a SQL record.
+        Keys are grouped by their other columns, and each group runs IN queries on the first column, chunked to stay
+        under driver parameter limits.
+        """
+        key_columns = [getattr(self.model, column_name) for column_name in key_column_names or self.unique_key]
+        first_values_by_rest = defaultdict(set)
+        for key in keys:
+            first_values_by_rest[tuple(key[1:])].add(key[0])
+
+        existing = set()
+        for rest_values, first_values in first_values_by_rest.items():
+            first_values = list(first_values)
+            for chunk_start in range(0, len(first_values), chunk_size):
+                rows = self.session.query(*key_columns).filter(
+                    *[key_column == value for key_column, value in zip(key_columns[1:], rest_values)],
+                    key_columns[0].in_(first_values[chunk_start:chunk_start + chunk_size])
+                )
+                existing.update(tuple(row) for row in rows)
+
+        return existing
+
+    def bulk_insert_ignore_mappings(self, mappings: List[dict], key_column_names: Tuple[str, ...], commit=True) -> None:
+        """
+        Inserts SQL records from a list of column value dictionaries, skipping records that match an existing record's
+        unique key. Uses INSERT ... ON CONFLICT DO NOTHING on PostgreSQL, INSERT OR IGNORE on SQLite and MERGE on SQL
+        Server, so inserting the same records twice is a no-op. Other dialects insert the records whose keys
+        existing_keys does not find, which a concurrent writer inserting the same keys can still conflict with.
+        """
+        table = self.model.__table__
+        dialect = self.session.bind.dialect
+        if dialect.name not in ("postgresql", "sqlite", "mssql"):
+            # Queries in the caller's unit of work, which a subclass's existing_keys may commit on its own
+            existing = SQLManager.existing_keys(
+                self,
+                {tuple(mapping[column_name] for column_name in key_column_names) for mapping in mappings},
+                key_column_names=key_column_names
+            )
+            new_mappings = dict()
+            for mapping in mappings:
+                key = tuple(mapping[column_name] for column_name in key_column_names)
+                if key not in existing:
+                    # Duplicate keys within the mappings are inserted once
+                    new_mappings.setdefault(key, mapping)
+            self.bulk_insert_mappings(list(new_mappings.values()), commit=commit)
+            return
+
+        # executemany needs the same columns in every parameter set
+        mappings_by_columns = dict()
+        for mapping in mappings:
+            mappings_by_columns.setdefault(tuple(mapping), list()).append(mapping)
+
+        for column_names, column_mappings in mappings_by_columns.items():
+            if dialect.name == "postgresql":
+                statement = postgresql.insert(table).on_conflict_do_nothing(index_elements=list(key_column_names))
+            elif dialect.name == "sqlite":
+                statement = table.insert().prefix_with("OR IGNORE")
+            else:
+                statement = self._merge_insert_statement(column_names, key_column_names)
+            self.session.execute(statement, column_mappings)
+        log.info(f"bulk inserted {len(mappings)} {self.model.__tablename__} records ignoring existing keys")
+        if commit:
+            self.commit()
+
+    def _merge_insert_statement(self, column_names: Tuple[str, ...], key_column_names: Tuple[str, ...]):
+        """
+        Returns a SQL Server MERGE statement that inserts a record unless its unique key matches an existing record.
+        Columns left out of the record get their SQL expression default.
+        """
+        table = self.model.__table__
+        dialect = self.session.bind.dialect
+        quote = dialect.identifier_preparer.quote
+        insert_columns = [column for column in table.columns if column.name in column_names]
+        default_columns = [
+            column for column in table.columns
+            if column.name not in column_names and column.default is not None and column.default.is_clause_element
+        ]
+        source_columns = ", ".join(f":{column.name} AS {quote(column.name)}" for column in insert_columns)
+        key_match = " AND ".join(f"target.{quote(name)} = source.{quote(name)}" for name in key_column_names)
+        insert_column_names = ", ".join(quote(column.name) for column in insert_columns + default_columns)
+        insert_values = ", ".join(
+            [f"source.{quote(column.name)}" for column in insert_columns]
+            + [str(column.default.arg.compile(dialect=dialect)) for column in default_columns]
+        )
+
+        return text(
+            f"MERGE {dialect.identifier_preparer.format_table(table)} WITH (HOLDLOCK) AS target "
+            f"USING (SELECT {source_columns}) AS source ON {key_match} "
+            f"WHEN NOT MATCHED THEN INSERT ({insert_column_names}) VALUES ({insert_values});"
+        )
+
+    def bulk_update_mappings(self, mappings: List[dict], commit=True) -> None:
+        """
+        Updates SQL records by primary key from a list of column value dictionaries with executemany UPDATE statements
+        """
+        self.session.bulk_update_mappings(self.model, mappings)
+        log.info(f"bulk updated {len(mappings)} {self.model.__tablename__} records")
+        if commit:
+            self.commit()
+
+    def expunge(self, records: Iterable) -> None:
+        """
+        Detaches SQL records from the SQL session. Detached records are not expired or reloaded by later commits, and
+        are written back by primary key with bulk_update.
+        """
+        for record in records:
+            if inspect(record).session is not None:
+                self.session.expunge(record)
+
     def bulk_update(self, records):
         """
-        Updates a list of SQL records
+        Inserts new and updates existing SQL records in bulk, in a single commit. Records without a primary key are
+        inserted with executemany INSERT statements, skipping records that match an existing record's unique key if the
+        manager has one. Records loaded from the database are detached from the SQL session and updated by primary key
+        with executemany UPDATE statements.
         """
+        insert_mappings = list()
+        update_mappings = list()
         for record in records:
-            self.update(record, commit=False)
+            if inspect(record).key is None:
+                insert_mappings.append(self.insert_mapping(record))
+            else:
+                update_mappings.append(self.update_mapping(record))
+        # Detach loaded records so the session's unit of work does not write them a second time
+        self.expunge(records)
+
+        if insert_mappings and self.unique_key:
+            self.bulk_insert_ignore_mappings(insert_mappings, self.unique_key, commit=False)
+        elif insert_mappings:
+            self.bulk_insert_mappings(insert_mappings, commit=False)
+        if update_mappings:
+            self.bulk_update_mappings(update_mappings, commit=False)
         self.commit()
 
     @property
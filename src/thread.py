@@ -2,11 +2,16 @@
 Threading utilities
 """
 
+from __future__ import annotations
+from collections import deque
 import concurrent.futures
-from typing import Callable, List, Any
+import queue
+from typing import Callable, Deque, Dict, Hashable, List, Any, Iterator, NamedTuple, Optional, Tuple
 import threading
 import functools
 
+from src import metrics
+
 
 def run_in_thread_pool(task: Callable, tasks_args: List, max_workers: int = 100) -> List:
     """
@@ -23,16 +28,248 @@ def run_in_thread_pool(task: Callable, tasks_args: List, max_workers: int = 100)
 
 def thread_safe(function: Callable) -> Any:
     """
-    Decorator to block the the main thread while the decorated function runs. Used for ensuring data consistency of
+    Decorator to serialize calls to the decorated function across threads. Used for ensuring data consistency of
     objects shared across threads.
     """
+    lock = threading.Lock()
+
     @functools.wraps(function)
     def wrapper(*args, **kwargs):
-        lock = threading.Lock()
-        lock.acquire()
-        function_return = function(*args, **kwargs)
-        lock.release()
-
-        return function_return
+        with lock:
+            return function(*args, **kwargs)
 
     return wrapper
+
+
+def configure_worker_pool(config: dict) -> WorkerPool:
+    """
+    Configures a WorkerPool from the "worker_pool" settings of a configuration dictionary's "sync" section
+    """
+    worker_pool_config = config.get("sync", {}).get("worker_pool") or {}
+
+    return WorkerPool(
+        worker_pool_config.get("size", 100),
+        worker_pool_config.get("queue_size", 1000),
+    )
+
+
+class TaskResult(NamedTuple):
+    """
+    Result of a task run in a WorkerPool. Holds the task's return value, or the exception it raised.
+    """
+    tag: Any
+    value: Any
+    error: Optional[BaseException]
+
+
+class TaskFlow:
+    """
+    A WorkerPool flow's weight, concurrency cap, queued tasks and fair queuing state
+    """
+
+    def __init__(self, weight: float = 1, max_concurrency: Optional[int] = None) -> TaskFlow:
+        if weight <= 0:
+            raise ValueError("weight must be greater than 0")
+
+        self.weight: float = weight
+        self.max_concurrency: Optional[int] = max_concurrency
+        self.queued: Deque[Tuple[float, tuple]] = deque()
+        self.running: int = 0
+        self.waiting: int = 0
+        self.finish_tag: float = 0
+
+    @property
+    def runnable(self) -> bool:
+        """
+        True if the flow has a queued task and is below its concurrency cap
+        """
+        return bool(self.queued) and (not self.max_concurrency or self.running < self.max_concurrency)
+
+
+class WorkerPool:
+    """
+    Long-lived pool of worker threads fed by a bounded submission queue. Submitting blocks while the queue is full,
+    which applies backpressure to producers. Each task's TaskResult is put on a results queue as soon as the task
+    completes, so callers can consume results as a stream instead of waiting for a whole batch.
+
+    Tasks are submitted to flows, such as one per MCAS DLP policy, which share the pool by weighted fair queuing. Each
+    task is stamped with a virtual finish time that advances by 1 / weight per task of its flow, and workers run the
+    queued task with the earliest finish time, skipping flows at their concurrency cap. A flow with a backlog therefore
+    cannot starve the others of workers, and while the queue is full each flow with blocked producers gets an equal
+    share of its slots. The pool's concurrency caps the tasks running across every flow, and can be lowered below the
+    pool size and raised back while the pool runs.
+    """
+
+    def __init__(self, size: int = 100, queue_size: int = 1000, name: str = "worker") -> WorkerPool:
+        if size <= 0:
+            raise ValueError("size must be greater than 0")
+
+        self._size: int = size
+        self._queue_size: int = max(1, queue_size)
+        self._lock: threading.Lock = threading.Lock()
+        self._task_queued: threading.Condition = threading.Condition(self._lock)
+        self._slot_freed: threading.Condition = threading.Condition(self._lock)
+        self._flows: Dict[Hashable, TaskFlow] = dict()
+        self._queued: int = 0
+        self._concurrency: int = size
+        self._running: int = 0
+        self._virtual_time: float = 0
+        self._shutting_down: bool = False
+        self._results: queue.Queue = queue.Queue()
+        self._threads: List[threading.Thread] = [
+            threading.Thread(target=self._work, name=f"{name}-{thread_index}", daemon=True)
+            for thread_index in range(size)
+        ]
+        for worker_thread in self._threads:
+            worker_thread.start()
+        metrics.registry.gauge(
+            "worker_pool_queue_depth", "Submitted tasks waiting for a worker", {"pool": name}
+        ).set_function(lambda: self._queued)
+
+    @property
+    def size(self) -> int:
+        """
+        Number of worker threads
+        """
+        return self._size
+
+    @property
+    def concurrency(self) -> int:
+        """
+        Cap on tasks running at once across every flow
+        """
+        return self._concurrency
+
+    def set_concurrency(self, concurrency: int) -> None:
+        """
+        Sets the cap on tasks running at once, between 1 and the pool size. Running tasks above a lowered cap complete.
+        """
+        with self._lock:
+            self._concurrency = max(1, min(self._size, concurrency))
+            self._task_queued.notify_all()
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        Number of submitted tasks waiting for a worker
+        """
+        return self._queued
+
+    def configure_flow(self, flow: Hashable, weight: float = 1, max_concurrency: Optional[int] = None) -> None:
+        """
+        Sets a flow's weight, relative to the other flows' weights, and its cap on concurrently running tasks
+        """
+        if weight <= 0:
+            raise ValueError("weight must be greater than 0")
+
+        with self._lock:
+            task_flow = self._flows.setdefault(flow, TaskFlow())
+            task_flow.weight = weight
+            task_flow.max_concurrency = max_concurrency
+            self._task_queued.notify_all()
+
+    def _fair_share(self) -> int:
+        """
+        Returns the number of queue slots each flow with queued tasks or blocked producers may hold. Called with the
+        lock held.
+        """
+        active_flow_count = sum(1 for task_flow in self._flows.values() if task_flow.queued or task_flow.waiting)
+
+        return max(1, self._queue_size // max(1, active_flow_count))
+
+    def _next_task(self) -> Optional[Tuple[TaskFlow, tuple]]:
+        """
+        Takes the queued task with the earliest virtual finish time among the flows below their concurrency cap, waiting
+        for one to be queued and the pool to be below its concurrency. Returns None once the pool is shut down and every
+        queued task has been taken.
+        """
+        with self._lock:
+            while True:
+                runnable_flows = [
+                    task_flow for task_flow in self._flows.values() if task_flow.runnable
+                ] if self._running < self._concurrency else []
+                if runnable_flows:
+                    break
+                if self._shutting_down and not self._queued:
+                    return None
+                self._task_queued.wait()
+
+            task_flow = min(runnable_flows, key=lambda runnable_flow: runnable_flow.queued[0][0])
+            finish_tag, submitted_task = task_flow.queued.popleft()
+            self._queued -= 1
+            self._virtual_time = max(self._virtual_time, finish_tag)
+            task_flow.running += 1
+            self._running += 1
+            self._slot_freed.notify_all()
+
+            return task_flow, submitted_task
+
+    def _work(self) -> None:
+        """
+        Worker thread loop that runs queued tasks until the pool shuts down
+        """
+        while True:
+            next_task = self._next_task()
+            if next_task is None:
+                return
+
+            task_flow, (task, task_args, tag, results) = next_task
+            try:
+                results.put(TaskResult(tag, task(*task_args), None))
+            except BaseException as e:
+                results.put(TaskResult(tag, None, e))
+            finally:
+                with self._lock:
+                    task_flow.running -= 1
+                    self._running -= 1
+                    if self._queued:
+                        # A worker may be waiting on this flow's or the pool's concurrency cap
+                        self._task_queued.notify()
+
+    def submit(
+            self,
+            task: Callable,
+            *task_args,
+            tag: Any = None,
+            results: Optional[queue.Queue] = None,
+            flow: Hashable = None
+    ) -> None:
+        """
+        Submits a task to a flow of the pool, blocking while the submission queue is full or the flow holds its share of
+        it. The task's TaskResult is put on the given results queue, or the pool's shared results queue.
+        """
+        submitted_task = (task, task_args, tag, results if results is not None else self._results)
+        with self._lock:
+            task_flow = self._flows.get(flow)
+            if task_flow is None:
+                task_flow = self._flows[flow] = TaskFlow()
+            task_flow.waiting += 1
+            while self._queued >= self._queue_size or len(task_flow.queued) >= self._fair_share():
+                self._slot_freed.wait()
+            task_flow.waiting -= 1
+            task_flow.finish_tag = max(self._virtual_time, task_flow.finish_tag) + 1 / task_flow.weight
+            task_flow.queued.append((task_flow.finish_tag, submitted_task))
+            self._queued += 1
+            self._task_queued.notify()
+
+    def results(self, block: bool = False, timeout: Optional[float] = None) -> Iterator[TaskResult]:
+        """
+        Yields task results from the pool's shared results queue. Yields every result already available, blocking for
+        the first one if block is True.
+        """
+        try:
+            yield self._results.get(block=block, timeout=timeout)
+            while True:
+                yield self._results.get_nowait()
+        except queue.Empty:
+            return
+
+    def shutdown(self) -> None:
+        """
+        Stops every worker thread once the tasks already submitted have run
+        """
+        with self._lock:
+            self._shutting_down = True
+            self._task_queued.notify_all()
+        for worker_thread in self._threads:
+            worker_thread.join()
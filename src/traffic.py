@@ -0,0 +1,402 @@
+"""
+Record and replay of the MCAS and Box HTTP traffic of a sync run. A recording is a directory of gzip compressed JSONL
+files with an exchange per line, and a replay serves the recorded responses from a local HTTP server.
+"""
+
+from __future__ import annotations
+from collections import defaultdict, deque
+import atexit
+import base64
+import datetime
+import functools
+import glob
+import gzip
+import http.server
+import json
+import logging
+import os
+import threading
+import time
+from typing import Deque, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+import requests.adapters
+from boxsdk.config import API
+
+from src import mcas
+
+
+log = logging.getLogger(__name__)
+
+REPLAY_ORIGINAL_TIMING = "original"
+REPLAY_FAST = "fast"
+
+# Requests that carry credentials are never recorded. Replays authenticate with a placeholder access token instead.
+UNRECORDED_PATHS = ("/oauth2/token",)
+UNRECORDED_RESPONSE_HEADERS = ("set-cookie",)
+# Replayed bodies are served decoded and whole, and the replay server sends its own Server and Date headers
+UNREPLAYED_RESPONSE_HEADERS = (
+    "content-length", "content-encoding", "transfer-encoding", "connection", "server", "date"
+)
+
+
+def encode_body(body) -> dict:
+    """
+    Returns the JSONL fields of a request or response body, as text or base64 for binary bodies
+    """
+    if body is None or body == b"" or body == "":
+        return dict()
+    if isinstance(body, str):
+        return {"text": body}
+    if not isinstance(body, bytes):
+        return {"text": repr(body)}
+    try:
+        return {"text": body.decode("utf-8")}
+    except UnicodeDecodeError:
+        return {"base64": base64.b64encode(body).decode("ascii")}
+
+
+def decode_body(fields: Optional[dict]) -> bytes:
+    """
+    Returns the bytes of a body from its JSONL fields
+    """
+    if not fields:
+        return b""
+    if "base64" in fields:
+        return base64.b64decode(fields["base64"])
+
+    return fields["text"].encode("utf-8")
+
+
+class TrafficRecorder:
+    """
+    Records every HTTP exchange made through requests, which the MCAS client and boxsdk use, and aiohttp, which the
+    asyncio engine uses, with its start time and latency. Recording patches requests' HTTPAdapter.send and aiohttp's
+    ClientSession._request for the whole process while started. Response bodies are read in full before they are
+    returned, so streamed MCAS pages are recorded whole.
+    """
+
+    def __init__(self, record_dir: str) -> TrafficRecorder:
+        os.makedirs(record_dir, exist_ok=True)
+        self.path: str = os.path.join(
+            record_dir, f"traffic-{datetime.datetime.utcnow():%Y%m%dT%H%M%S}-{os.getpid()}.jsonl.gz"
+        )
+        self._file = None
+        self._lock: threading.Lock = threading.Lock()
+        self._started_at: float = 0
+        self._exchange_count: int = 0
+        self._unpatches: List[Tuple[type, str, object]] = list()
+
+    def record(
+            self,
+            method: str,
+            url: str,
+            request_body,
+            started_at: float,
+            elapsed: float,
+            status: Optional[int] = None,
+            headers: Optional[dict] = None,
+            body: Optional[bytes] = None,
+            error: Optional[BaseException] = None
+    ) -> None:
+        """
+        Writes an HTTP exchange, or a request that failed without a response, to the recording
+        """
+        if urlparse(url).path.endswith(UNRECORDED_PATHS):
+            return
+
+        exchange = {
+            "started_at": round(started_at - self._started_at, 6),
+            "elapsed": round(elapsed, 6),
+            "method": method.upper(),
+            "url": url,
+            "request_body": encode_body(request_body),
+        }
+        if error is not None:
+            exchange["error"] = repr(error)
+        else:
+            exchange.update({
+                "status": status,
+                "headers": {
+                    name: value for name, value in (headers or {}).items()
+                    if name.lower() not in UNRECORDED_RESPONSE_HEADERS
+                },
+                "body": encode_body(body),
+            })
+        line = json.dumps(exchange, separators=(",", ":")) + "\n"
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line.encode("utf-8"))
+                self._exchange_count += 1
+
+    def _patch(self, owner: type, name: str, replacement) -> None:
+        """
+        Replaces a class attribute until the recorder stops
+        """
+        self._unpatches.append((owner, name, owner.__dict__[name]))
+        setattr(owner, name, replacement)
+
+    def start(self) -> TrafficRecorder:
+        """
+        Opens the recording and starts recording the process's HTTP traffic
+        """
+        self._file = gzip.open(self.path, "wb")
+        self._started_at = time.monotonic()
+        recorder = self
+        send = requests.adapters.HTTPAdapter.send
+
+        @functools.wraps(send)
+        def recording_send(adapter, request, *args, **kwargs):
+            started_at = time.monotonic()
+            try:
+                response = send(adapter, request, *args, **kwargs)
+                body = response.content
+            except Exception as e:
+                recorder.record(
+                    request.method, request.url, request.body, started_at, time.monotonic() - started_at, error=e
+                )
+                raise
+            recorder.record(
+                request.method,
+                request.url,
+                request.body,
+                started_at,
+                time.monotonic() - started_at,
+                response.status_code,
+                dict(response.headers),
+                body
+            )
+
+            return response
+
+        self._patch(requests.adapters.HTTPAdapter, "send", recording_send)
+
+        try:
+            import aiohttp
+        except ImportError:
+            aiohttp = None
+        if aiohttp is not None:
+            session_request = aiohttp.ClientSession._request
+
+            @functools.wraps(session_request)
+            async def recording_session_request(session, method, url, *args, **kwargs):
+                request_body = json.dumps(kwargs["json"]) if kwargs.get("json") is not None else kwargs.get("data")
+                started_at = time.monotonic()
+                try:
+                    response = await session_request(session, method, url, *args, **kwargs)
+                    # The body is kept on the response, so the caller's read returns it again
+                    body = await response.read()
+                except Exception as e:
+                    recorder.record(method, str(url), request_body, started_at, time.monotonic() - started_at, error=e)
+                    raise
+                recorder.record(
+                    method,
+                    str(response.url),
+                    request_body,
+                    started_at,
+                    time.monotonic() - started_at,
+                    response.status,
+                    dict(response.headers),
+                    body
+                )
+
+                return response
+
+            self._patch(aiohttp.ClientSession, "_request", recording_session_request)
+
+        atexit.register(self.stop)
+        log.info(f"recording MCAS and Box traffic to {self.path}")
+
+        return self
+
+    def stop(self) -> None:
+        """
+        Stops recording and closes the recording
+        """
+        while self._unpatches:
+            owner, name, original = self._unpatches.pop()
+            setattr(owner, name, original)
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.close()
+            self._file = None
+        log.info(f"recorded {self._exchange_count} HTTP exchanges to {self.path}")
+
+
+def load_exchanges(replay_dir: str) -> List[dict]:
+    """
+    Reads the HTTP exchanges of the recordings in a directory in recording order. A recording cut short by a killed
+    process is read up to its last complete exchange.
+    """
+    exchanges = list()
+    recording_paths = sorted(glob.glob(os.path.join(replay_dir, "*.jsonl.gz")))
+    if not recording_paths:
+        raise FileNotFoundError(f"no .jsonl.gz traffic recordings in {replay_dir}")
+
+    for recording_path in recording_paths:
+        recording_exchanges = list()
+        try:
+            with gzip.open(recording_path, "rt", encoding="utf-8") as fh:
+                for line in fh:
+                    recording_exchanges.append(json.loads(line))
+        except (EOFError, ValueError) as e:
+            log.warning(f"read {len(recording_exchanges)} HTTP exchanges of truncated recording {recording_path}: {e}")
+        exchanges.extend(sorted(recording_exchanges, key=lambda exchange: exchange["started_at"]))
+    log.info(f"loaded {len(exchanges)} HTTP exchanges from {len(recording_paths)} recordings in {replay_dir}")
+
+    return exchanges
+
+
+class ReplayRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Keep-alive HTTP request handler that answers requests with recorded responses
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def _handle(self) -> None:
+        content_length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(content_length) if content_length else b""
+        self.server.replay.respond(self, body)
+
+    do_GET = _handle
+    do_POST = _handle
+    do_PUT = _handle
+    do_DELETE = _handle
+
+    def log_message(self, format, *args) -> None:
+        """
+        Silences per request logging
+        """
+        pass
+
+
+class ReplayServer:
+    """
+    Local HTTP server that answers requests with the recorded responses to the same method, path, query and body, in
+    recording order. Requests that never match exactly, such as MCAS polls filtered by a watermark taken from the
+    clock, fall back to the recorded responses to the same method, path and query, then to the same method and path.
+    Once the responses to a request are used up the last is repeated. Recorded connection failures are replayed by
+    closing the connection.
+
+    With original timing, each response is delayed by its recorded latency. Otherwise responses are served as fast as
+    possible.
+    """
+
+    def __init__(
+            self,
+            exchanges: List[dict],
+            timing: str = REPLAY_ORIGINAL_TIMING,
+            host: str = "127.0.0.1",
+            port: int = 0
+    ) -> ReplayServer:
+        self._timing: str = timing
+        self._lock: threading.Lock = threading.Lock()
+        # Exchanges by match key, most specific first, and the last exchange served for each key
+        self._exchanges: Dict[tuple, Deque[dict]] = defaultdict(deque)
+        self._last_exchanges: Dict[tuple, dict] = dict()
+        for exchange in exchanges:
+            url = urlparse(exchange["url"])
+            for key in self.match_keys(exchange["method"], url.path, url.query, decode_body(exchange["request_body"])):
+                self._exchanges[key].append(exchange)
+        self._served: set = set()
+        self._server = http.server.ThreadingHTTPServer((host, port), ReplayRequestHandler)
+        self._server.daemon_threads = True
+        self._server.replay = self
+
+    @staticmethod
+    def match_keys(method: str, path: str, query: str, body: bytes) -> List[tuple]:
+        """
+        Returns the keys a request is matched on, most specific first
+        """
+        path = path.rstrip("/")
+
+        return [(method, path, query, body), (method, path, query), (method, path)]
+
+    @property
+    def url(self) -> str:
+        """
+        Base URL of the running server
+        """
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> ReplayServer:
+        """
+        Serves requests on a daemon thread
+        """
+        threading.Thread(target=self._server.serve_forever, name="replay-server", daemon=True).start()
+        log.info(f"replaying recorded MCAS and Box traffic from {self.url} with {self._timing} timing")
+
+        return self
+
+    def stop(self) -> None:
+        """
+        Stops serving requests
+        """
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _next_exchange(self, method: str, path: str, query: str, body: bytes) -> Optional[dict]:
+        """
+        Takes the next unserved recorded exchange matching a request, or repeats the last one served
+        """
+        with self._lock:
+            for key in self.match_keys(method, path, query, body):
+                exchanges = self._exchanges.get(key)
+                while exchanges and id(exchanges[0]) in self._served:
+                    exchanges.popleft()
+                if exchanges:
+                    exchange = exchanges.popleft()
+                    self._served.add(id(exchange))
+                    self._last_exchanges[key] = exchange
+                    return exchange
+            for key in self.match_keys(method, path, query, body):
+                if key in self._last_exchanges:
+                    return self._last_exchanges[key]
+
+        return None
+
+    def respond(self, handler: ReplayRequestHandler, body: bytes) -> None:
+        """
+        Answers a request with its recorded response
+        """
+        url = urlparse(handler.path)
+        exchange = self._next_exchange(handler.command, url.path, url.query, body)
+        if exchange is None:
+            log.warning(f"no recorded response to {handler.command} {handler.path}")
+            handler.send_response(404)
+            handler.send_header("Content-Length", "0")
+            handler.end_headers()
+            return
+
+        if self._timing == REPLAY_ORIGINAL_TIMING:
+            time.sleep(exchange["elapsed"])
+        if "error" in exchange:
+            handler.close_connection = True
+            return
+
+        response_body = decode_body(exchange.get("body"))
+        handler.send_response(exchange["status"])
+        for name, value in exchange.get("headers", {}).items():
+            if name.lower() not in UNREPLAYED_RESPONSE_HEADERS:
+                handler.send_header(name, value)
+        handler.send_header("Content-Length", str(len(response_body)))
+        handler.end_headers()
+        handler.wfile.write(response_body)
+
+
+def configure_replay_server(config: dict, replay_dir: str, timing: str = REPLAY_ORIGINAL_TIMING) -> ReplayServer:
+    """
+    Starts a ReplayServer of the recordings in a directory and points a configuration dictionary's MCAS and Box API
+    URLs at it. Box requests are authenticated with a placeholder access token.
+    """
+    replay_server = ReplayServer(load_exchanges(replay_dir), timing).start()
+    mcas_path = urlparse(mcas.mcas_base_url(config["mcas"])).path
+    box_path = urlparse(config["box"].get("api_base_url") or API.BASE_API_URL).path
+    config["mcas"]["base_url"] = f"{replay_server.url}{mcas_path}"
+    config["box"]["api_base_url"] = f"{replay_server.url}{box_path}"
+    config["box"]["access_token"] = "replay"
+
+    return replay_server